@@ -1,6 +1,5 @@
 # app.py 
 import streamlit as st
-import sqlite3
 from datetime import datetime
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -9,23 +8,39 @@ import plotly.express as px
 import plotly.graph_objects as go
 import time
 import os
+import json
+import functools
+
+import db
+import sqltrace
+
+from log_export import EXPORT_DIR
+from charts import (
+    GRANULARITIES, patients_added_series, log_activity_series, log_counts_by, diagnosis_counts, diagnosis_series,
+)
+from diagnoses import add_synonym
+from storage import get_profile, active_profile_name
+from backup import load_manifest as load_backup_manifest, start_wal_archiver
+from jobs import (
+    submit_job, list_jobs, cancel_job, schedule_job, unschedule_job, list_schedules, start_job_runner
+)
 
 from utils import (
-    verify_password, log_action, get_logs_df, anonymize_all_unanonymized,
+    verify_password, log_action, get_logs_df,
     get_all_patients_raw, get_patients_for_doctor, add_patient_admin,
-     delete_patient_admin, export_patients_csv,
-    apply_data_retention, ensure_db_exists,get_patient_by_id,update_patient_admin,insert_patient, encrypt_field,decrypt_field
+     delete_patient_admin,
+    ensure_db_exists,get_patient_by_id,update_patient_admin,insert_patient, encrypt_field,decrypt_field,
+    enable_read_replica, get_connection, get_read_connection, ensure_schema,
+    update_patient, UPDATE_OK, UPDATE_CONFLICT,
+    check_user_password, select_patient_ids, bulk_delete_patients, bulk_update_diagnosis,
+    bulk_reanonymize_patients, count_patients, count_logs, time_range, get_encounters, get_slow_queries_df
 )
 
-#-----------------------dynamic file path------------------
-DB_PATH = os.path.join(os.path.dirname(__file__), "database.db")
-
-def ensure_db_exists():
-    return os.path.exists(DB_PATH)
-
+#-----------------------database connection------------------
+# The database location comes from db.DB_PATH (HMS_DATABASE); see db.py
 def create_connection():
     try:
-        conn = sqlite3.connect("database.db", check_same_thread=False)
+        conn = get_connection()
         return conn
     except Exception as e:
         st.error(f"Database connection error: {e}")
@@ -44,6 +59,36 @@ if 'consent_given' not in st.session_state:
 if 'last_uptime' not in st.session_state:
     st.session_state['last_uptime'] = datetime.now()
 
+# ---------------------- Server timing ----------------------
+# Append one JSON line per full rerun ("app") and per fragment rerun to this file
+# (summarize with: python -m hms perf FILE).
+PERF_LOG = os.environ.get("HMS_PERF_LOG")
+
+def record_timing(scope, started):
+    """Store the server time since `started` (time.perf_counter) under scope."""
+    ms = (time.perf_counter() - started) * 1000
+    st.session_state.setdefault('perf', {})[scope] = round(ms, 1)
+    if PERF_LOG:
+        with open(PERF_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": round(time.time(), 3), "scope": scope, "ms": round(ms, 2),
+                                "role": st.session_state.get('role')}) + "\n")
+
+def timed_fragment(scope, run_every=None):
+    """
+    st.fragment whose runs are timed under scope: interacting inside it reruns only the
+    fragment, as does every run_every seconds when given.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_timing(scope, started)
+        return st.fragment(wrapper, run_every=run_every)
+    return decorator
+
 # ---------------------- Consent Banner ----------------------
 def show_consent_banner():
     if st.session_state.get("consent_given", False):
@@ -65,11 +110,14 @@ def login():
         st.error("Database file not found. Run database_setup.py and seed_data.py first.")
         return
 
-    username = st.text_input("Username")
-    password = st.text_input("Password", type="password")
+    # A form submits once, instead of rerunning the page after each field
+    with st.form("login_form"):
+        username = st.text_input("Username")
+        password = st.text_input("Password", type="password")
+        submitted = st.form_submit_button("Login")
 
-    if st.button("Login"):
-        conn = sqlite3.connect('database.db')
+    if submitted:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT user_id, password, role FROM users WHERE username=?", (username,))
         user = cursor.fetchone()
@@ -137,6 +185,7 @@ def show_logout_prompt():
             st.rerun()
 
 # ---------------------- Admin Pages ----------------------
+@timed_fragment("patients:view")
 def admin_view_data():
     st.header("View Patient Data (Admin)")
     df = get_all_patients_raw()
@@ -151,17 +200,11 @@ def admin_view_data():
     pid = st.number_input("Enter patient id to view original", min_value=1, value=1, step=1)
 
     if st.button("Show Original Record"):
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM patients WHERE patient_id=?", (pid,))
-        row = cursor.fetchone()
-        conn.close()
+        rec = get_patient_by_id(pid)
 
-        if not row:
+        if not rec:
             st.error("Patient ID not found.")
         else:
-            rec = dict(zip([column[0] for column in cursor.description], row))
-
             st.write({
                 "patient_id": rec['patient_id'],
                 "name (original)": decrypt_field(rec['name']),
@@ -175,347 +218,436 @@ def admin_view_data():
         log_action(st.session_state['user_id'], st.session_state['role'], "DecryptView", f"Viewed original patient_id {pid}")
 
 
+USER_ROLES = ["doctor", "admin", "receptionist"]
+
 def show_user_management_page():
     st.subheader("User Management")
 
-    tab1, tab2, tab3, tab4 = st.tabs([
-        "👁 View Users",
-        "➕ Add User",
-        "✏️ Edit User",
-        "🗑 Delete User"
-    ])
-
-    # ----------------TAB 1----------VIEW USERS------------------
-    with tab1:
-        st.write("### All Users")
+    # Only the selected section runs (and queries); st.tabs would run all four on every rerun
+    section = st.radio("Section", ["👁 View Users", "➕ Add User", "✏️ Edit User", "🗑 Delete User"],
+                       horizontal=True, label_visibility="collapsed", key="user_mgmt_section")
+    if section == "👁 View Users":
+        users_view_section()
+    elif section == "➕ Add User":
+        users_add_section()
+    elif section == "✏️ Edit User":
+        users_edit_section()
+    else:
+        users_delete_section()
 
-        # Example: Fetch users (you will replace with SQL)
-        try:
-            conn = create_connection()
-            df = pd.read_sql("SELECT user_id, username, role FROM users", conn)
-            st.dataframe(df, use_container_width=True)
-        except Exception as e:
-            st.error(f"Error fetching users: {e}")
+# ----------------SECTION 1----------VIEW USERS------------------
+@timed_fragment("users:view")
+def users_view_section():
+    st.write("### All Users")
+    try:
+        conn = create_connection()
+        df = pd.read_sql("SELECT user_id, username, role FROM users", conn)
+        conn.close()
+        st.dataframe(df, use_container_width=True)
+    except Exception as e:
+        st.error(f"Error fetching users: {e}")
 
-    # --------------------TAB 2----------------ADD USER--------------
-    with tab2:
-        st.subheader("➕ Add New User")
+# --------------------SECTION 2----------------ADD USER--------------
+@timed_fragment("users:add")
+def users_add_section():
+    st.subheader("➕ Add New User")
 
+    with st.form("add_user_form", clear_on_submit=True):
         new_username = st.text_input("Username")
         new_password = st.text_input("Password", type="password")
-        new_role = st.selectbox("Role", ["doctor", "admin", "receptionist"])
+        new_role = st.selectbox("Role", USER_ROLES)
+        submitted = st.form_submit_button("Add User")
 
-        if st.button("Add User"):
-            if not new_username or not new_password:
-                st.error("Username and Password are mandatory.")
-            else:
-                try:
-                    conn = create_connection()
-                    cur = conn.cursor()
-                    cur.execute(
-                        "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                        (new_username, encrypt_field(new_password), new_role)
-                    )
-                    conn.commit()
-                    conn.close()
-                    log_action(
-                        st.session_state['user_id'],
-                        st.session_state['role'],
-                        "AddUser",
-                        f"Added user {new_username} with role {new_role}"
-                    )
-                    msg = st.empty()
-                    msg.success(f"User '{new_username}' added successfully!")
-                    time.sleep(2)
-                    msg.empty() 
-                    st.rerun()  
-
-                except Exception as e:
-                    st.error(f"Error: {e}")
-
-    # -----------------------TAB 3------------------EDIT USER
-    with tab3:
-        st.write("### Edit User")
+    if submitted:
+        if not new_username or not new_password:
+            st.error("Username and Password are mandatory.")
+            return
         try:
             conn = create_connection()
-            cur = conn.cursor()
-            df = pd.read_sql("SELECT * FROM users", conn)
-            user_list = df["username"].tolist()
-            if user_list:
-                user_to_edit = st.selectbox("Select User", user_list)
-                new_role_edit = st.selectbox("New Role", ["doctor", "admin", "receptionist"])
-                if st.button("Update User"):
-                    cur.execute(
-                        "UPDATE users SET role=? WHERE username=?",
-                        (new_role_edit, user_to_edit)
-                    )
-                    conn.commit()
-                    msg = st.empty()
-                    msg.success(f"User '{user_to_edit}' updated successfully!")
-                    time.sleep(2)
-                    msg.empty()
-                    st.rerun()
-            else:
-                st.info("No users available to edit.")
+            conn.execute(
+                "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+                (new_username, encrypt_field(new_password), new_role)
+            )
+            conn.commit()
             conn.close()
+            log_action(
+                st.session_state['user_id'],
+                st.session_state['role'],
+                "AddUser",
+                f"Added user {new_username} with role {new_role}"
+            )
+            st.toast(f"User '{new_username}' added successfully!", icon="✅")
         except Exception as e:
             st.error(f"Error: {e}")
 
-#-------------------------TAB 2---------------DELETION-----------
-    with tab4:
-        st.subheader("🗑 Delete User")
+# -----------------------SECTION 3------------------EDIT USER
+@timed_fragment("users:edit")
+def users_edit_section():
+    st.write("### Edit User")
+    try:
+        conn = create_connection()
+        user_list = [row[0] for row in conn.execute("SELECT username FROM users ORDER BY username").fetchall()]
+        conn.close()
+    except Exception as e:
+        st.error(f"Error: {e}")
+        return
+    if not user_list:
+        st.info("No users available to edit.")
+        return
+
+    with st.form("edit_user_form"):
+        user_to_edit = st.selectbox("Select User", user_list)
+        new_role_edit = st.selectbox("New Role", USER_ROLES)
+        submitted = st.form_submit_button("Update User")
 
+    if submitted:
         try:
             conn = create_connection()
-            cur = conn.cursor()
-            role = st.selectbox("Select Role", ["admin", "doctor", "receptionist"])
-            cur.execute("SELECT username FROM users WHERE role=?", (role,))
-            users = [row[0] for row in cur.fetchall()]
-
-            if users:
-                username_to_delete = st.selectbox("Select Username to Delete", users)
-
-                if "delete_verified" not in st.session_state:
-                    st.session_state["delete_verified"] = False
-
-                admin_pass = st.text_input("Enter Your Admin Password", type="password")
-
-                if st.button("Verify Password"):
-                    cur.execute("SELECT password FROM users WHERE user_id=?", (st.session_state['user_id'],))
-                    row = cur.fetchone()
-                    if row and row[0] == admin_pass:  
-                        st.session_state["delete_verified"] = True
-                        st.success("✅ Password verified. You can now confirm deletion.")
-                    else:
-                        st.session_state["delete_verified"] = False
-                        st.error("❌ Invalid password.")
-                if st.session_state["delete_verified"] and st.button("Delete User"):
-                    cur.execute(
-                        "DELETE FROM users WHERE username=? AND role=?",
-                        (username_to_delete, role)
-                    )
-                    conn.commit()
-
-                    log_action(
-                        st.session_state['user_id'],
-                        st.session_state['role'],
-                        "DeleteUser",
-                        f"Deleted user '{username_to_delete}' with role '{role}'"
-                    )
-
-                    msg = st.empty()
-                    msg.success(f"User '{username_to_delete}' deleted successfully!")
-                    time.sleep(2)
-                    msg.empty()
-
-                    st.session_state["delete_verified"] = False
-
-                    st.rerun()
+            conn.execute("UPDATE users SET role=? WHERE username=?", (new_role_edit, user_to_edit))
+            conn.commit()
+            conn.close()
+            st.toast(f"User '{user_to_edit}' updated successfully!", icon="✅")
+        except Exception as e:
+            st.error(f"Error: {e}")
+
+#-------------------------SECTION 4---------------DELETION-----------
+@timed_fragment("users:delete")
+def users_delete_section():
+    st.subheader("🗑 Delete User")
 
+    role = st.selectbox("Select Role", ["admin", "doctor", "receptionist"])
+    try:
+        conn = create_connection()
+        users = [row[0] for row in conn.execute("SELECT username FROM users WHERE role=?", (role,)).fetchall()]
+        conn.close()
+    except Exception as e:
+        st.error(f"Error: {e}")
+        return
+    if not users:
+        st.info(f"No users found with role '{role}'")
+        return
+
+    username_to_delete = st.selectbox("Select Username to Delete", users)
+
+    if "delete_verified" not in st.session_state:
+        st.session_state["delete_verified"] = False
+
+    with st.form("verify_delete_user_form", clear_on_submit=True):
+        admin_pass = st.text_input("Enter Your Admin Password", type="password")
+        if st.form_submit_button("Verify Password"):
+            if check_user_password(st.session_state['user_id'], admin_pass):
+                st.session_state["delete_verified"] = True
+                st.success("✅ Password verified. You can now confirm deletion.")
             else:
-                st.info(f"No users found with role '{role}'")
+                st.session_state["delete_verified"] = False
+                st.error("❌ Invalid password.")
 
+    if st.session_state["delete_verified"] and st.button("Delete User"):
+        try:
+            conn = create_connection()
+            conn.execute("DELETE FROM users WHERE username=? AND role=?", (username_to_delete, role))
+            conn.commit()
             conn.close()
         except Exception as e:
             st.error(f"Error: {e}")
+            return
+
+        log_action(
+            st.session_state['user_id'],
+            st.session_state['role'],
+            "DeleteUser",
+            f"Deleted user '{username_to_delete}' with role '{role}'"
+        )
+        st.session_state["delete_verified"] = False
+        st.toast(f"User '{username_to_delete}' deleted successfully!", icon="🗑")
+        # Refresh the user list of this section only
+        st.rerun(scope="fragment")
 
 
 def admin_manage_data():
     st.header("🛠 Manage Patient Data")
 
-    tab1, tab2, tab3 = st.tabs(["➕ Add Patient", "✏️ Update Patient", "🗑 Delete Patient"])
-
-    # ----------------TAB1 --------------ADD PATIENT
-    with tab1:
-        st.subheader("➕ Add New Patient")
-
-        with st.form("add_patient_form"):
-            name = st.text_input("Full Name")
-            contact = st.text_input("Contact Number")
-            diagnosis = st.text_input("Diagnosis")
-            submitted = st.form_submit_button("Add Patient")
-
-            if submitted:
-                if name and contact:
-                    conn = sqlite3.connect(DB_PATH)
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "INSERT INTO patients (name, contact, diagnosis, date_added) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
-                        (name, contact, diagnosis)
-                    )
-                    conn.commit()
-                    pid = cursor.lastrowid  # <-- this is the new patient_id
-                    conn.close()
-                    st.success(f"Patient added successfully! Assigned Patient ID: {pid}")
-
-                    log_action(
-                        st.session_state['user_id'],
-                        st.session_state['role'],
-                        "AddPatient",
-                        f"Added patient_id {pid}"
-                    )
-                else:
-                    st.error("Name and Contact are mandatory.")
-# -----------------TAB2---UPDATE PATIENT BY ADMIN DASHBOARD ----------------------# 
-    with tab2:
-        st.subheader("✏️ Update Existing Patient")
-
-        edit_id = st.number_input("Enter Patient ID", min_value=1, step=1, key="edit_id_btn")
-
-        if st.button("Search Patient", key="search_update"):
-            df = get_patient_by_id(edit_id)
-            if not df:
-                st.error("❌ Patient ID not found.")
-                st.session_state["edit_found"] = False
-            else:
-                st.session_state["edit_found"] = True
-                st.session_state["edit_patient"] = df  
-                st.session_state["password_verified_update"] = False 
-
-        if st.session_state.get("edit_found"):
-            patient = st.session_state["edit_patient"]
-
-            st.markdown("### Patient Found (Anonymized View):")
-            st.info(f"**Name:** {patient.get('anonymized_name', 'N/A')}  \n"
-                    f"**Contact:** {patient.get('anonymized_contact', 'N/A')}  \n"
-                    f"**Diagnosis:** {patient.get('diagnosis', 'N/A')}  \n"
-                    f"**Date Added:** {patient.get('date_added', 'N/A')}")
-
-            if not st.session_state.get("password_verified_update"):
-                st.warning("⚠ To view original data, please verify your admin password.")
-                admin_pass = st.text_input("Enter Admin Password", type="password", key="update_admin_pass")
-                if st.button("Verify Password", key="verify_update_pass"):
-                    conn = sqlite3.connect(DB_PATH)
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT password FROM users WHERE user_id=?", (st.session_state['user_id'],))
-                    row = cursor.fetchone()
-                    conn.close()
-                    if row and verify_password(admin_pass, row[0]):
-                        st.session_state["password_verified_update"] = True
-                        st.success("✅ Password verified. Original data is now visible.")
-                    else:
-                        st.error("❌ Invalid password. Cannot show original data.")
-
-            if st.session_state.get("password_verified_update"):
-                st.subheader("Original Data (Decrypted)")
-                st.write(f"- **Name:** {decrypt_field(patient['name'])}")
-                st.write(f"- **Contact:** {decrypt_field(patient['contact'])}")
-                st.write(f"- **Diagnosis:** {patient.get('diagnosis', 'N/A')}")
-                st.write(f"- **Date Added:** {patient.get('date_added', 'N/A')}")
-
-            st.subheader("Update Fields (leave blank to keep unchanged)")
-            new_name = st.text_input("New Name (optional)")
-            new_contact = st.text_input("New Contact (optional)")
-            new_diag = st.text_input("New Diagnosis (optional)")
-
-            if st.button("Update Now", key="update_now"):
-                name_val = new_name if new_name.strip() else None
-                contact_val = new_contact if new_contact.strip() else None
-                diag_val = new_diag if new_diag.strip() else None
-
-                success = update_patient_admin(
-                    edit_id,
-                    name=name_val,
-                    contact=contact_val,
-                    diagnosis=diag_val,
+    # Only the selected section runs; each is a fragment, so its widgets rerun just that section
+    section = st.radio("Section", ["➕ Add Patient", "✏️ Update Patient", "🗑 Delete Patient", "📦 Bulk Actions"],
+                       horizontal=True, label_visibility="collapsed", key="manage_patients_section")
+    if section == "➕ Add Patient":
+        manage_add_patient_section()
+    elif section == "✏️ Update Patient":
+        manage_update_patient_section()
+    elif section == "🗑 Delete Patient":
+        manage_delete_patient_section()
+    else:
+        admin_bulk_actions()
+
+# ----------------SECTION 1 --------------ADD PATIENT
+@timed_fragment("patients:add")
+def manage_add_patient_section():
+    st.subheader("➕ Add New Patient")
+
+    with st.form("add_patient_form"):
+        name = st.text_input("Full Name")
+        contact = st.text_input("Contact Number")
+        diagnosis = st.text_input("Diagnosis")
+        submitted = st.form_submit_button("Add Patient")
+
+        if submitted:
+            if name and contact:
+                pid = add_patient_admin(name, contact, diagnosis, recorded_by=st.session_state['user_id'])
+                st.success(f"Patient added successfully! Assigned Patient ID: {pid}")
+
+                log_action(
+                    st.session_state['user_id'],
+                    st.session_state['role'],
+                    "AddPatient",
+                    f"Added patient_id {pid}"
                 )
+            else:
+                st.error("Name and Contact are mandatory.")
 
-                if success:
-                    st.success("✔ Patient record updated successfully.")
-                    log_action(
-                        st.session_state['user_id'],
-                        st.session_state['role'],
-                        "UpdatePatient",
-                        f"Updated patient_id {edit_id}"
-                    )
-
-                    for key in ["edit_found", "edit_patient", "password_verified_update"]:
-                        if key in st.session_state:
-                            del st.session_state[key]
+# -----------------SECTION 2---UPDATE PATIENT BY ADMIN DASHBOARD ----------------------#
+@timed_fragment("patients:update")
+def manage_update_patient_section():
+    st.subheader("✏️ Update Existing Patient")
+
+    edit_id = st.number_input("Enter Patient ID", min_value=1, step=1, key="edit_id_btn")
+
+    if st.button("Search Patient", key="search_update"):
+        df = get_patient_by_id(edit_id)
+        if not df:
+            st.error("❌ Patient ID not found.")
+            st.session_state["edit_found"] = False
+        else:
+            st.session_state["edit_found"] = True
+            st.session_state["edit_patient"] = df  
+            st.session_state["password_verified_update"] = False 
+
+    if st.session_state.get("edit_found"):
+        patient = st.session_state["edit_patient"]
+
+        st.markdown("### Patient Found (Anonymized View):")
+        st.info(f"**Name:** {patient.get('anonymized_name', 'N/A')}  \n"
+                f"**Contact:** {patient.get('anonymized_contact', 'N/A')}  \n"
+                f"**Diagnosis:** {patient.get('diagnosis', 'N/A')}  \n"
+                f"**Date Added:** {patient.get('date_added', 'N/A')}")
+        show_encounter_history(patient['patient_id'])
+
+        if not st.session_state.get("password_verified_update"):
+            st.warning("⚠ To view original data, please verify your admin password.")
+            admin_pass = st.text_input("Enter Admin Password", type="password", key="update_admin_pass")
+            if st.button("Verify Password", key="verify_update_pass"):
+                conn = get_connection()
+                cursor = conn.cursor()
+                cursor.execute("SELECT password FROM users WHERE user_id=?", (st.session_state['user_id'],))
+                row = cursor.fetchone()
+                conn.close()
+                if row and verify_password(admin_pass, row[0]):
+                    st.session_state["password_verified_update"] = True
+                    st.success("✅ Password verified. Original data is now visible.")
                 else:
-                    st.error("Update failed. Check ID or database.")
+                    st.error("❌ Invalid password. Cannot show original data.")
+
+        if st.session_state.get("password_verified_update"):
+            st.subheader("Original Data (Decrypted)")
+            st.write(f"- **Name:** {decrypt_field(patient['name'])}")
+            st.write(f"- **Contact:** {decrypt_field(patient['contact'])}")
+            st.write(f"- **Diagnosis:** {patient.get('diagnosis', 'N/A')}")
+            st.write(f"- **Date Added:** {patient.get('date_added', 'N/A')}")
 
+        st.subheader("Update Fields (leave blank to keep unchanged)")
+        new_name = st.text_input("New Name (optional)")
+        new_contact = st.text_input("New Contact (optional)")
+        new_diag = st.text_input("New Diagnosis (optional)")
+
+        if st.button("Update Now", key="update_now"):
+            name_val = new_name if new_name.strip() else None
+            contact_val = new_contact if new_contact.strip() else None
+            diag_val = new_diag if new_diag.strip() else None
 
-# ========TAB3  ========= DELETE PATIENT =================
-    with tab3:
-        st.subheader("🗑 Delete Patient")
+            result = update_patient(
+                edit_id,
+                name=name_val,
+                contact=contact_val,
+                diagnosis=diag_val,
+                expected_version=patient.get('row_version'),
+                recorded_by=st.session_state['user_id'],
+            )
 
-        del_id = st.number_input("Enter Patient ID to Delete", min_value=1, step=1, key="del_id_input")
+            if result["status"] == UPDATE_OK:
+                st.success("✔ Patient record updated successfully.")
+                log_action(
+                    st.session_state['user_id'],
+                    st.session_state['role'],
+                    "UpdatePatient",
+                    f"Updated patient_id {edit_id}"
+                )
 
-        if st.button("Search Patient", key="search_delete"):
-            df = get_patient_by_id(del_id)
-            if not df:
-                st.error("❌ Patient ID not found.")
-                st.session_state["delete_found"] = False
+                for key in ["edit_found", "edit_patient", "password_verified_update"]:
+                    if key in st.session_state:
+                        del st.session_state[key]
+            elif result["status"] == UPDATE_CONFLICT:
+                st.warning("⚠ This patient was changed by another user after you loaded it. "
+                           "Search again to review the latest data, then re-apply your edit.")
             else:
-                st.session_state["delete_found"] = True
-                st.session_state["delete_patient"] = df
-                st.session_state["password_verified"] = False 
-                st.session_state["delete_confirmed"] = False
-
-        if st.session_state.get("delete_found"):
-            patient = st.session_state["delete_patient"]
-            st.info("🔒 Patient Found (Anonymized View)")
-            st.write(f"- **Anonymized Name:** {patient.get('anonymized_name', 'N/A')}")
-            st.write(f"- **Anonymized Contact:** {patient.get('anonymized_contact', 'N/A')}")
+                st.error("Update failed. Check ID or database.")
+
+# ========SECTION 3  ========= DELETE PATIENT =================
+@timed_fragment("patients:delete")
+def manage_delete_patient_section():
+    st.subheader("🗑 Delete Patient")
+
+    del_id = st.number_input("Enter Patient ID to Delete", min_value=1, step=1, key="del_id_input")
+
+    if st.button("Search Patient", key="search_delete"):
+        df = get_patient_by_id(del_id)
+        if not df:
+            st.error("❌ Patient ID not found.")
+            st.session_state["delete_found"] = False
+        else:
+            st.session_state["delete_found"] = True
+            st.session_state["delete_patient"] = df
+            st.session_state["password_verified"] = False 
+            st.session_state["delete_confirmed"] = False
+
+    if st.session_state.get("delete_found"):
+        patient = st.session_state["delete_patient"]
+        st.info("🔒 Patient Found (Anonymized View)")
+        st.write(f"- **Anonymized Name:** {patient.get('anonymized_name', 'N/A')}")
+        st.write(f"- **Anonymized Contact:** {patient.get('anonymized_contact', 'N/A')}")
+        st.write(f"- **Diagnosis:** {patient.get('diagnosis', 'N/A')}")
+        st.write(f"- **Date Added:** {patient.get('date_added', 'N/A')}")
+
+        if not st.session_state.get("password_verified"):
+            st.warning("⚠ To delete this patient, please verify your admin password.")
+            admin_pass = st.text_input("Enter Admin Password", type="password", key="del_admin_pass")
+            if st.button("Verify Password", key="verify_del_pass"):
+                conn = get_connection()
+                cursor = conn.cursor()
+                cursor.execute("SELECT password FROM users WHERE user_id=?", (st.session_state['user_id'],))
+                row = cursor.fetchone()
+                conn.close()
+                if row and verify_password(admin_pass, row[0]):
+                    st.session_state["password_verified"] = True
+                    st.success("✅ Password verified. You can now confirm deletion.")
+                else:
+                    st.error("❌ Invalid password. Cannot proceed with deletion.")
+
+        if st.session_state.get("password_verified") and not st.session_state.get("delete_confirmed"):
+            st.info("💡 Original Data")
+            st.write(f"- **Name:** {decrypt_field(patient['name'])}")
+            st.write(f"- **Contact:** {decrypt_field(patient['contact'])}")
             st.write(f"- **Diagnosis:** {patient.get('diagnosis', 'N/A')}")
             st.write(f"- **Date Added:** {patient.get('date_added', 'N/A')}")
 
-            if not st.session_state.get("password_verified"):
-                st.warning("⚠ To delete this patient, please verify your admin password.")
-                admin_pass = st.text_input("Enter Admin Password", type="password", key="del_admin_pass")
-                if st.button("Verify Password", key="verify_del_pass"):
-                    conn = sqlite3.connect(DB_PATH)
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT password FROM users WHERE user_id=?", (st.session_state['user_id'],))
-                    row = cursor.fetchone()
-                    conn.close()
-                    if row and verify_password(admin_pass, row[0]):
-                        st.session_state["password_verified"] = True
-                        st.success("✅ Password verified. You can now confirm deletion.")
-                    else:
-                        st.error("❌ Invalid password. Cannot proceed with deletion.")
-
-            if st.session_state.get("password_verified") and not st.session_state.get("delete_confirmed"):
-                st.info("💡 Original Data")
-                st.write(f"- **Name:** {decrypt_field(patient['name'])}")
-                st.write(f"- **Contact:** {decrypt_field(patient['contact'])}")
-                st.write(f"- **Diagnosis:** {patient.get('diagnosis', 'N/A')}")
-                st.write(f"- **Date Added:** {patient.get('date_added', 'N/A')}")
-
-                if st.button("Confirm Delete Patient", key="confirm_final_delete"):
-                    delete_patient_admin(del_id)
-                    log_action(
-                        st.session_state['user_id'],
-                        st.session_state['role'],
-                        "DeletePatient",
-                        f"Deleted patient_id {del_id}"
-                    )
-                    st.session_state["delete_confirmed"] = True
-                    st.success(f"✔ Patient ID {del_id} deleted permanently.")
-
-                    for key in ["delete_found", "delete_patient", "password_verified", "delete_confirmed"]:
-                        if key in st.session_state:
-                            del st.session_state[key]
-
-            if st.session_state.get("delete_confirmed"):
+            if st.button("Confirm Delete Patient", key="confirm_final_delete"):
+                delete_patient_admin(del_id)
+                log_action(
+                    st.session_state['user_id'],
+                    st.session_state['role'],
+                    "DeletePatient",
+                    f"Deleted patient_id {del_id}"
+                )
+                st.session_state["delete_confirmed"] = True
                 st.success(f"✔ Patient ID {del_id} deleted permanently.")
+
                 for key in ["delete_found", "delete_patient", "password_verified", "delete_confirmed"]:
                     if key in st.session_state:
                         del st.session_state[key]
 
+        if st.session_state.get("delete_confirmed"):
+            st.success(f"✔ Patient ID {del_id} deleted permanently.")
+            for key in ["delete_found", "delete_patient", "password_verified", "delete_confirmed"]:
+                if key in st.session_state:
+                    del st.session_state[key]
+
+
+@timed_fragment("patients:bulk")
+def admin_bulk_actions():
+    st.subheader("📦 Bulk Patient Actions")
+
+    mode = st.radio("Select patients by", ["Pick from table", "ID range", "Filter"], horizontal=True, key="bulk_mode")
+
+    if mode == "Pick from table":
+        df = get_patients_for_doctor()
+        if df.empty:
+            st.info("No patient data available.")
+            return
+        df.insert(0, "select", False)
+        edited = st.data_editor(
+            df,
+            hide_index=True,
+            use_container_width=True,
+            disabled=[c for c in df.columns if c != "select"],
+            key="bulk_table"
+        )
+        selected_ids = select_patient_ids(patient_ids=edited.loc[edited["select"], "patient_id"].tolist())
+    elif mode == "ID range":
+        col1, col2 = st.columns(2)
+        first_id = col1.number_input("From patient ID", min_value=1, step=1, key="bulk_from_id")
+        last_id = col2.number_input("To patient ID", min_value=1, step=1, value=first_id, key="bulk_to_id")
+        selected_ids = select_patient_ids(id_range=(first_id, last_id))
+    else:
+        col1, col2, col3 = st.columns(3)
+        date_from = col1.date_input("Added on or after", value=None, key="bulk_date_from")
+        date_to = col2.date_input("Added on or before", value=None, key="bulk_date_to")
+        diagnosis_filter = col3.text_input("Diagnosis is", key="bulk_diag_filter")
+        if date_from is None and date_to is None and not diagnosis_filter.strip():
+            st.info("Set at least one filter.")
+            return
+        selected_ids = select_patient_ids(date_from=date_from, date_to=date_to,
+                                          diagnosis=diagnosis_filter.strip() or None)
+
+    st.write(f"**{len(selected_ids)} patient(s) selected.**")
+    if not selected_ids:
+        return
+
+    action = st.selectbox("Action", ["Delete", "Set diagnosis", "Re-anonymize"], key="bulk_action")
+    new_diag = ""
+    if action == "Set diagnosis":
+        new_diag = st.text_input("New Diagnosis", key="bulk_new_diag")
+
+    if not st.session_state.get("bulk_verified"):
+        admin_pass = st.text_input("Enter Admin Password", type="password", key="bulk_admin_pass")
+        if st.button("Verify Password", key="verify_bulk_pass"):
+            if check_user_password(st.session_state['user_id'], admin_pass):
+                st.session_state["bulk_verified"] = True
+                st.rerun(scope="fragment")
+            else:
+                st.error("❌ Invalid password.")
+        return
+
+    if st.button(f"Apply '{action}' to {len(selected_ids)} patient(s)", type="primary", key="bulk_apply"):
+        user_id, role = st.session_state['user_id'], st.session_state['role']
+        if action == "Delete":
+            count = bulk_delete_patients(selected_ids, user_id, role)
+        elif action == "Set diagnosis":
+            if not new_diag.strip():
+                st.error("Diagnosis is mandatory.")
+                return
+            count = bulk_update_diagnosis(selected_ids, new_diag.strip(), user_id, role)
+        else:
+            count = bulk_reanonymize_patients(selected_ids, user_id, role)
+        st.session_state["bulk_verified"] = False
+        st.success(f"✔ {action} applied to {count} patient(s).")
+
+
+# Relative time ranges move in steps of this many seconds, so reruns reuse cached results
+RANGE_ROUNDING = 60
 
 def admin_logs_page():
     st.header("📊 Audit & System Analytics Dashboard")
-    
-    logs_df = get_logs_df()
-    patients_df = get_all_patients_raw()
+
+    ranges = {"Last 24 hours": {"last_hours": 24}, "Last 7 days": {"last_days": 7},
+              "Last 30 days": {"last_days": 30}, "Last 365 days": {"last_days": 365}, "All time": {}}
+    period = st.selectbox("Time range", list(ranges), index=2)
+    lo, hi = time_range(**ranges[period], round_to=RANGE_ROUNDING)
+
+    logs_df = get_logs_df(lo, hi)
 
     if logs_df.empty:
-        st.info("No logs found yet.")
+        st.info("No logs found in this time range.")
         return
 
-    logs_df['timestamp'] = pd.to_datetime(logs_df['timestamp'], errors='coerce')
+    logs_df['timestamp'] = pd.to_datetime(logs_df.pop('timestamp_epoch'), unit='s')
 
     st.markdown("""
         <style>
@@ -541,7 +673,7 @@ def admin_logs_page():
     with col1:
         st.markdown(f"""
             <div class="kpi-card">
-                <h3>Total Audit Logs</h3>
+                <h3>Audit Logs ({period})</h3>
                 <h1>{len(logs_df)}</h1>
             </div>
         """, unsafe_allow_html=True)
@@ -550,12 +682,12 @@ def admin_logs_page():
         st.markdown(f"""
             <div class="kpi-card kpi-card-green">
                 <h3>Total Patients</h3>
-                <h1>{len(patients_df)}</h1>
+                <h1>{count_patients()}</h1>
             </div>
         """, unsafe_allow_html=True)
 
     with col3:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cur = conn.cursor()
         cur.execute("SELECT COUNT(*) FROM users WHERE role='doctor'")
         doctor_count = cur.fetchone()[0]
@@ -575,35 +707,26 @@ def admin_logs_page():
 
     st.markdown("---")
 
-    st.subheader("📅 Patients Added Per Day")
+    st.subheader("📈 Audit Activity Over Time")
 
-    if not patients_df.empty:
-        patients_df["date_added"] = pd.to_datetime(patients_df["date_added"], errors="coerce")
+    fig_activity = px.line(
+        log_activity_series(lo, hi),
+        x="timestamp",
+        y="entries",
+        title="Audit Entries",
+        color_discrete_sequence=["#1E88E5"]
+    )
+    st.plotly_chart(fig_activity, use_container_width=True)
 
-        patients_per_day = (
-            patients_df.groupby(patients_df["date_added"].dt.date)
-            .size()
-            .reset_index(name="patients")
-        )
+    st.markdown("---")
 
-        fig_patients = px.line(
-            patients_per_day,
-            x="date_added",
-            y="patients",
-            markers=True,
-            title="Patients Added Per Day",
-            color_discrete_sequence=["#43A047"]
-        )
-        st.plotly_chart(fig_patients, use_container_width=True)
-    else:
-        st.info("No patient records found.")
+    patients_added_chart(lo, hi)
 
     st.markdown("---")
 
     st.subheader("🛡 Most Frequent Actions in System")
 
-    action_counts = logs_df["action"].value_counts().reset_index()
-    action_counts.columns = ["action", "count"]
+    action_counts = log_counts_by("action", lo, hi)
 
     fig_actions = px.bar(
         action_counts,
@@ -619,8 +742,7 @@ def admin_logs_page():
 
     st.subheader("👤 Activity Distribution by User Role")
 
-    role_counts = logs_df["role"].value_counts().reset_index()
-    role_counts.columns = ["role", "count"]
+    role_counts = log_counts_by("role", lo, hi)
 
     fig_roles = px.pie(
         role_counts,
@@ -633,6 +755,49 @@ def admin_logs_page():
 
     st.markdown("---")
     
+@timed_fragment("logs:patients_chart")
+def patients_added_chart(lo, hi):
+    """Changing the granularity redraws only this chart, not the log table and KPIs."""
+    st.subheader("📅 Patients Added Over Time")
+    granularity = st.selectbox("Chart granularity", ["auto", *GRANULARITIES])
+
+    patients_series = patients_added_series(lo, hi, granularity)
+    if not patients_series.empty:
+        fig_patients = px.line(
+            patients_series,
+            x="date_added",
+            y="patients",
+            markers=True,
+            title="Patients Added",
+            color_discrete_sequence=["#43A047"]
+        )
+        st.plotly_chart(fig_patients, use_container_width=True)
+    else:
+        st.info("No patient records found.")
+
+@timed_fragment("settings:slow_queries")
+def slow_queries_section():
+    """Slow statements logged by sqltrace, with their plans, and this process's sampled totals."""
+    st.subheader("Slow Queries")
+    st.caption(f"{sqltrace.TRACE_SAMPLE:.0%} of statements are timed; those over {sqltrace.SLOW_QUERY_MS:g} ms "
+               "are logged with their query plan (HMS_SQL_TRACE_SAMPLE, HMS_SLOW_QUERY_MS).")
+    days = st.selectbox("Logged in the last", [1, 7, 30], format_func=lambda d: f"{d} day(s)", key="slow_query_days")
+    lo, hi = time_range(last_days=days)
+    slow = get_slow_queries_df(lo, hi)
+    if slow.empty:
+        st.info("No slow queries logged in this period.")
+    else:
+        st.dataframe(slow[["ts", "duration_ms", "rows", "source", "database", "statement"]], use_container_width=True)
+        query_id = st.selectbox("Show plan for", slow["query_id"], key="slow_query_plan",
+                                format_func=lambda q: f"#{q}: {slow.loc[slow['query_id'] == q, 'statement'].iloc[0][:80]}")
+        entry = slow.loc[slow["query_id"] == query_id].iloc[0]
+        st.code(entry["statement"], language="sql")
+        st.code(entry["plan"] or "(no plan captured)", language="text")
+    stats = sqltrace.statement_stats()
+    if stats:
+        st.write("Sampled statements in this server process, by total time:")
+        st.dataframe(pd.DataFrame(stats)[["statement", "count", "total_ms", "avg_ms", "max_ms", "rows"]], use_container_width=True)
+
 def admin_settings_page():
     st.header("Admin Settings")
     st.subheader("Data Retention Timer")
@@ -640,24 +805,134 @@ def admin_settings_page():
         st.session_state['retention_days'] = 365  
     rd = st.number_input("Retention period (days)", min_value=0, max_value=3650, value=st.session_state['retention_days'], step=1)
     if st.button("Apply Retention Now"):
-        deleted = apply_data_retention(rd)
-        st.success(f"Retention applied. Deleted {deleted} records older than {rd} days.")
-        log_action(st.session_state['user_id'], st.session_state['role'], "ApplyRetention", f"{deleted} records removed, retention {rd}d")
+        job_id = submit_job("retention", {"retention_days": rd}, st.session_state['user_id'], st.session_state['role'])
+        st.success(f"Retention job #{job_id} queued ({rd} days).")
     if st.button("Save Retention Setting"):
         st.session_state['retention_days'] = rd
         st.success(f"Retention setting saved to {rd} days.")
+    recurring_job_toggle("retention", "Apply retention nightly", {"retention_days": rd})
     st.markdown("---")
     st.subheader("System & Privacy")
     st.write("System last started at:", st.session_state.get('last_uptime'))
     st.checkbox("Show user consent banner at login (for demo)", value=not st.session_state.get('consent_given', False))
     if st.button("Export logs CSV"):
-        fname = "logs_export.csv"
-        logs_df = get_logs_df()
-        logs_df.to_csv(fname, index=False)
-        st.success(f"Logs exported to {fname}")
-        log_action(st.session_state['user_id'], st.session_state['role'], "ExportLogs", f"Exported logs to {fname}")
+        job_id = submit_job("export_logs", {"filepath": "logs_export.csv"}, st.session_state['user_id'], st.session_state['role'])
+        st.success(f"Log export job #{job_id} queued.")
+    if st.button("Export new logs (incremental)"):
+        job_id = submit_job("export_logs_incremental", {}, st.session_state['user_id'], st.session_state['role'])
+        st.success(f"Incremental export job #{job_id} queued; files go to {EXPORT_DIR}.")
+    if st.button("Export patients CSV"):
+        job_id = submit_job("export_patients", {"filepath": "patients_backup.csv"}, st.session_state['user_id'], st.session_state['role'])
+        st.success(f"Patient export job #{job_id} queued.")
+    if st.button("Export analytics snapshot (Parquet / Arrow)"):
+        job_id = submit_job("export_snapshot", {}, st.session_state['user_id'], st.session_state['role'])
+        st.success(f"Snapshot job #{job_id} queued; its result shows the snapshot directory.")
+    st.markdown("---")
+    st.subheader("Storage")
+    st.write("Storage profile:", active_profile_name(db.DB_PATH), get_profile(db.DB_PATH))
+    if st.button("Run maintenance now"):
+        job_id = submit_job("maintenance", {}, st.session_state['user_id'], st.session_state['role'])
+        st.success(f"Maintenance job #{job_id} queued.")
+    recurring_job_toggle("maintenance", "Run maintenance nightly (change-feed compaction, optimize, incremental vacuum)", {})
+    st.markdown("---")
+    slow_queries_section()
+    st.markdown("---")
+    st.subheader("Backups")
+    if st.button("Back up now"):
+        job_id = submit_job("backup", {}, st.session_state['user_id'], st.session_state['role'])
+        st.success(f"Backup job #{job_id} queued.")
+    recurring_job_toggle("backup", "Take a verified backup nightly", {})
+    manifest = load_backup_manifest()
+    if manifest["bases"]:
+        st.dataframe(pd.DataFrame(manifest["bases"][-10:])[["file", "bytes", "integrity", "timeline"]], use_container_width=True)
+    st.caption(f"{len(manifest['segments'])} WAL segment(s) archived. Restore with: python backup.py restore \"YYYY-MM-DD HH:MM:SS\" --output restored.db")
+    st.markdown("---")
+    st.subheader("Diagnosis Dictionary")
+    st.caption("Free-text diagnoses are coded on write; fold a spelling into an existing diagnosis to merge their statistics.")
+    with st.form("diagnosis_synonym_form"):
+        spelling = st.text_input("Spelling (e.g. 'influenza a')")
+        target = st.text_input("Same as diagnosis (e.g. 'Influenza')")
+        if st.form_submit_button("Add synonym"):
+            try:
+                recoded = add_synonym(spelling, target)
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                log_action(st.session_state['user_id'], st.session_state['role'], "AddDiagnosisSynonym",
+                           f"'{spelling.strip()}' = '{target.strip()}', {recoded} patients re-coded")
+                st.success(f"Added; {recoded} patient(s) re-coded.")
+    if st.button("Code existing diagnoses"):
+        job_id = submit_job("diagnosis_codes", {}, st.session_state['user_id'], st.session_state['role'])
+        st.success(f"Diagnosis coding job #{job_id} queued.")
+    show_jobs_panel(["retention", "export_logs", "export_logs_incremental", "export_patients", "export_snapshot",
+                     "maintenance", "cdc_compact", "backup", "diagnosis_codes"])
+
+# ---------------------- Background Jobs ----------------------
+def recurring_job_toggle(kind, label, params):
+    """Checkbox that adds or removes a nightly schedule for a job kind."""
+    schedules = list_schedules(kind)
+    enabled = st.checkbox(label, value=bool(schedules), key=f"recurring_{kind}")
+    if enabled and not schedules:
+        schedule_job(kind, params, every_seconds=86400, user_id=st.session_state['user_id'], role=st.session_state['role'])
+        st.success(f"Scheduled {kind} every 24h.")
+    elif not enabled and schedules:
+        for schedule in schedules:
+            unschedule_job(schedule["schedule_id"])
+        st.info(f"Stopped recurring {kind}.")
+
+
+JOB_POLL_SECONDS = 2
+
+def show_jobs_panel(kinds):
+    """Recent jobs of the given kinds; polls for progress while any of them is queued or running."""
+    if any(job['status'] in ("queued", "running") for job in list_jobs(limit=10, kinds=kinds)):
+        live_jobs_panel(kinds)
+    else:
+        jobs_panel(kinds)
+
+@timed_fragment("jobs")
+def jobs_panel(kinds):
+    render_jobs(kinds)
+
+@timed_fragment("jobs:live", run_every=JOB_POLL_SECONDS)
+def live_jobs_panel(kinds):
+    if not render_jobs(kinds):
+        # All done: a full rerun swaps in the panel that does not poll
+        st.rerun()
+
+def render_jobs(kinds):
+    """Recent jobs with progress and a cancel button while they are active; returns whether any is."""
+    st.subheader("Background Jobs")
+    jobs = list_jobs(limit=10, kinds=kinds)
+    if not jobs:
+        st.caption("No jobs yet.")
+        return False
+    active = False
+    for job in jobs:
+        cols = st.columns([3, 4, 1])
+        cols[0].write(f"#{job['job_id']} {job['kind']} — {job['status']}")
+        if job['status'] in ("queued", "running"):
+            active = True
+            cols[1].progress(job['progress'] or 0.0, text=job['message'] or "")
+            if cols[2].button("Cancel", key=f"cancel_job_{job['job_id']}"):
+                cancel_job(job['job_id'])
+                st.rerun(scope="fragment")
+        elif job['status'] == "succeeded":
+            cols[1].write(job['result'])
+        else:
+            cols[1].write((job['message'] or "").splitlines()[0] if job['message'] else "")
+    return active
 
 # ---------------------- Doctor & Receptionist ----------------------
+def show_encounter_history(patient_id, limit=10):
+    """A patient's latest encounters (an index range scan, see get_encounters)."""
+    history = get_encounters(patient_id, limit=limit)
+    st.markdown(f"#### 🩺 Recent History (last {limit} encounters)")
+    if history.empty:
+        st.caption("No encounters recorded for this patient yet.")
+        return
+    st.dataframe(history.drop(columns="encounter_id"), hide_index=True)
+
 def doctor_dashboard_page():
     st.header("Doctor Dashboard")
     df = get_patients_for_doctor()
@@ -665,6 +940,35 @@ def doctor_dashboard_page():
         st.info("No patient data available.")
         return
     st.dataframe(df)
+    doctor_history_panel(df["patient_id"].tolist())
+    st.markdown("---")
+    diagnosis_breakdown_panel()
+
+@timed_fragment("doctor:history")
+def doctor_history_panel(patient_ids):
+    history_id = st.selectbox("Patient history", patient_ids, key="doctor_history_id")
+    if history_id is not None:
+        show_encounter_history(int(history_id))
+
+@timed_fragment("doctor:diagnoses")
+def diagnosis_breakdown_panel():
+    st.subheader("🧬 Diagnosis Breakdown")
+    window = st.selectbox("Patients added", ["Last 30 days", "Last 90 days", "Last 365 days", "All time"],
+                          index=1, key="doctor_diagnosis_window")
+    days = {"Last 30 days": 30, "Last 90 days": 90, "Last 365 days": 365}.get(window)
+    lo, hi = time_range(last_days=days, round_to=RANGE_ROUNDING) if days else (None, None)
+    counts = diagnosis_counts(lo, hi)
+    if counts.empty:
+        st.info("No patients added in this period.")
+        return
+    col1, col2 = st.columns(2)
+    with col1:
+        st.plotly_chart(px.bar(counts, x="diagnosis", y="patients", title="Patients by Diagnosis"),
+                        use_container_width=True)
+    with col2:
+        series = diagnosis_series(lo, hi)
+        st.plotly_chart(px.line(series, x="date_added", y="patients", color="diagnosis", markers=True,
+                                title="Diagnoses Over Time"), use_container_width=True)
 def add_new_patient_page():
     st.subheader("Add New Patient")
 
@@ -678,7 +982,7 @@ def add_new_patient_page():
             st.warning("Please fill all fields")
             return
     
-        insert_patient(name, contact, diagnosis, date_added)
+        insert_patient(name, contact, diagnosis, date_added, recorded_by=st.session_state['user_id'])
         st.success(f"Patient '{name}' added successfully!")
         log_action(st.session_state['user_id'], st.session_state['role'], "AddPatient", f"Added patient {name}")
 
@@ -696,7 +1000,7 @@ def edit_existing_patient_page():
 
         st.success(f"Patient ID {patient_id} exists. Enter fields to update.")
         st.session_state['patient_found'] = True
-        st.session_state['patient_data'] = df[0]
+        st.session_state['patient_data'] = df
 
     if st.session_state.get('patient_found'):
         st.info("Update Fields (leave blank to keep unchanged)")
@@ -708,14 +1012,19 @@ def edit_existing_patient_page():
         if st.button("Update Patient"):
             patient = st.session_state['patient_data']
 
-            name_val = name if name.strip() != "" else patient['name']
-            contact_val = contact if contact.strip() != "" else patient['contact']
-            diagnosis_val = diagnosis if diagnosis.strip() != "" else patient['diagnosis']
-
-            update_patient_admin(patient['patient_id'],
-                                 name=name_val,
-                                 contact=contact_val,
-                                 diagnosis=diagnosis_val)
+            name_val = name if name.strip() != "" else None
+            contact_val = contact if contact.strip() != "" else None
+            diagnosis_val = diagnosis if diagnosis.strip() != "" else None
+
+            result = update_patient(patient['patient_id'],
+                                    name=name_val,
+                                    contact=contact_val,
+                                    diagnosis=diagnosis_val,
+                                    expected_version=patient.get('row_version'),
+                                    recorded_by=st.session_state['user_id'])
+            if result["status"] == UPDATE_CONFLICT:
+                st.warning("⚠ This patient was changed by another user after you loaded it. Search again before editing.")
+                return
 
             st.success(f"Patient ID {patient['patient_id']} updated successfully!")
             log_action(st.session_state['user_id'], st.session_state['role'], "UpdatePatientReceptionist", f"Updated patient_id {patient['patient_id']}")
@@ -725,6 +1034,7 @@ def edit_existing_patient_page():
                     del st.session_state[key]
 
 #----------------RECEPTIONIST FUNCTIONS-----------------------
+@timed_fragment("receptionist:add")
 def receptionist_add_patient():
     st.subheader("➕ Add New Patient")
     with st.form("add_patient_form"):
@@ -735,7 +1045,7 @@ def receptionist_add_patient():
 
         if submitted:
             if name and contact:
-                pid = add_patient_admin(name, contact, diagnosis)
+                pid = add_patient_admin(name, contact, diagnosis, recorded_by=st.session_state['user_id'])
                 st.success(f"Patient added successfully! Assigned Patient ID: {pid}")
                 log_action(
                     st.session_state['user_id'],
@@ -746,6 +1056,7 @@ def receptionist_add_patient():
             else:
                 st.error("Name and Contact are mandatory.")
 
+@timed_fragment("receptionist:edit")
 def receptionist_edit_patient():
     st.subheader("✏️ Edit Existing Patient")
 
@@ -762,6 +1073,7 @@ def receptionist_edit_patient():
 
     if st.session_state.get("edit_found"):
         patient = st.session_state["edit_patient"]
+        show_encounter_history(patient['patient_id'])
         st.subheader("Record Exist! Enter Data to Update (leave blank to keep unchanged)")
         new_name = st.text_input("New Name (optional)")
         new_contact = st.text_input("New Contact (optional)")
@@ -772,14 +1084,16 @@ def receptionist_edit_patient():
             contact_val = new_contact if new_contact.strip() else None
             diag_val = new_diag if new_diag.strip() else None
 
-            success = update_patient_admin(
+            result = update_patient(
                 edit_id,
                 name=name_val,
                 contact=contact_val,
-                diagnosis=diag_val
+                diagnosis=diag_val,
+                expected_version=patient.get('row_version'),
+                recorded_by=st.session_state['user_id']
             )
 
-            if success:
+            if result["status"] == UPDATE_OK:
                 st.success("✔ Patient record updated successfully.")
                 log_action(
                     st.session_state['user_id'],
@@ -787,6 +1101,10 @@ def receptionist_edit_patient():
                     "UpdatePatient",
                     f"Updated patient_id {edit_id}"
                 )
+                patient['row_version'] = result["row_version"]
+            elif result["status"] == UPDATE_CONFLICT:
+                st.warning("⚠ This patient was changed by another user after you loaded it. "
+                           "Search again to review the latest data, then re-apply your edit.")
             else:
                 st.error("Update failed. Check ID or database.")
 
@@ -810,8 +1128,7 @@ def show_footer(role=None):
     st.write(f"🕒 System uptime start: {st.session_state.get('last_uptime')}")
 
     if role == "admin":
-        logs_df = get_logs_df()
-        st.write(f"📊 Total actions logged: {len(logs_df)}")
+        st.write(f"📊 Total actions logged: {count_logs()}")
 
 
 # ---------------------- Main ----------------------
@@ -819,6 +1136,13 @@ def show_footer(role=None):
 st.set_page_config(page_title="GDPR Mini Hospital", layout="wide")
 
 def main():
+    # Read-heavy pages use the snapshot replica when HMS_REPLICA_PATH is set.
+    if ensure_db_exists():
+        ensure_schema()
+        enable_read_replica()
+        start_job_runner()
+        start_wal_archiver()
+
     show_consent_banner()
     if not st.session_state.get("consent_given"):
         return
@@ -831,6 +1155,10 @@ def main():
         st.write(f"User: {st.session_state['username']} ({st.session_state['role']})")
         if st.button("Logout"):
             st.session_state['show_logout_prompt'] = True
+        if st.session_state.get('perf'):
+            with st.expander("⏱ Server time (ms)"):
+                st.caption("Last full rerun and last run of each fragment")
+                st.json(st.session_state['perf'])
     
     if st.session_state.get('show_logout_prompt', False):
         show_logout_prompt()
@@ -846,10 +1174,12 @@ def main():
         if page == "View Data":
             admin_view_data()
             st.markdown("---")
+            st.caption("New patients are encrypted and anonymized when they are saved; this only processes older records.")
             if st.button("Anonymize All Unanonymized (one-click)"):
-                count = anonymize_all_unanonymized()
-                log_action(st.session_state['user_id'], st.session_state['role'], "AnonymizeAll", f"Anonymized {count} records")
-                st.success(f"Anonymized {count} records.")
+                job_id = submit_job("anonymize", {}, st.session_state['user_id'], st.session_state['role'])
+                st.success(f"Anonymization job #{job_id} queued.")
+            recurring_job_toggle("anonymize", "Run anonymization sweep nightly", {})
+            show_jobs_panel(["anonymize"])
         elif page == "Manage Patients":
             admin_manage_data()
         elif page == "Logs":
@@ -872,4 +1202,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    _started = time.perf_counter()
+    try:
+        main()
+    finally:
+        record_timing("app", _started)
@@ -0,0 +1,460 @@
+# backup.py
+"""
+Online backups and point-in-time restore for the primary database.
+
+create_backup() copies the live database with the sqlite3 backup API a bounded number
+of pages per step, so writers are only held up for one short step at a time, then
+verifies the copy with PRAGMA integrity_check.
+
+WalArchiver adds point-in-time recovery: it starts a timeline with a base backup and
+then, every `interval` seconds, copies the committed WAL frames written since the last
+copy into a segment file and checkpoints. Backups taken while a timeline is active
+(e.g. the nightly job) join it, so its later segments replay onto them too;
+archiving waits while a backup copies.
+restore(timestamp) picks the base whose timeline reaches closest to that time and
+replays segment pages onto it. Archiving needs a storage profile with wal_autocheckpoint = 0 (e.g.
+"archive"), so no other connection checkpoints frames away before they are copied.
+
+    python backup.py backup
+    python backup.py archive --interval 60
+    python backup.py restore "2026-10-19 14:30:00" --output restored.db
+    python backup.py list
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+import db
+from log_export import file_lock
+from storage import apply_profile, get_profile
+
+BACKUP_DIR = os.environ.get("HMS_BACKUP_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "backups")
+WAL_ARCHIVE_INTERVAL = float(os.environ.get("HMS_WAL_ARCHIVE_INTERVAL", "0"))
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.005
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = ".backup.lock"
+
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+
+
+# -------------------- Manifest --------------------
+def load_manifest(backup_dir=None):
+    """
+    {"bases": [...], "segments": [...], "timelines": n, "active_timeline": n or None,
+    "segment_seq": n, "wal": {...}} for backup_dir.
+    """
+    path = os.path.join(backup_dir or BACKUP_DIR, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"bases": [], "segments": [], "timelines": 0, "active_timeline": None, "segment_seq": 0, "wal": {}}
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest.setdefault("active_timeline", None)
+    # Manifests written before segments were numbered: their list position is the number
+    for seq, segment in enumerate(manifest["segments"], 1):
+        segment.setdefault("seq", seq)
+    manifest.setdefault("segment_seq", len(manifest["segments"]))
+    return manifest
+
+
+def _save_manifest(manifest, backup_dir):
+    path = os.path.join(backup_dir, MANIFEST_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+_manifest_lock = threading.Lock()
+
+
+@contextmanager
+def _locked(backup_dir):
+    """
+    Exclusive use of backup_dir's manifest, across threads and processes. Backups,
+    the archiver and pruning all rewrite it, and a backup holds it for its whole copy
+    so that no segment is archived while the copy is being taken.
+    """
+    with _manifest_lock, file_lock(os.path.join(backup_dir, LOCK_NAME)):
+        yield
+
+
+def _stamp(epoch):
+    return db.format_epoch(epoch).replace("-", "").replace(":", "").replace(" ", "_")
+
+
+# -------------------- Base backups --------------------
+def verify(path):
+    """Result of PRAGMA integrity_check on a database file ("ok" when healthy)."""
+    conn = sqlite3.connect(path)
+    try:
+        return "\n".join(row[0] for row in conn.execute("PRAGMA integrity_check").fetchall())
+    finally:
+        conn.close()
+
+
+def create_backup(backup_dir=None, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP, progress=None, timeline=None):
+    """
+    Copy the primary database into backup_dir with the backup API, `pages` pages per
+    step, and verify it. progress(remaining, total) is called after every step.
+    The backup joins `timeline`, by default the one an archiver is running. Returns
+    the manifest entry; raises RuntimeError if the copy fails verification.
+    """
+    backup_dir = backup_dir or BACKUP_DIR
+    os.makedirs(backup_dir, exist_ok=True)
+    with _locked(backup_dir):
+        return _create_backup(backup_dir, pages, sleep, progress, timeline)
+
+
+def _create_backup(backup_dir, pages, sleep, progress, timeline):
+    manifest = load_manifest(backup_dir)
+    if timeline is None:
+        timeline = manifest["active_timeline"]
+    # The archiver waits for the lock, so segments numbered up to here end before the
+    # copy and never replay onto it. Later ones may repeat commits the copy already
+    # has, which is harmless: a segment is always replayed to its end.
+    after_seq = manifest["segment_seq"]
+    tmp_path = os.path.join(backup_dir, f".base-{os.getpid()}.db")
+    src = db.get_connection()
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.backup(dst, pages=pages, sleep=sleep,
+                   progress=(lambda status, remaining, total: progress(remaining, total)) if progress else None)
+        created_at = db.now_epoch()
+        # Self-contained copy: no -wal file needed next to it
+        dst.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        dst.close()
+        src.close()
+
+    integrity = verify(tmp_path)
+    if integrity != "ok":
+        os.remove(tmp_path)
+        raise RuntimeError(f"Backup failed integrity check: {integrity}")
+
+    name = f"base_{_stamp(created_at)}_{len(manifest['bases']) + 1:04d}.db"
+    os.replace(tmp_path, os.path.join(backup_dir, name))
+    entry = {
+        "file": name,
+        "created_at": created_at,
+        "bytes": os.path.getsize(os.path.join(backup_dir, name)),
+        "sha256": _sha256(os.path.join(backup_dir, name)),
+        "integrity": integrity,
+        "timeline": timeline,
+        "after_seq": after_seq if timeline is not None else None,
+    }
+    manifest["bases"].append(entry)
+    _save_manifest(manifest, backup_dir)
+    return entry
+
+
+def _base_segments(manifest, base, until=None):
+    """The segments that replay onto `base`, oldest first, optionally only those archived by epoch `until`."""
+    if base["timeline"] is None:
+        return []
+    return [
+        s for s in manifest["segments"]
+        if s["timeline"] == base["timeline"] and s["seq"] > (base.get("after_seq") or 0)
+        and (until is None or s["archived_at"] <= until)
+    ]
+
+
+def prune_backups(keep=3, backup_dir=None):
+    """
+    Delete all but the newest `keep` base backups, and the segments no kept base
+    replays. The active timeline always keeps a base and its segments, so archiving
+    carries on with a usable timeline. Returns files removed.
+    """
+    backup_dir = backup_dir or BACKUP_DIR
+    with _locked(backup_dir):
+        manifest = load_manifest(backup_dir)
+        bases = sorted(manifest["bases"], key=lambda b: b["created_at"])
+        kept = bases[-keep:] if keep else []
+        active = manifest["active_timeline"]
+        if active is not None and not any(b["timeline"] == active for b in kept):
+            kept += [b for b in bases if b["timeline"] == active][-1:]
+        drop = [b for b in bases if b not in kept]
+        needed = {s["file"] for b in kept for s in _base_segments(manifest, b)}
+        dropped_segments = [
+            s for s in manifest["segments"] if s["file"] not in needed and s["timeline"] != active
+        ]
+        manifest["bases"] = kept
+        manifest["segments"] = [s for s in manifest["segments"] if s not in dropped_segments]
+        _save_manifest(manifest, backup_dir)
+    for entry in drop + dropped_segments:
+        path = os.path.join(backup_dir, entry["file"])
+        if os.path.exists(path):
+            os.remove(path)
+    return len(drop) + len(dropped_segments)
+
+
+# -------------------- WAL archiving --------------------
+def _committed_frames(wal_path, state):
+    """
+    (page_size, salts, data, end) for the committed frames of the current WAL
+    generation not archived yet. state is the {"salts", "offset"} recorded by the last
+    archive; a WAL restarted since then (new salts) is read from the beginning.
+    """
+    if not os.path.exists(wal_path) or os.path.getsize(wal_path) < WAL_HEADER_SIZE:
+        return None, None, b"", WAL_HEADER_SIZE
+    with open(wal_path, "rb") as f:
+        header = f.read(WAL_HEADER_SIZE)
+        page_size = struct.unpack(">I", header[8:12])[0]
+        salts = header[16:24]
+        start = state.get("offset", WAL_HEADER_SIZE) if state.get("salts") == salts.hex() else WAL_HEADER_SIZE
+        frame_size = WAL_FRAME_HEADER_SIZE + page_size
+        f.seek(start)
+        chunks, offset, committed_end, pending = [], start, start, []
+        while True:
+            frame = f.read(frame_size)
+            # Frames left over from an earlier WAL generation carry other salts
+            if len(frame) < frame_size or frame[8:16] != salts:
+                break
+            pending.append(frame)
+            offset += frame_size
+            if struct.unpack(">I", frame[4:8])[0]:
+                chunks.extend(pending)
+                pending = []
+                committed_end = offset
+    return page_size, salts.hex(), b"".join(chunks), committed_end
+
+
+class WalArchiver:
+    """
+    Keeps a connection open (so no connection close checkpoints the WAL), starts a
+    timeline with a base backup and archives WAL segments every `interval` seconds.
+    """
+
+    def __init__(self, interval=60.0, backup_dir=None):
+        self.interval = interval
+        self.backup_dir = backup_dir or BACKUP_DIR
+        self.timeline = None
+        self._anchor = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        if get_profile(db.DB_PATH).get("wal_autocheckpoint") != 0:
+            raise ValueError("WAL archiving needs a storage profile with wal_autocheckpoint = 0 (e.g. HMS_STORAGE_PROFILE=archive)")
+        # Used from the archiving thread, so not bound to this one
+        self._anchor = apply_profile(db.sqltrace.connect(db.DB_PATH, timeout=30, check_same_thread=False),
+                                     get_profile(db.DB_PATH))
+        self._anchor.isolation_level = None
+        if self._anchor.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+            raise ValueError("WAL archiving needs the database in WAL journal mode")
+
+        os.makedirs(self.backup_dir, exist_ok=True)
+        with _locked(self.backup_dir):
+            manifest = load_manifest(self.backup_dir)
+            manifest["timelines"] += 1
+            manifest["active_timeline"] = self.timeline = manifest["timelines"]
+            manifest["wal"] = {}
+            _save_manifest(manifest, self.backup_dir)
+        create_backup(self.backup_dir, timeline=self.timeline)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="hms-wal-archiver", daemon=True)
+        self._thread.start()
+        return self
+
+    def archive(self):
+        """Copy newly committed WAL frames into a segment and checkpoint. Returns the entry or None."""
+        with self._lock, _locked(self.backup_dir):
+            # Hold the write lock so no frame is appended between the copy and the checkpoint
+            self._anchor.execute("BEGIN IMMEDIATE")
+            try:
+                manifest = load_manifest(self.backup_dir)
+                page_size, salts, data, end = _committed_frames(db.database_file() + "-wal", manifest.get("wal", {}))
+                entry = None
+                if data:
+                    archived_at = db.now_epoch()
+                    # Never reused, so pruning cannot make a new segment overwrite a kept one
+                    manifest["segment_seq"] += 1
+                    name = f"wal_{self.timeline:04d}_{manifest['segment_seq']:08d}.seg"
+                    with open(os.path.join(self.backup_dir, name), "wb") as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    entry = {
+                        "file": name, "timeline": self.timeline, "seq": manifest["segment_seq"], "archived_at": archived_at,
+                        "page_size": page_size, "frames": len(data) // (WAL_FRAME_HEADER_SIZE + page_size),
+                        "bytes": len(data),
+                    }
+                    manifest["segments"].append(entry)
+                manifest["wal"] = {"salts": salts, "offset": end}
+                _save_manifest(manifest, self.backup_dir)
+
+                # PASSIVE needs no write lock; a full checkpoint lets the next writer restart the WAL
+                conn = sqlite3.connect(db.database_file())
+                conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+                conn.close()
+            finally:
+                self._anchor.execute("ROLLBACK")
+            return entry
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.archive()
+            except sqlite3.OperationalError:
+                # Busy; the next tick copies everything since the last segment
+                pass
+
+    def stop(self):
+        """Archive a final segment and release the anchor connection."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        try:
+            self.archive()
+        finally:
+            self._anchor.close()
+            self._anchor = None
+            with _locked(self.backup_dir):
+                manifest = load_manifest(self.backup_dir)
+                if manifest["active_timeline"] == self.timeline:
+                    manifest["active_timeline"] = None
+                    _save_manifest(manifest, self.backup_dir)
+
+
+_archiver = None
+
+
+def start_wal_archiver(interval=None):
+    """Start the archiver once per process when HMS_WAL_ARCHIVE_INTERVAL is set; returns it or None."""
+    global _archiver
+    interval = interval or WAL_ARCHIVE_INTERVAL
+    if _archiver is None and interval > 0:
+        _archiver = WalArchiver(interval).start()
+    return _archiver
+
+
+# -------------------- Restore --------------------
+def _replay_segment(path, target, page_size):
+    """Write the committed pages of one segment into the open target file."""
+    frame_size = WAL_FRAME_HEADER_SIZE + page_size
+    with open(path, "rb") as f:
+        while True:
+            frame = f.read(frame_size)
+            if len(frame) < frame_size:
+                break
+            page_number, commit_size = struct.unpack(">II", frame[:8])
+            target.seek((page_number - 1) * page_size)
+            target.write(frame[WAL_FRAME_HEADER_SIZE:])
+            if commit_size:
+                target.truncate(commit_size * page_size)
+
+
+def restore(timestamp, output, backup_dir=None, overwrite=False):
+    """
+    Rebuild the database as of `timestamp` (datetime or text) into `output`: of the base
+    backups taken at or before it, the one whose timeline's segments reach closest to
+    it (the newest such base, when several do), plus those segments. Returns a summary;
+    raises ValueError when no backup is old enough.
+    """
+    backup_dir = backup_dir or BACKUP_DIR
+    target_epoch = db.to_epoch(timestamp)
+    if target_epoch is None:
+        raise ValueError(f"Unrecognised timestamp {timestamp!r}")
+    if os.path.exists(output) and not overwrite:
+        raise ValueError(f"{output} already exists")
+
+    manifest = load_manifest(backup_dir)
+    bases = [b for b in manifest["bases"] if b["created_at"] <= target_epoch]
+    if not bases:
+        raise ValueError(f"No backup taken at or before {db.format_epoch(target_epoch)}")
+
+    def reach(base):
+        segments = _base_segments(manifest, base, target_epoch)
+        return (segments[-1]["archived_at"] if segments else base["created_at"]), base["created_at"]
+
+    # reversed: of bases taken in the same second, the later one
+    base = max(reversed(bases), key=reach)
+    segments = _base_segments(manifest, base, target_epoch)
+
+    tmp = output + ".restoring"
+    shutil.copyfile(os.path.join(backup_dir, base["file"]), tmp)
+    with open(tmp, "r+b") as target:
+        for segment in segments:
+            _replay_segment(os.path.join(backup_dir, segment["file"]), target, segment["page_size"])
+    conn = sqlite3.connect(tmp)
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.close()
+    integrity = verify(tmp)
+    if integrity != "ok":
+        os.remove(tmp)
+        raise RuntimeError(f"Restored database failed integrity check: {integrity}")
+    os.replace(tmp, output)
+    restored_to = segments[-1]["archived_at"] if segments else base["created_at"]
+    return {
+        "output": output,
+        "base": base["file"],
+        "segments": len(segments),
+        "restored_to": db.format_epoch(restored_to),
+        "integrity": integrity,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Online backup and point-in-time restore")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("backup", help="take a verified base backup now")
+    archive = sub.add_parser("archive", help="start a timeline and archive WAL segments until Ctrl+C")
+    archive.add_argument("--interval", type=float, default=WAL_ARCHIVE_INTERVAL or 60.0)
+    restore_cmd = sub.add_parser("restore", help="rebuild the database as of a timestamp")
+    restore_cmd.add_argument("timestamp", help='e.g. "2026-10-19 14:30:00"')
+    restore_cmd.add_argument("--output", default="restored.db")
+    restore_cmd.add_argument("--force", action="store_true", help="overwrite --output if it exists")
+    sub.add_parser("list", help="show base backups and segments")
+    prune = sub.add_parser("prune", help="keep only the newest base backups")
+    prune.add_argument("--keep", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "backup":
+        entry = create_backup()
+        print(f"Backup {entry['file']} ({entry['bytes']} bytes) verified: {entry['integrity']}")
+    elif args.command == "archive":
+        archiver = WalArchiver(args.interval).start()
+        print(f"Timeline {archiver.timeline} started; archiving every {args.interval}s. Press Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            archiver.stop()
+    elif args.command == "restore":
+        result = restore(args.timestamp, args.output, overwrite=args.force)
+        print(f"Restored to {result['restored_to']} from {result['base']} + {result['segments']} segment(s) "
+              f"into {result['output']} ({result['integrity']})")
+    elif args.command == "list":
+        manifest = load_manifest()
+        for base in manifest["bases"]:
+            segments = _base_segments(manifest, base)
+            print(f"{db.format_epoch(base['created_at'])}  {base['file']}  {base['bytes']} bytes  "
+                  f"timeline {base['timeline'] or '-'}  {len(segments)} segment(s)")
+    elif args.command == "prune":
+        print(f"Removed {prune_backups(args.keep)} file(s)")
+
+
+if __name__ == "__main__":
+    main()
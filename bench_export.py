@@ -0,0 +1,157 @@
+# bench_export.py
+"""
+Compare CSV exports with the columnar snapshot (snapshot_export.py).
+
+Fills a throwaway in-memory database (db.memory_database) with synthetic anonymized patients and audit entries, then
+times, for the same rows: writing CSV (streamed with csv.writer, like `hms export logs`)
+against writing the Parquet + Arrow snapshot, and reading each back as a table (CSV via
+pyarrow's multi-threaded reader, so the baseline is not held back by the csv module).
+Also reports file sizes and a one-column read, where Parquet only touches that column.
+
+    python bench_export.py --patients 200000 --logs 500000 --report bench_export.json
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import db
+import snapshot_export
+from bench_logs import synthetic_rows
+
+DIAGNOSES = ("Flu", "Cold", "Hypertension", "Type 2 diabetes", "Asthma", "COVID-19", "Migraine", "Pneumonia",
+             "flu", "high blood pressure", "Sprained ankle", "Back pain")
+
+
+def build_database(patients, logs, days=365, seed=11):
+    conn = db.get_connection()
+    rng = random.Random(seed)
+    end = db.now_epoch()
+    epochs = sorted(rng.randrange(end - days * 86400, end) for _ in range(patients))
+    conn.executemany(
+        "INSERT INTO patients (name, contact, diagnosis, anonymized_name, anonymized_contact, date_added, date_added_epoch) "
+        "VALUES (NULL, NULL, ?, ?, ?, ?, ?)",
+        ((rng.choice(DIAGNOSES), f"ANON_{i:07d}", f"XXX-XXX-{rng.randrange(10000):04d}", db.format_epoch(epoch), epoch)
+         for i, epoch in enumerate(epochs))
+    )
+    cursor = conn.cursor()
+    for _, user_id, role, action, _, details, epoch in synthetic_rows(logs, days=days):
+        db.insert_log(cursor, user_id, role, action, details, epoch)
+    conn.commit()
+    conn.close()
+
+
+def export_csv(path, sql):
+    conn = db.get_read_connection()
+    try:
+        cursor = conn.execute(sql)
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(column[0] for column in cursor.description)
+            while True:
+                batch = cursor.fetchmany(5000)
+                if not batch:
+                    break
+                writer.writerows(batch)
+    finally:
+        conn.close()
+
+
+def read_arrow(path):
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return round(statistics.median(samples) * 1000, 1)
+
+
+def dir_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def run_benchmark(patients=200_000, logs=500_000, repeat=3, row_group_size=100_000):
+    workdir = tempfile.mkdtemp(prefix="hms-bench-export-")
+    try:
+        with db.memory_database():
+            build_database(patients, logs)
+            csv_paths = {table: os.path.join(workdir, f"{table}.csv") for table in ("patients", "logs")}
+            sql = {"patients": snapshot_export.PATIENT_SQL, "logs": snapshot_export.LOG_SQL}
+            snapshots = os.path.join(workdir, "snapshots")
+            report = {"patients": patients, "logs": logs, "row_group_size": row_group_size, "write_ms": {}, "tables": {}}
+
+            report["write_ms"]["csv"] = timed(lambda: [export_csv(csv_paths[t], sql[t]) for t in csv_paths], repeat)
+            runs = []
+            report["write_ms"]["snapshot"] = timed(
+                lambda: runs.append(snapshot_export.export_snapshot(snapshots, row_group_size=row_group_size)), repeat)
+            # The snapshot writes Parquet and Arrow in one pass; time each alone too
+            for fmt in snapshot_export.FORMATS:
+                fmt_dir = os.path.join(workdir, fmt)
+                report["write_ms"][fmt] = timed(lambda: snapshot_export.export_snapshot(fmt_dir, (fmt,), row_group_size=row_group_size), 1)
+            latest = runs[-1]["path"]
+
+            for table, column in (("patients", "diagnosis"), ("logs", "action")):
+                parquet_dir = os.path.join(latest, table)
+                arrow_path = os.path.join(latest, f"{table}.arrow")
+                report["tables"][table] = {
+                    "csv_bytes": os.path.getsize(csv_paths[table]),
+                    "parquet_bytes": dir_bytes(parquet_dir),
+                    "arrow_bytes": os.path.getsize(arrow_path),
+                    "read_ms": {
+                        "csv": timed(lambda: pa_csv.read_csv(csv_paths[table]), repeat),
+                        "parquet": timed(lambda: pq.read_table(parquet_dir), repeat),
+                        "arrow": timed(lambda: read_arrow(arrow_path), repeat),
+                    },
+                    f"read_{column}_ms": {
+                        "csv": timed(lambda: pa_csv.read_csv(
+                            csv_paths[table], convert_options=pa_csv.ConvertOptions(include_columns=[column])), repeat),
+                        "parquet": timed(lambda: pq.read_table(parquet_dir, columns=[column]), repeat),
+                    },
+                }
+            return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(report):
+    print(f"{report['patients']} patients, {report['logs']} log entries, row groups of {report['row_group_size']}")
+    print("write ms: " + ", ".join(f"{name} {ms}" for name, ms in report["write_ms"].items()))
+    print(f"{'table':<10}{'format':<9}{'bytes':>13}{'read ms':>10}{'1 column ms':>13}")
+    for table, result in report["tables"].items():
+        one_column = next(value for key, value in result.items() if key.startswith("read_") and key != "read_ms")
+        for fmt in ("csv", "parquet", "arrow"):
+            print(f"{table:<10}{fmt:<9}{result[f'{fmt}_bytes']:>13}{result['read_ms'][fmt]:>10}{one_column.get(fmt, '-'):>13}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CSV exports against Parquet / Arrow snapshots")
+    parser.add_argument("--patients", type=int, default=200_000)
+    parser.add_argument("--logs", type=int, default=500_000)
+    parser.add_argument("--row-group-size", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement; the median is reported")
+    parser.add_argument("--report", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.patients, args.logs, args.repeat, args.row_group_size)
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+# bench_logs.py
+"""
+Compare the legacy audit log layout (one wide `logs` table) with the compact,
+dictionary-encoded layout (`logs_compact` + lookup tables behind the `logs` view).
+
+Builds both on throwaway databases from the same synthetic rows and reports bytes per
+row (table + indexes, via dbstat) and the time of typical dashboard aggregations.
+
+    python bench_logs.py --rows 200000 --report bench_logs.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import db
+
+LEGACY_DDL = """
+CREATE TABLE logs (
+    log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    role TEXT,
+    action TEXT,
+    timestamp TEXT,
+    details TEXT,
+    timestamp_epoch INTEGER
+)
+"""
+
+# (role, action, details template, weight) modelled on what the app logs
+WORKLOAD = (
+    ("admin", "Login", "User logged in", 6),
+    ("doctor", "Login", "User logged in", 10),
+    ("receptionist", "Login", "User logged in", 10),
+    ("receptionist", "AddPatient", "Added patient_id {n}", 25),
+    ("receptionist", "UpdatePatient", "Updated patient_id {n}", 20),
+    ("admin", "DecryptView", "Viewed original patient_id {n}", 8),
+    ("admin", "BulkDeletePatients", "Deleted {k} patients: {n}-{m}, {p}", 2),
+    ("admin", "ApplyRetention", 'Job {j}: {{"deleted": {k}, "retention_days": 365}}', 1),
+    ("admin", "ExportLogs", "Job {j}: {{\"file\": \"logs_export.csv\"}}", 1),
+    ("doctor", "ViewPatients", "Viewed patient list", 17),
+)
+
+COMPACT_OBJECTS = ("logs_compact", "log_roles", "log_actions", "log_templates")
+
+
+def synthetic_rows(count, days=90, seed=7):
+    rng = random.Random(seed)
+    weights = [w[3] for w in WORKLOAD]
+    end = db.now_epoch()
+    start = end - days * 86400
+    epochs = sorted(rng.randrange(start, end) for _ in range(count))
+    for log_id, epoch in enumerate(epochs, start=1):
+        role, action, template, _ = rng.choices(WORKLOAD, weights)[0]
+        n = rng.randrange(1, 50_000)
+        details = template.format(n=n, m=n + rng.randrange(1, 40), p=n + 50, k=rng.randrange(1, 200), j=rng.randrange(1, 5000))
+        yield log_id, rng.randrange(1, 60), role, action, db.format_epoch(epoch), details, epoch
+
+
+def build_legacy(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute(LEGACY_DDL)
+    conn.executemany("INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.execute("CREATE INDEX idx_logs_timestamp_epoch ON logs(timestamp_epoch)")
+    conn.commit()
+    return conn
+
+
+def build_compact(legacy_path, path):
+    """Copy the legacy database and convert it with the real migration."""
+    shutil.copyfile(legacy_path, path)
+    conn = sqlite3.connect(path)
+    started = time.perf_counter()
+    db._migrate_compact_logs(conn.cursor())
+    conn.commit()
+    migrate_seconds = time.perf_counter() - started
+    conn.execute("VACUUM")
+    return conn, migrate_seconds
+
+
+def storage_bytes(conn, tables):
+    """Bytes used by the tables and all of their indexes."""
+    placeholders = ",".join("?" * len(tables))
+    return conn.execute(f"""
+        SELECT COALESCE(SUM(pgsize), 0) FROM dbstat
+        WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name IN ({placeholders}))
+    """, tables).fetchone()[0]
+
+
+def queries(since_7d, since_30d):
+    """(name, legacy/view SQL, compact SQL against the codes, params)."""
+    return (
+        ("count by action",
+         "SELECT action, COUNT(*) FROM logs GROUP BY action",
+         "SELECT a.name, n FROM (SELECT action_id, COUNT(*) AS n FROM logs_compact GROUP BY action_id) "
+         "JOIN log_actions a USING (action_id)",
+         ()),
+        ("per day, 30 days",
+         "SELECT timestamp_epoch / 86400, COUNT(*) FROM logs WHERE timestamp_epoch >= ? GROUP BY 1",
+         "SELECT ts / 86400, COUNT(*) FROM logs_compact WHERE ts >= ? GROUP BY 1",
+         (since_30d,)),
+        ("role x action, 7 days",
+         "SELECT role, action, COUNT(*) FROM logs WHERE timestamp_epoch >= ? GROUP BY role, action",
+         "SELECT r.name, a.name, n FROM (SELECT role_id, action_id, COUNT(*) AS n FROM logs_compact "
+         "WHERE ts >= ? GROUP BY role_id, action_id) JOIN log_roles r USING (role_id) JOIN log_actions a USING (action_id)",
+         (since_7d,)),
+        ("rows, 7 days (get_logs_df)",
+         "SELECT * FROM logs WHERE timestamp_epoch >= ? ORDER BY timestamp_epoch DESC",
+         None,
+         (since_7d,)),
+    )
+
+
+def time_query(conn, sql, params, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        samples.append(time.perf_counter() - started)
+    return round(statistics.median(samples) * 1000, 2)
+
+
+def run_benchmark(rows=200_000, repeat=5):
+    workdir = tempfile.mkdtemp(prefix="hms-bench-logs-")
+    try:
+        legacy_path = os.path.join(workdir, "legacy.db")
+        legacy = build_legacy(legacy_path, synthetic_rows(rows))
+        legacy.execute("VACUUM")
+        compact, migrate_seconds = build_compact(legacy_path, os.path.join(workdir, "compact.db"))
+
+        legacy_bytes = storage_bytes(legacy, ("logs",))
+        compact_bytes = storage_bytes(compact, COMPACT_OBJECTS)
+        report = {
+            "rows": rows,
+            "legacy_bytes_per_row": round(legacy_bytes / rows, 1),
+            "compact_bytes_per_row": round(compact_bytes / rows, 1),
+            "size_ratio": round(compact_bytes / legacy_bytes, 3),
+            "templates": compact.execute("SELECT COUNT(*) FROM log_templates").fetchone()[0],
+            "migration_seconds": round(migrate_seconds, 2),
+            "queries": {},
+        }
+
+        now = db.now_epoch()
+        for name, sql, coded_sql, params in queries(now - 7 * 86400, now - 30 * 86400):
+            result = {
+                "legacy_ms": time_query(legacy, sql, params, repeat),
+                "compact_view_ms": time_query(compact, sql, params, repeat),
+            }
+            if coded_sql:
+                result["compact_codes_ms"] = time_query(compact, coded_sql, params, repeat)
+            report["queries"][name] = result
+        legacy.close()
+        compact.close()
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(report):
+    print(f"{report['rows']} rows: legacy {report['legacy_bytes_per_row']} B/row, "
+          f"compact {report['compact_bytes_per_row']} B/row ({report['size_ratio']:.0%}), "
+          f"{report['templates']} templates, migration {report['migration_seconds']}s")
+    print(f"{'query':<28}{'legacy ms':>11}{'view ms':>11}{'codes ms':>11}")
+    for name, result in report["queries"].items():
+        print(f"{name:<28}{result['legacy_ms']:>11}{result['compact_view_ms']:>11}{result.get('compact_codes_ms', '-'):>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark legacy vs compact audit log storage")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per query; the median is reported")
+    parser.add_argument("--report", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.rows, args.repeat)
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# cdc.py
+"""
+Change-data-capture feed for patients and users.
+
+Triggers installed by db.migrate_schema append one row per change to the `changes`
+table: (seq, table_name, op 'I'/'U'/'D', row_key, changed_columns, version, changed_at).
+Consumers read it with changes_since() or the blocking tail(), remember their
+position with acknowledge(), and compact() deletes entries every consumer has seen
+and, so the table cannot grow without bound behind an abandoned consumer, entries
+older than HMS_CDC_MAX_AGE_DAYS (default 30). The maintenance job runs compact_all().
+
+With sharding enabled each shard keeps its own `changes` table; pass the shard index
+as `source` to read it (None is the primary database).
+"""
+import os
+import time
+
+from db import get_connection, get_shard_router
+
+CHANGE_MAX_AGE_SECONDS = float(os.environ.get("HMS_CDC_MAX_AGE_DAYS", "30")) * 86400
+
+CHANGE_COLUMNS = ("seq", "table_name", "op", "row_key", "changed_columns", "version", "changed_at")
+
+
+def _connect(source=None):
+    if source is None:
+        return get_connection()
+    return get_shard_router().connect(source)
+
+
+def _as_change(row):
+    change = dict(zip(CHANGE_COLUMNS, row))
+    change["changed_columns"] = change["changed_columns"].split(",") if change["changed_columns"] else []
+    return change
+
+
+def _query_since(conn, since, limit, tables):
+    sql = f"SELECT {', '.join(CHANGE_COLUMNS)} FROM changes WHERE seq > ?"
+    params = [since]
+    if tables:
+        sql += f" AND table_name IN ({','.join('?' * len(tables))})"
+        params.extend(tables)
+    sql += " ORDER BY seq LIMIT ?"
+    params.append(limit)
+    return [_as_change(row) for row in conn.execute(sql, params).fetchall()]
+
+
+def changes_since(since=0, limit=1000, tables=None, source=None):
+    """Up to `limit` changes with seq > since, oldest first, optionally only for some tables."""
+    conn = _connect(source)
+    try:
+        return _query_since(conn, since, limit, tables)
+    finally:
+        conn.close()
+
+
+def latest_seq(source=None):
+    """Highest sequence number ever assigned (0 if none); survives compaction."""
+    conn = _connect(source)
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+
+def tail(since=0, tables=None, poll_interval=0.5, batch_size=500, stop_event=None, source=None):
+    """
+    Blocking iterator over changes after `since`, yielding each change dict as it is
+    committed. Between batches it only polls PRAGMA data_version, which is free until
+    another connection commits. Stops when stop_event (a threading.Event) is set.
+    """
+    conn = _connect(source)
+    try:
+        last_version = None
+        while stop_event is None or not stop_event.is_set():
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == last_version:
+                time.sleep(poll_interval)
+                continue
+            batch = _query_since(conn, since, batch_size, tables)
+            for change in batch:
+                since = change["seq"]
+                yield change
+            # A full batch may have more behind it; re-check without waiting.
+            if len(batch) < batch_size:
+                last_version = version
+    finally:
+        conn.close()
+
+
+def consumer_position(consumer, source=None):
+    """Last sequence number acknowledged by consumer (0 if it has never acknowledged)."""
+    conn = _connect(source)
+    row = conn.execute("SELECT last_seq FROM cdc_consumers WHERE name = ?", (consumer,)).fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+
+def acknowledge(consumer, seq, source=None):
+    """Record that consumer has applied every change up to and including seq."""
+    conn = _connect(source)
+    conn.execute("""
+        INSERT INTO cdc_consumers (name, last_seq) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET last_seq = MAX(last_seq, excluded.last_seq)
+    """, (consumer, seq))
+    conn.commit()
+    conn.close()
+
+
+def compact(max_age_seconds=CHANGE_MAX_AGE_SECONDS, source=None):
+    """
+    Delete changes every registered consumer has acknowledged, and entries older than
+    max_age_seconds regardless of consumers (a lagging consumer must then resync from
+    the tables); max_age_seconds=None keeps them. Returns the number of entries removed.
+    """
+    conn = _connect(source)
+    cursor = conn.cursor()
+    floor = cursor.execute("SELECT MIN(last_seq) FROM cdc_consumers").fetchone()[0]
+    deleted = 0
+    if floor is not None:
+        cursor.execute("DELETE FROM changes WHERE seq <= ?", (floor,))
+        deleted += cursor.rowcount
+    if max_age_seconds is not None:
+        cursor.execute(
+            "DELETE FROM changes WHERE changed_at < CAST(strftime('%s', 'now', 'localtime') AS INTEGER) - ?",
+            (int(max_age_seconds),)
+        )
+        deleted += cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+
+def compact_all(max_age_seconds=CHANGE_MAX_AGE_SECONDS):
+    """compact() the primary database and every patient shard; returns the total removed."""
+    router = get_shard_router()
+    sources = [None] + list(range(len(router) if router is not None else 0))
+    return sum(compact(max_age_seconds, source) for source in sources)
@@ -0,0 +1,226 @@
+# charts.py
+"""
+Chart data for the admin and doctor dashboards, aggregated in SQL and bounded in size.
+
+Time series are bucketed in SQL at hour/day/week/month granularity and then reduced
+with Largest-Triangle-Three-Buckets (LTTB) to at most max_points points, which keeps
+peaks and troughs visible. Category charts return the top N categories plus "Other".
+However long the history, a series never has more than max_points points and a
+category chart never more than top + 1 bars.
+"""
+import pandas as pd
+
+from db import fan_out_patients, get_read_connection, range_clause
+from diagnoses import UNCODED, diagnosis_names
+from shared_cache import cached
+
+GRANULARITIES = ("hour", "day", "week", "month")
+GRANULARITY_SECONDS = {"hour": 3600, "day": 86400, "week": 7 * 86400, "month": 31 * 86400}
+DEFAULT_MAX_POINTS = 500
+DEFAULT_TOP = 15
+
+# 1970-01-05 was a Monday, so weeks are aligned to it
+_WEEK_OFFSET = 4 * 86400
+
+
+def bucket_expr(column, granularity):
+    """SQL expression mapping an epoch column to the start of its bucket (also an epoch)."""
+    if granularity == "hour":
+        return f"({column} / 3600 * 3600)"
+    if granularity == "day":
+        return f"({column} / 86400 * 86400)"
+    if granularity == "week":
+        return f"(({column} - {_WEEK_OFFSET}) / 604800 * 604800 + {_WEEK_OFFSET})"
+    if granularity == "month":
+        return f"CAST(strftime('%s', {column}, 'unixepoch', 'start of month') AS INTEGER)"
+    raise ValueError(f"Unknown granularity {granularity!r}; expected one of {', '.join(GRANULARITIES)}")
+
+
+def pick_granularity(lo, hi, max_points=DEFAULT_MAX_POINTS):
+    """Finest granularity that fits [lo, hi) into max_points buckets."""
+    if lo is None or hi is None:
+        return "month"
+    for granularity in GRANULARITIES:
+        if (hi - lo) / GRANULARITY_SECONDS[granularity] <= max_points:
+            return granularity
+    return "month"
+
+
+def lttb(points, threshold):
+    """
+    Downsample [(x, y), ...] (sorted by x) to `threshold` points with
+    Largest-Triangle-Three-Buckets. First and last points are always kept.
+    """
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(points)
+    sampled = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle corner
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        span = next_end - next_start
+        avg_x = sum(p[0] for p in points[next_start:next_end]) / span
+        avg_y = sum(p[1] for p in points[next_start:next_end]) / span
+
+        ax, ay = points[a]
+        best, best_area = None, -1.0
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def _series_frame(rows, x, y, max_points):
+    points = lttb(sorted(rows), max_points)
+    df = pd.DataFrame(points, columns=[x, y])
+    df[x] = pd.to_datetime(df[x], unit="s")
+    return df
+
+
+def _data_span(column, table, lo, hi, connect):
+    """(lo, hi) with open ends replaced by the data's own MIN/MAX, for picking a granularity."""
+    if lo is not None and hi is not None:
+        return lo, hi
+    rows = connect(lambda conn: conn.execute(f"SELECT MIN({column}), MAX({column}) FROM {table}").fetchone())
+    lows = [r[0] for r in rows if r[0] is not None]
+    highs = [r[1] for r in rows if r[1] is not None]
+    if not lows:
+        return lo, hi
+    return (lo if lo is not None else min(lows)), (hi if hi is not None else max(highs) + 1)
+
+
+def _log_connect(func):
+    conn = get_read_connection()
+    try:
+        return [func(conn)]
+    finally:
+        conn.close()
+
+
+# -------------------- Series --------------------
+@cached("patients")
+def patients_added_series(lo=None, hi=None, granularity="auto", max_points=DEFAULT_MAX_POINTS):
+    """Patients added per bucket in [lo, hi): DataFrame(date_added, patients), at most max_points rows."""
+    if granularity == "auto":
+        granularity = pick_granularity(*_data_span("date_added_epoch", "patients", lo, hi, fan_out_patients), max_points)
+    bucket = bucket_expr("date_added_epoch", granularity)
+    where, params = range_clause("date_added_epoch", lo, hi)
+    sql = f"""
+        SELECT {bucket} AS bucket, COUNT(*) FROM patients
+        WHERE date_added_epoch IS NOT NULL AND {where}
+        GROUP BY bucket
+    """
+    totals = {}
+    for rows in fan_out_patients(lambda conn: conn.execute(sql, params).fetchall()):
+        for bucket_start, count in rows:
+            totals[bucket_start] = totals.get(bucket_start, 0) + count
+    return _series_frame(totals.items(), "date_added", "patients", max_points)
+
+
+@cached("logs")
+def log_activity_series(lo=None, hi=None, granularity="auto", max_points=DEFAULT_MAX_POINTS):
+    """Audit entries per bucket in [lo, hi): DataFrame(timestamp, entries), at most max_points rows."""
+    if granularity == "auto":
+        granularity = pick_granularity(*_data_span("ts", "logs_compact", lo, hi, _log_connect), max_points)
+    bucket = bucket_expr("ts", granularity)
+    where, params = range_clause("ts", lo, hi)
+    rows = _log_connect(lambda conn: conn.execute(f"""
+        SELECT {bucket} AS bucket, COUNT(*) FROM logs_compact
+        WHERE ts IS NOT NULL AND {where}
+        GROUP BY bucket
+    """, params).fetchall())[0]
+    return _series_frame(rows, "timestamp", "entries", max_points)
+
+
+# -------------------- Categories --------------------
+@cached("logs")
+def log_counts_by(field, lo=None, hi=None, top=DEFAULT_TOP):
+    """
+    Audit entries per action or role in [lo, hi), counted on the compact codes:
+    DataFrame(field, count) with the `top` largest categories plus one "Other" row.
+    """
+    lookups = {"action": ("log_actions", "action_id"), "role": ("log_roles", "role_id")}
+    if field not in lookups:
+        raise ValueError(f"Unknown log field {field!r}; expected 'action' or 'role'")
+    table, key = lookups[field]
+    where, params = range_clause("ts", lo, hi)
+    rows = _log_connect(lambda conn: conn.execute(f"""
+        SELECT COALESCE(t.name, '(none)'), c.n
+        FROM (SELECT {key}, COUNT(*) AS n FROM logs_compact WHERE {where} GROUP BY {key}) c
+        LEFT JOIN {table} t USING ({key})
+        ORDER BY c.n DESC
+    """, params).fetchall())[0]
+    head, rest = rows[:top], rows[top:]
+    if rest:
+        head.append(("Other", sum(n for _, n in rest)))
+    return pd.DataFrame(head, columns=[field, "count"])
+
+
+# -------------------- Diagnoses --------------------
+def _top_diagnoses(totals, top):
+    """Split {code: count} into the `top` largest codes and the rest."""
+    ranked = sorted(totals, key=lambda code: (-totals[code], code is None, code or 0))
+    return ranked[:top], set(ranked[top:])
+
+
+@cached("patients")
+def diagnosis_counts(lo=None, hi=None, top=DEFAULT_TOP):
+    """
+    Patients added in [lo, hi) per coded diagnosis, grouped on the integer codes:
+    DataFrame(diagnosis, patients) with the `top` largest diagnoses plus one "Other" row.
+    """
+    where, params = range_clause("date_added_epoch", lo, hi)
+    sql = f"SELECT diagnosis_code, COUNT(*) FROM patients WHERE {where} GROUP BY diagnosis_code"
+    totals = {}
+    for rows in fan_out_patients(lambda conn: conn.execute(sql, params).fetchall()):
+        for code, count in rows:
+            totals[code] = totals.get(code, 0) + count
+    head, rest = _top_diagnoses(totals, top)
+    names = diagnosis_names(head)
+    rows = [(names.get(code, UNCODED) if code is not None else UNCODED, totals[code]) for code in head]
+    if rest:
+        rows.append(("Other", sum(totals[code] for code in rest)))
+    return pd.DataFrame(rows, columns=["diagnosis", "patients"])
+
+
+@cached("patients")
+def diagnosis_series(lo=None, hi=None, granularity="auto", top=8, max_points=DEFAULT_MAX_POINTS):
+    """
+    Patients added per bucket and coded diagnosis in [lo, hi), for the `top` diagnoses of
+    the range plus "Other": DataFrame(date_added, diagnosis, patients), long format,
+    with at most max_points rows per diagnosis.
+    """
+    if granularity == "auto":
+        granularity = pick_granularity(*_data_span("date_added_epoch", "patients", lo, hi, fan_out_patients), max_points)
+    bucket = bucket_expr("date_added_epoch", granularity)
+    where, params = range_clause("date_added_epoch", lo, hi)
+    sql = f"""
+        SELECT {bucket} AS bucket, diagnosis_code, COUNT(*) FROM patients
+        WHERE date_added_epoch IS NOT NULL AND {where}
+        GROUP BY bucket, diagnosis_code
+    """
+    cells, totals = {}, {}
+    for rows in fan_out_patients(lambda conn: conn.execute(sql, params).fetchall()):
+        for bucket_start, code, count in rows:
+            cells[bucket_start, code] = cells.get((bucket_start, code), 0) + count
+            totals[code] = totals.get(code, 0) + count
+    head, _ = _top_diagnoses(totals, top)
+    names = diagnosis_names(head)
+    labels = {code: names.get(code, UNCODED) if code is not None else UNCODED for code in head}
+    series = {}
+    for (bucket_start, code), count in cells.items():
+        buckets = series.setdefault(labels.get(code, "Other"), {})
+        buckets[bucket_start] = buckets.get(bucket_start, 0) + count
+    # An explicit fine granularity over a long range can exceed max_points buckets
+    rows = [(b, label, n) for label, buckets in series.items() for b, n in lttb(sorted(buckets.items()), max_points)]
+    df = pd.DataFrame(sorted(rows), columns=["date_added", "diagnosis", "patients"])
+    df["date_added"] = pd.to_datetime(df["date_added"], unit="s")
+    return df
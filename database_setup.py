@@ -1,44 +1,9 @@
-import sqlite3
+from db import DB_PATH, create_schema, get_connection
 
-conn = sqlite3.connect('database.db')
-cursor = conn.cursor()
+conn = get_connection()
 
-# Users table
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    username TEXT UNIQUE NOT NULL,
-    password TEXT NOT NULL,
-    role TEXT NOT NULL
-)
-''')
+# Users, patients and logs tables, plus columns, indexes and tables added after the first release
+create_schema(conn)
 
-# Patients table
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS patients (
-    patient_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT,
-    contact TEXT,
-    diagnosis TEXT,
-    anonymized_name TEXT,
-    anonymized_contact TEXT,
-    date_added TEXT
-)
-''')
-
-# Logs table
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS logs (
-    log_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    role TEXT,
-    action TEXT,
-    timestamp TEXT,
-    details TEXT,
-    FOREIGN KEY(user_id) REFERENCES users(user_id)
-)
-''')
-
-conn.commit()
 conn.close()
-print("Database and tables created successfully!")
+print(f"Database and tables created successfully at {DB_PATH}!")
@@ -0,0 +1,900 @@
+# db.py
+import calendar
+import json
+import os
+import re
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import parse_qs, unquote, urlsplit
+from urllib.request import pathname2url
+
+import sqltrace
+from diagnoses import seed_dictionary
+from replica import ReadReplica
+from sharding import ShardRouter
+from storage import apply_profile, get_profile
+
+# The primary database: a file path or a SQLite URI, from HMS_DATABASE. An in-memory
+# URI shared by the process's connections (":memory:", "file:/hms?vfs=memdb" or
+# "file:hms?mode=memory&cache=shared") keeps the whole database in RAM, loaded from the
+# HMS_DATABASE_SNAPSHOT file when that is set and with a new schema otherwise.
+# Every module connects through get_connection().
+DB_PATH = os.environ.get("HMS_DATABASE") or os.path.join(os.path.dirname(__file__), "database.db")
+DB_SNAPSHOT = os.environ.get("HMS_DATABASE_SNAPSHOT")
+
+# Optional read replica. Set HMS_REPLICA_PATH to a file path to enable it.
+REPLICA_PATH = os.environ.get("HMS_REPLICA_PATH")
+REPLICA_INTERVAL = float(os.environ.get("HMS_REPLICA_INTERVAL", "30"))
+REPLICA_MAX_STALENESS = float(os.environ.get("HMS_REPLICA_MAX_STALENESS", "60"))
+
+# Optional horizontal sharding of patients. HMS_SHARD_COUNT > 0 enables it and sets the
+# initial number of shards (afterwards the shard_layout table decides); shard files
+# live in HMS_SHARD_DIR (default: next to the primary; in memory for an in-memory one).
+# HMS_SHARD_STRATEGY is "hash" (by patient_id) or "facility", with
+# HMS_SHARD_FACILITIES pinning facilities to shards, e.g. "north=0,south=1".
+SHARD_COUNT = int(os.environ.get("HMS_SHARD_COUNT", "0"))
+SHARD_DIR = os.environ.get("HMS_SHARD_DIR")
+SHARD_STRATEGY = os.environ.get("HMS_SHARD_STRATEGY", "hash")
+SHARD_FACILITIES = os.environ.get("HMS_SHARD_FACILITIES", "")
+
+_replica = None
+_router = None
+
+# In-memory databases live as long as a connection to them is open
+_memory_anchors = {}
+_memory_lock = threading.RLock()
+
+
+# -------------------- Storage location --------------------
+def memory_uri(name=None):
+    """
+    URI of a named in-memory database shared by every connection in this process; a new,
+    unique one when name is None. SQLite's memdb VFS (3.36+) keeps ordinary locking, so
+    writers wait for readers; older versions fall back to a shared-cache database.
+    """
+    name = f"hms-{name or uuid.uuid4().hex}"
+    if sqlite3.sqlite_version_info >= (3, 36):
+        return f"file:/{name}?vfs=memdb"
+    return f"file:{name}?mode=memory&cache=shared"
+
+
+if DB_PATH == ":memory:":
+    DB_PATH = memory_uri()
+
+
+def is_memory_database(path=None):
+    path = DB_PATH if path is None else path
+    if path == ":memory:":
+        return True
+    if not path.startswith("file:"):
+        return False
+    parts = urlsplit(path)
+    query = parse_qs(parts.query)
+    return parts.path == ":memory:" or "memory" in query.get("mode", []) or "memdb" in query.get("vfs", [])
+
+
+def database_file(path=None):
+    """Filesystem path of a database path or file: URI; None for an in-memory database."""
+    path = DB_PATH if path is None else path
+    if is_memory_database(path):
+        return None
+    if path.startswith("file:"):
+        return unquote(urlsplit(path).path)
+    return path
+
+
+def database_exists(path=None):
+    """True for an in-memory database (created on first use) or an existing file."""
+    path = DB_PATH if path is None else path
+    return is_memory_database(path) or os.path.exists(database_file(path))
+
+
+def configure_database(path, snapshot=None, shard_dir=None):
+    """
+    Point this process at another database (a file path, a SQLite URI or ":memory:")
+    and return the resolved DB_PATH. Connections opened later use it, with shard files
+    in shard_dir (default: HMS_SHARD_DIR, or next to the database).
+    """
+    global DB_PATH, DB_SNAPSHOT, SHARD_DIR, _router
+    if path == ":memory:":
+        path = memory_uri()
+    elif not path.startswith("file:"):
+        path = os.path.abspath(path)
+    disable_read_replica()
+    DB_PATH, DB_SNAPSHOT, _router = path, snapshot, None
+    SHARD_DIR = shard_dir or os.environ.get("HMS_SHARD_DIR")
+    return DB_PATH
+
+
+def _open_memory_database(uri, snapshot=None):
+    """Create (once) and keep open the in-memory database at uri, loaded from snapshot or with a new schema."""
+    with _memory_lock:
+        if uri in _memory_anchors:
+            return
+        anchor = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        _memory_anchors[uri] = anchor
+        try:
+            if snapshot:
+                # VACUUM INTO, unlike the backup API, writes a rollback-journal image,
+                # which memdb needs (it cannot open a WAL-mode database)
+                if not snapshot.startswith("file:"):
+                    snapshot = "file:" + pathname2url(os.path.abspath(snapshot)) + "?mode=ro"
+                source = sqlite3.connect(snapshot, uri=True)
+                source.execute("VACUUM INTO ?", (uri,))
+                source.close()
+            elif uri == DB_PATH:
+                create_schema(anchor)
+        except BaseException:
+            del _memory_anchors[uri]
+            anchor.close()
+            raise
+
+
+def close_memory_database(uri=None):
+    """Drop an in-memory database (its data is gone once the last connection closes)."""
+    anchor = _memory_anchors.pop(DB_PATH if uri is None else uri, None)
+    if anchor is not None:
+        anchor.close()
+
+
+@contextmanager
+def memory_database(snapshot=None, name=None):
+    """
+    Run the block against a fresh in-memory database, preloaded from the `snapshot`
+    file or created with the current schema, then restore the previous database:
+
+        with db.memory_database("database.db"):
+            ...   # every helper reads and writes RAM only
+
+    Each call gets its own database, so several can coexist in one process
+    (threads started in the block see it too; DB_PATH is process-wide).
+    """
+    global DB_PATH, DB_SNAPSHOT, _router
+    saved = DB_PATH, DB_SNAPSHOT, _router
+    uri = memory_uri(name)
+    DB_PATH, DB_SNAPSHOT, _router = uri, snapshot, None
+    try:
+        _open_memory_database(uri, snapshot)
+        yield uri
+    finally:
+        if _router is not None:
+            for path in _router.shard_paths:
+                close_memory_database(path)
+        close_memory_database(uri)
+        DB_PATH, DB_SNAPSHOT, _router = saved
+
+
+# -------------------- Connections --------------------
+def get_connection():
+    """
+    Connection to the primary database; use for every write and read-your-writes query.
+    Pragmas come from the active storage profile (see storage.py).
+    """
+    if DB_PATH not in _memory_anchors and is_memory_database(DB_PATH):
+        _open_memory_database(DB_PATH, DB_SNAPSHOT)
+    return apply_profile(sqltrace.connect(DB_PATH), get_profile(DB_PATH))
+
+
+def enable_read_replica(replica_path=None, interval=None):
+    """
+    Start the background snapshot refresher (idempotent).
+    Returns the replica, or None when no replica path is configured.
+    """
+    global _replica
+    if _replica is not None:
+        return _replica
+    replica_path = replica_path or REPLICA_PATH
+    if not replica_path or is_memory_database():
+        # An in-memory primary is already as fast to read as a snapshot would be
+        return None
+    _replica = ReadReplica(DB_PATH, replica_path, interval or REPLICA_INTERVAL).start()
+    return _replica
+
+
+def read_replica():
+    """The running ReadReplica, or None when reads go to the primary."""
+    return _replica
+
+
+def disable_read_replica():
+    global _replica
+    if _replica is not None:
+        _replica.stop()
+        _replica = None
+
+
+def get_read_connection(max_staleness=None):
+    """
+    Connection for read-only queries that tolerate bounded staleness.
+    Served from the replica snapshot when one is enabled (never older than
+    max_staleness seconds), otherwise from the primary database. max_staleness=0
+    reads the primary rather than copying it into a fresh snapshot.
+    """
+    if _replica is None or max_staleness == 0:
+        return get_connection()
+    if max_staleness is None:
+        max_staleness = REPLICA_MAX_STALENESS
+    return _replica.connect(max_staleness)
+
+
+# -------------------- Patient shards --------------------
+def shard_paths(count):
+    if is_memory_database():
+        # Shards of an in-memory primary are in-memory too, named after it
+        base, _, query = DB_PATH.partition("?")
+        return [f"{base}-shard{i}?{query}" for i in range(count)]
+    directory = SHARD_DIR or os.path.dirname(os.path.abspath(database_file()))
+    return [os.path.join(directory, f"database_shard{i}.db") for i in range(count)]
+
+
+def _open_shard_paths(count):
+    """shard_paths(count), with in-memory shards created and kept open."""
+    paths = shard_paths(count)
+    for path in filter(is_memory_database, paths):
+        _open_memory_database(path)
+    return paths
+
+
+def get_shard_router():
+    """The configured ShardRouter, or None when patients live in the primary database."""
+    global _router
+    if _router is None and SHARD_COUNT > 0:
+        facility_map = {}
+        for item in filter(None, SHARD_FACILITIES.split(",")):
+            facility, shard = item.split("=")
+            facility_map[facility.strip()] = int(shard)
+        conn = get_connection()
+        # The first process to shard the database records the layout; rebalances change it
+        conn.execute("INSERT OR IGNORE INTO shard_layout (layout_id, shard_count) VALUES (1, ?)", (SHARD_COUNT,))
+        # Start id allocation above any patient still in the primary database
+        # (shard_existing_patients moves those rows onto the shards).
+        conn.execute("""
+            INSERT OR IGNORE INTO patient_shards (patient_id, shard)
+            SELECT MAX(patient_id), NULL FROM patients HAVING MAX(patient_id) IS NOT NULL
+        """)
+        conn.commit()
+        conn.close()
+        _router = ShardRouter(
+            _open_shard_paths, get_connection, SHARD_STRATEGY, facility_map,
+            configure=lambda conn: apply_profile(conn, get_profile(DB_PATH)), shard_count=SHARD_COUNT
+        )
+        for index in range(len(_router)):
+            conn = _router.connect(index)
+            create_shard_schema(conn)
+            conn.close()
+    return _router
+
+
+def patient_connection(patient_id):
+    """Connection to whichever database holds patient_id."""
+    router = get_shard_router()
+    if router is None:
+        return get_connection()
+    return router.connect_for(patient_id)
+
+
+def patient_connections():
+    """Connections to every database holding patient rows, for writes that touch all patients."""
+    router = get_shard_router()
+    if router is None:
+        return [get_connection()]
+    return [router.connect(index) for index in range(len(router))]
+
+
+def fan_out_patients(func, max_staleness=None, primary=False):
+    """
+    Run func(conn) against every database holding patient rows (in parallel across
+    shards) and return the list of results. Unsharded reads use get_read_connection
+    unless primary=True asks for read-your-writes.
+    """
+    router = get_shard_router()
+    if router is not None:
+        return router.fan_out(func)
+    conn = get_connection() if primary else get_read_connection(max_staleness)
+    try:
+        return [func(conn)]
+    finally:
+        conn.close()
+
+
+def allocate_patient(facility=None):
+    """
+    (patient_id, connection) for a new patient. Unsharded, the id is reserved inside an
+    open write transaction on the returned connection; the caller commits the insert.
+    """
+    router = get_shard_router()
+    if router is None:
+        conn = get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        patient_id = conn.execute("""
+            SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'patients'), 0),
+                       COALESCE((SELECT MAX(patient_id) FROM patients), 0)) + 1
+        """).fetchone()[0]
+        return patient_id, conn
+    patient_id, shard = router.allocate(facility)
+    return patient_id, router.connect(shard)
+
+
+def shard_existing_patients(batch_size=500):
+    """
+    One-off move of patients (and their encounters) still stored in the primary
+    database onto the shards. Returns the number of patients moved.
+    """
+    router = get_shard_router()
+    if router is None:
+        raise RuntimeError("Sharding is not enabled (set HMS_SHARD_COUNT)")
+    conn = get_connection()
+    rows = conn.execute("SELECT patient_id, facility FROM patients").fetchall()
+    columns = ", ".join(row[1] for row in conn.execute("PRAGMA table_info(patients)").fetchall())
+    moved = 0
+    for start in range(0, len(rows), batch_size):
+        by_shard = {}
+        for patient_id, facility in rows[start:start + batch_size]:
+            by_shard.setdefault(router.place(patient_id, facility), []).append(patient_id)
+        for shard, patient_ids in by_shard.items():
+            placeholders = ",".join("?" * len(patient_ids))
+            conn.execute("ATTACH DATABASE ? AS shard", (router.shard_paths[shard],))
+            conn.execute(
+                f"INSERT OR REPLACE INTO shard.patients ({columns}) "
+                f"SELECT {columns} FROM main.patients WHERE patient_id IN ({placeholders})", patient_ids
+            )
+            conn.execute(
+                "INSERT INTO shard.encounters (patient_id, ts, diagnosis, recorded_by) "
+                f"SELECT patient_id, ts, diagnosis, recorded_by FROM main.encounters WHERE patient_id IN ({placeholders})",
+                patient_ids
+            )
+            conn.execute(f"DELETE FROM main.patients WHERE patient_id IN ({placeholders})", patient_ids)
+            conn.executemany(
+                "INSERT OR REPLACE INTO patient_shards (patient_id, shard) VALUES (?, ?)",
+                [(pid, shard) for pid in patient_ids]
+            )
+            conn.commit()
+            conn.execute("DETACH DATABASE shard")
+            moved += len(patient_ids)
+    conn.close()
+    return moved
+
+
+def rebalance_shards(new_count):
+    """Move patients onto new_count shard files; every process switches to them (see ShardRouter.rebalance)."""
+    router = get_shard_router()
+    if router is None:
+        raise RuntimeError("Sharding is not enabled (set HMS_SHARD_COUNT)")
+    return router.rebalance(new_count, create_shard_schema)
+
+
+# -------------------- Data retention --------------------
+def apply_data_retention(retention_days):
+    """
+    Delete patient records older than retention_days (based on date_added).
+    Rows without an epoch are dated from their text first; unparseable dates are kept.
+    Returns number of deleted records.
+    """
+    cutoff = to_epoch(datetime.now() - timedelta(days=retention_days))
+    count = 0
+    for conn in patient_connections():
+        cursor = conn.cursor()
+        # Rows written without date_added_epoch (direct SQL, older clients) would never match the DELETE
+        _normalize_timestamps(cursor, "patients", "patient_id", "date_added", "date_added_epoch")
+        cursor.execute("DELETE FROM patients WHERE date_added_epoch < ?", (cutoff,))
+        count += cursor.rowcount
+        conn.commit()
+        conn.close()
+    return count
+
+
+# -------------------- Timestamps --------------------
+# Integer timestamps are seconds since 1970-01-01 on the hospital's local wall clock,
+# the same naive local time the TEXT columns always held. SQLite's
+# date(x, 'unixepoch') therefore yields the local day without a timezone lookup.
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+_PARSE_FORMATS = (TIMESTAMP_FORMAT, "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%d")
+
+
+def to_epoch(value):
+    """Convert a datetime, date, epoch number or timestamp string to integer epoch seconds (None if unparseable)."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, datetime):
+        return calendar.timegm(value.timetuple())
+    if isinstance(value, date):
+        return calendar.timegm(value.timetuple())
+    text = str(value).strip()
+    for fmt in _PARSE_FORMATS:
+        try:
+            return calendar.timegm(datetime.strptime(text, fmt).timetuple())
+        except ValueError:
+            continue
+    return None
+
+
+def format_epoch(epoch):
+    """Render epoch seconds in the canonical TEXT format."""
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+def now_epoch():
+    return to_epoch(datetime.now())
+
+
+def time_range(last_hours=None, last_days=None, start=None, end=None, round_to=None):
+    """
+    Half-open [lo, hi) epoch bounds for range queries; None means unbounded.
+    last_hours / last_days count back from now, rounded down to a multiple of round_to
+    seconds when given, so calls within that window return the same bounds (and hit
+    the same shared-cache entries). A plain date as `end` includes that whole day.
+    """
+    lo = hi = None
+    if last_hours is not None:
+        lo = now_epoch() - int(last_hours * 3600)
+    if last_days is not None:
+        lo = now_epoch() - int(last_days * 86400)
+    if lo is not None and round_to:
+        lo -= lo % round_to
+    if start is not None:
+        lo = to_epoch(start)
+    if end is not None:
+        if isinstance(end, date) and not isinstance(end, datetime):
+            end = end + timedelta(days=1)
+        hi = to_epoch(end)
+    return lo, hi
+
+
+def range_clause(column, lo=None, hi=None):
+    """SQL fragment and params restricting an indexed epoch column to [lo, hi)."""
+    clauses, params = [], []
+    if lo is not None:
+        clauses.append(f"{column} >= ?")
+        params.append(lo)
+    if hi is not None:
+        clauses.append(f"{column} < ?")
+        params.append(hi)
+    return " AND ".join(clauses) or "1", params
+
+
+# -------------------- Schema migrations --------------------
+_migrated = set()
+
+
+def _object_type(cursor, name):
+    """'table', 'view', ... for a schema object, or None when it does not exist."""
+    row = cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def _table_columns(cursor, table):
+    return {row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()}
+
+
+PATIENTS_DDL = '''
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    contact TEXT,
+    diagnosis TEXT,
+    anonymized_name TEXT,
+    anonymized_contact TEXT,
+    date_added TEXT
+)
+'''
+
+USERS_DDL = '''
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL,
+    role TEXT NOT NULL
+)
+'''
+
+LOGS_DDL = '''
+CREATE TABLE IF NOT EXISTS logs (
+    log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    role TEXT,
+    action TEXT,
+    timestamp TEXT,
+    details TEXT,
+    FOREIGN KEY(user_id) REFERENCES users(user_id)
+)
+'''
+
+
+def create_schema(conn):
+    """Create the base tables in a new database and apply every migration."""
+    cursor = conn.cursor()
+    cursor.execute(USERS_DDL)
+    cursor.execute(PATIENTS_DDL)
+    cursor.execute(LOGS_DDL)
+    conn.commit()
+    migrate_schema(conn)
+
+
+def migrate_schema(conn=None):
+    """
+    Bring an existing database up to the current schema. Safe to run repeatedly;
+    database_setup.py runs it after creating the base tables.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_connection()
+    cursor = conn.cursor()
+
+    _migrate_patients(cursor)
+
+    if _object_type(cursor, "logs") == "table":
+        if "timestamp_epoch" not in _table_columns(cursor, "logs"):
+            cursor.execute("ALTER TABLE logs ADD COLUMN timestamp_epoch INTEGER")
+        _normalize_timestamps(cursor, "logs", "log_id", "timestamp", "timestamp_epoch")
+    _migrate_compact_logs(cursor)
+
+    # Shard directory: allocates patient ids and records where each patient lives
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patient_shards (
+            patient_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shard INTEGER
+        )
+    ''')
+    # Shard layout: one row, target_count set while a rebalance is moving rows
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shard_layout (
+            layout_id INTEGER PRIMARY KEY CHECK (layout_id = 1),
+            shard_count INTEGER NOT NULL,
+            target_count INTEGER
+        )
+    ''')
+
+    # Diagnosis dictionary: every known spelling maps to one integer code (see diagnoses.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS diagnoses (
+            diagnosis_code INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS diagnosis_synonyms (
+            synonym TEXT PRIMARY KEY,
+            diagnosis_code INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    seed_dictionary(cursor)
+
+    # Background jobs and their recurring schedules (see jobs.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress REAL NOT NULL DEFAULT 0,
+            message TEXT,
+            result TEXT,
+            submitted_by INTEGER,
+            submitted_role TEXT,
+            schedule_id INTEGER,
+            created_at INTEGER,
+            started_at INTEGER,
+            finished_at INTEGER,
+            cancel_requested INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # Which runner holds a running job, and when it last said it was alive
+    if "worker_id" not in _table_columns(cursor, "jobs"):
+        cursor.execute("ALTER TABLE jobs ADD COLUMN worker_id TEXT")
+    if "heartbeat_at" not in _table_columns(cursor, "jobs"):
+        cursor.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, job_id)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_schedules (
+            schedule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT,
+            every_seconds INTEGER NOT NULL,
+            next_run INTEGER NOT NULL,
+            submitted_by INTEGER,
+            submitted_role TEXT
+        )
+    ''')
+
+    _install_change_capture(cursor, "users", "user_id")
+
+    conn.commit()
+    if own_conn:
+        conn.close()
+
+
+def create_shard_schema(conn):
+    """Create and migrate the patients table in a shard database."""
+    cursor = conn.cursor()
+    cursor.execute(PATIENTS_DDL)
+    _migrate_patients(cursor)
+    conn.commit()
+
+
+def _migrate_patients(cursor):
+    if "row_version" not in _table_columns(cursor, "patients"):
+        cursor.execute("ALTER TABLE patients ADD COLUMN row_version INTEGER NOT NULL DEFAULT 1")
+
+    if "date_added_epoch" not in _table_columns(cursor, "patients"):
+        cursor.execute("ALTER TABLE patients ADD COLUMN date_added_epoch INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patients_date_added_epoch ON patients(date_added_epoch)")
+    _normalize_timestamps(cursor, "patients", "patient_id", "date_added", "date_added_epoch")
+
+    if "facility" not in _table_columns(cursor, "patients"):
+        cursor.execute("ALTER TABLE patients ADD COLUMN facility TEXT")
+
+    # New rows are anonymized on insert; only legacy rows still match, so the sweep stays cheap
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_patients_unanonymized ON patients(patient_id)
+        WHERE anonymized_name IS NULL OR anonymized_name = ''
+    """)
+
+    # Coded diagnosis (see diagnoses.py); the index serves per-diagnosis counts and finds uncoded rows
+    if "diagnosis_code" not in _table_columns(cursor, "patients"):
+        cursor.execute("ALTER TABLE patients ADD COLUMN diagnosis_code INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patients_diagnosis_code ON patients(diagnosis_code, date_added_epoch)")
+
+    _migrate_encounters(cursor)
+
+    # Keep last: the update trigger lists every current column
+    _install_change_capture(cursor, "patients", "patient_id", "row_version")
+
+
+def _migrate_encounters(cursor):
+    """
+    Append-only diagnosis history next to patients (so it shards with them). The index
+    covers every column a timeline reads, in (patient_id, ts, encounter_id) order, so the
+    latest N or a date range of one patient is a single index range scan.
+    """
+    created = _object_type(cursor, "encounters") is None
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS encounters (
+            encounter_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            diagnosis TEXT,
+            recorded_by INTEGER
+        )
+    ''')
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_encounters_patient_ts
+        ON encounters(patient_id, ts, encounter_id, diagnosis, recorded_by)
+    """)
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_delete_encounters AFTER DELETE ON patients BEGIN
+            DELETE FROM encounters WHERE patient_id = OLD.patient_id;
+        END
+    ''')
+    if created:
+        # Existing patients start their history with the diagnosis they have now
+        cursor.execute("""
+            INSERT INTO encounters (patient_id, ts, diagnosis)
+            SELECT patient_id, COALESCE(date_added_epoch, ?), diagnosis FROM patients
+            WHERE diagnosis IS NOT NULL AND diagnosis != ''
+        """, (now_epoch(),))
+
+
+def _install_change_capture(cursor, table, key, version_column=None):
+    """
+    (Re)create the triggers that append a compact record to `changes` for every
+    insert, update and delete on table. Updates record only the names of the columns
+    whose value changed and are skipped when nothing changed. See cdc.py.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            op TEXT NOT NULL,
+            row_key INTEGER NOT NULL,
+            changed_columns TEXT,
+            version INTEGER,
+            changed_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now', 'localtime') AS INTEGER))
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cdc_consumers (
+            name TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    columns = sorted(_table_columns(cursor, table))
+    changed = " || ".join(f"CASE WHEN OLD.{c} IS NOT NEW.{c} THEN '{c},' ELSE '' END" for c in columns)
+    new_version = f"NEW.{version_column}" if version_column else "NULL"
+    old_version = f"OLD.{version_column}" if version_column else "NULL"
+
+    for op in ("insert", "update", "delete"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS cdc_{table}_{op}")
+    cursor.execute(f'''
+        CREATE TRIGGER cdc_{table}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO changes (table_name, op, row_key, version)
+            VALUES ('{table}', 'I', NEW.{key}, {new_version});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER cdc_{table}_update AFTER UPDATE ON {table} BEGIN
+            INSERT INTO changes (table_name, op, row_key, changed_columns, version)
+            SELECT '{table}', 'U', NEW.{key}, rtrim(cols, ','), {new_version}
+            FROM (SELECT {changed} AS cols)
+            WHERE cols <> '';
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER cdc_{table}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO changes (table_name, op, row_key, version)
+            VALUES ('{table}', 'D', OLD.{key}, {old_version});
+        END
+    ''')
+
+
+def _normalize_timestamps(cursor, table, key, text_column, epoch_column):
+    """Fill the epoch column for rows that lack it and rewrite their text into the canonical format."""
+    rows = cursor.execute(
+        f"SELECT {key}, {text_column} FROM {table} WHERE {epoch_column} IS NULL AND {text_column} IS NOT NULL"
+    ).fetchall()
+    updates = []
+    for row_key, text in rows:
+        epoch = to_epoch(text)
+        if epoch is not None:
+            updates.append((format_epoch(epoch), epoch, row_key))
+    cursor.executemany(
+        f"UPDATE {table} SET {text_column} = ?, {epoch_column} = ? WHERE {key} = ?", updates
+    )
+
+
+# -------------------- Compact audit log --------------------
+# Audit rows live in logs_compact: role and action as codes into lookup tables, the
+# timestamp as an epoch, and details split into a template (numbers replaced by %s)
+# plus a JSON array of the numbers. The `logs` view rebuilds the original columns.
+LOG_TEMPLATE_MAX_PARAMS = 8
+_LOG_PARAM = re.compile(r"\b(?:0|[1-9][0-9]{0,14})\b")
+_LOG_CODE_TABLES = {"log_roles": "role_id", "log_actions": "action_id", "log_templates": "template_id"}
+_log_codes = {}
+
+
+def encode_log_details(details):
+    """
+    (template, args, raw) for a details string. Templates have the numbers replaced
+    by %s and are rebuilt with printf(); text without numbers is its own template and
+    text with too many numbers is kept raw.
+    """
+    if details is None:
+        return None, None, None
+    params = _LOG_PARAM.findall(details)
+    if not params:
+        return details, None, None
+    if len(params) > LOG_TEMPLATE_MAX_PARAMS:
+        return None, None, details
+    template = _LOG_PARAM.sub("%s", details.replace("%", "%%"))
+    return template, json.dumps([int(p) for p in params], separators=(",", ":")), None
+
+
+def _log_code(cursor, table, name, cache=None):
+    """
+    Id of name in a lookup table, adding it if needed. Only ids that already existed
+    are cached, so a rolled-back insert never leaves a stale id behind.
+    """
+    if name is None:
+        return None
+    cache = _log_codes.setdefault((DB_PATH, table), {}) if cache is None else cache
+    if name in cache:
+        return cache[name]
+    column = "template" if table == "log_templates" else "name"
+    key = _LOG_CODE_TABLES[table]
+    cursor.execute(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", (name,))
+    inserted = cursor.rowcount == 1
+    code = cursor.execute(f"SELECT {key} FROM {table} WHERE {column} = ?", (name,)).fetchone()[0]
+    if not inserted:
+        cache[name] = code
+    return code
+
+
+def _compact_log_row(cursor, user_id, role, action, details, epoch, cache=None):
+    def code(table, name):
+        return _log_code(cursor, table, name, None if cache is None else cache.setdefault(table, {}))
+
+    template, args, raw = encode_log_details(details)
+    return (
+        user_id, code("log_roles", role), code("log_actions", action), epoch,
+        code("log_templates", template), args, raw,
+    )
+
+
+def insert_log(cursor, user_id, role, action, details, epoch):
+    """Append one audit row in the compact encoding on an open cursor."""
+    cursor.execute(
+        "INSERT INTO logs_compact (user_id, role_id, action_id, ts, template_id, args, details) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        _compact_log_row(cursor, user_id, role, action, details, epoch)
+    )
+    return cursor.lastrowid
+
+
+def _migrate_compact_logs(cursor, batch_size=5000):
+    """Create the compact log tables, move rows out of a legacy logs table and install the view."""
+    cursor.execute("CREATE TABLE IF NOT EXISTS log_roles (role_id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS log_actions (action_id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS log_templates (template_id INTEGER PRIMARY KEY, template TEXT UNIQUE NOT NULL)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS logs_compact (
+            log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            role_id INTEGER,
+            action_id INTEGER,
+            ts INTEGER,
+            template_id INTEGER,
+            args TEXT,
+            details TEXT
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_compact_ts ON logs_compact(ts)")
+
+    if _object_type(cursor, "logs") == "table":
+        cache = {}
+        rows = cursor.execute(
+            "SELECT log_id, user_id, role, action, details, timestamp_epoch FROM logs ORDER BY log_id"
+        ).fetchall()
+        for start in range(0, len(rows), batch_size):
+            cursor.executemany(
+                "INSERT INTO logs_compact (log_id, user_id, role_id, action_id, ts, template_id, args, details) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(log_id, *_compact_log_row(cursor, user_id, role, action, details, epoch, cache))
+                 for log_id, user_id, role, action, details, epoch in rows[start:start + batch_size]]
+            )
+        # Keep handing out ids above any the old table ever used
+        cursor.execute("""
+            UPDATE sqlite_sequence SET seq = MAX(seq, COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'logs'), 0))
+            WHERE name = 'logs_compact'
+        """)
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'logs'")
+        cursor.execute("DROP TABLE logs")
+
+    args = ", ".join(f"json_extract(c.args, '$[{i}]')" for i in range(LOG_TEMPLATE_MAX_PARAMS))
+    cursor.execute("DROP VIEW IF EXISTS logs")
+    cursor.execute(f'''
+        CREATE VIEW logs AS
+        SELECT c.log_id AS log_id,
+               c.user_id AS user_id,
+               (SELECT name FROM log_roles WHERE role_id = c.role_id) AS role,
+               (SELECT name FROM log_actions WHERE action_id = c.action_id) AS action,
+               strftime('%Y-%m-%d %H:%M:%S', c.ts, 'unixepoch') AS timestamp,
+               CASE WHEN c.template_id IS NULL THEN c.details
+                    WHEN c.args IS NULL THEN (SELECT template FROM log_templates WHERE template_id = c.template_id)
+                    ELSE printf((SELECT template FROM log_templates WHERE template_id = c.template_id), {args}) END AS details,
+               c.ts AS timestamp_epoch
+        FROM logs_compact c
+    ''')
+    # Writers that still INSERT INTO logs keep working; details are stored raw.
+    cursor.execute('''
+        CREATE TRIGGER logs_insert INSTEAD OF INSERT ON logs BEGIN
+            INSERT OR IGNORE INTO log_roles (name) SELECT NEW.role WHERE NEW.role IS NOT NULL;
+            INSERT OR IGNORE INTO log_actions (name) SELECT NEW.action WHERE NEW.action IS NOT NULL;
+            INSERT INTO logs_compact (log_id, user_id, role_id, action_id, ts, details)
+            VALUES (
+                NEW.log_id, NEW.user_id,
+                (SELECT role_id FROM log_roles WHERE name = NEW.role),
+                (SELECT action_id FROM log_actions WHERE name = NEW.action),
+                COALESCE(NEW.timestamp_epoch, CAST(strftime('%s', NEW.timestamp) AS INTEGER)),
+                NEW.details
+            );
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER logs_delete INSTEAD OF DELETE ON logs BEGIN
+            DELETE FROM logs_compact WHERE log_id = OLD.log_id;
+        END
+    ''')
+
+
+def ensure_schema():
+    """Run migrate_schema once per process for the configured database."""
+    if DB_PATH in _migrated:
+        return
+    migrate_schema()
+    _migrated.add(DB_PATH)
@@ -1,8 +1,16 @@
 import os
 
-db_path = "D:\\hospital_project\\database.db"
-if os.path.exists(db_path):
+from db import DB_PATH, database_file
+
+db_path = database_file()
+if db_path is None:
+    print(f"{DB_PATH} is an in-memory database; it is gone when the process exits.")
+elif os.path.exists(db_path):
     os.remove(db_path)
+    # WAL-mode databases leave these next to the file
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
     print("Database deleted.")
 else:
     print("Database file does not exist.")
@@ -0,0 +1,188 @@
+# diagnoses.py
+"""
+Coded diagnosis dictionary.
+
+Free-text diagnoses are normalized (case and whitespace) and looked up in
+`diagnosis_synonyms`, which maps every known spelling to an integer code in `diagnoses`.
+Unknown text gets a code of its own; add_synonym() later folds it into an existing
+diagnosis. Patients carry the code in `diagnosis_code`, so per-diagnosis statistics
+group by an integer however many spellings are in use. The dictionary lives in the
+primary database, so codes are the same on every shard.
+"""
+import json
+import re
+
+# Canonical name -> spellings seeded into a new dictionary (the name itself is always one)
+BUILTIN_DIAGNOSES = {
+    "Influenza": ("flu", "the flu", "influenza-like illness"),
+    "Common cold": ("cold", "head cold"),
+    "Hypertension": ("high blood pressure", "htn"),
+    "Type 2 diabetes": ("diabetes", "t2dm", "diabetes mellitus type 2"),
+    "Asthma": (),
+    "COVID-19": ("covid", "covid19", "sars-cov-2"),
+    "Migraine": (),
+    "Pneumonia": (),
+}
+
+UNCODED = "Uncoded"
+
+
+def normalize_diagnosis(text):
+    """Lookup form of a diagnosis: lower case, single spaces, trimmed ('' for None)."""
+    return re.sub(r"\s+", " ", text or "").strip().lower()
+
+
+def seed_dictionary(cursor):
+    """Add the built-in diagnoses and spellings that are not in the dictionary yet."""
+    for name, spellings in BUILTIN_DIAGNOSES.items():
+        row = cursor.execute("SELECT diagnosis_code FROM diagnosis_synonyms WHERE synonym = ?",
+                             (normalize_diagnosis(name),)).fetchone()
+        if row:
+            code = row[0]
+        else:
+            code = cursor.execute("INSERT INTO diagnoses (name) VALUES (?)", (name,)).lastrowid
+        cursor.executemany(
+            "INSERT OR IGNORE INTO diagnosis_synonyms (synonym, diagnosis_code) VALUES (?, ?)",
+            [(normalize_diagnosis(s), code) for s in (name, *spellings)]
+        )
+
+
+def _lookup(conn, keys):
+    return dict(conn.execute(
+        "SELECT synonym, diagnosis_code FROM diagnosis_synonyms WHERE synonym IN (SELECT value FROM json_each(?))",
+        (json.dumps(sorted(keys)),)
+    ).fetchall())
+
+
+def resolve_codes(texts):
+    """
+    {text: diagnosis_code} for the given diagnoses (None for empty text), adding unknown
+    spellings to the dictionary. Uses its own primary connection, so call it before
+    opening the write transaction that stores the codes.
+    """
+    import db
+
+    keys = {text: normalize_diagnosis(text) for text in set(texts)}
+    wanted = {key for key in keys.values() if key}
+    if not wanted:
+        return {text: None for text in keys}
+    conn = db.get_connection()
+    try:
+        codes = _lookup(conn, wanted)
+        if len(codes) < len(wanted):
+            # Re-check under the write lock so concurrent writers agree on one code per spelling
+            conn.execute("BEGIN IMMEDIATE")
+            codes = _lookup(conn, wanted)
+            for text, key in sorted(keys.items(), key=lambda item: (item[1], item[0] or "")):
+                if key and key not in codes:
+                    name = re.sub(r"\s+", " ", text).strip()
+                    codes[key] = conn.execute("INSERT INTO diagnoses (name) VALUES (?)", (name,)).lastrowid
+                    conn.execute("INSERT INTO diagnosis_synonyms (synonym, diagnosis_code) VALUES (?, ?)", (key, codes[key]))
+            conn.commit()
+    finally:
+        conn.close()
+    return {text: codes.get(key) for text, key in keys.items()}
+
+
+def resolve_code(text):
+    return resolve_codes([text])[text]
+
+
+def diagnosis_names(codes=None):
+    """{diagnosis_code: canonical name}, for the given codes or the whole dictionary."""
+    import db
+
+    conn = db.get_read_connection()
+    try:
+        if codes is None:
+            return dict(conn.execute("SELECT diagnosis_code, name FROM diagnoses").fetchall())
+        return dict(conn.execute(
+            "SELECT diagnosis_code, name FROM diagnoses WHERE diagnosis_code IN (SELECT value FROM json_each(?))",
+            (json.dumps([c for c in codes if c is not None]),)
+        ).fetchall())
+    finally:
+        conn.close()
+
+
+def add_synonym(spelling, diagnosis):
+    """
+    Make `spelling` another name for `diagnosis` (a canonical name or a known spelling).
+    Patients coded with the spelling's old code move to the target code, and the old
+    code is dropped once nothing maps to it. Returns the number of patients re-coded.
+    """
+    import db
+
+    key, target_key = normalize_diagnosis(spelling), normalize_diagnosis(diagnosis)
+    if not key or not target_key:
+        raise ValueError("Both the spelling and the diagnosis are required")
+    conn = db.get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        target = conn.execute("""
+            SELECT diagnosis_code FROM diagnoses WHERE LOWER(name) = ?
+            UNION ALL SELECT diagnosis_code FROM diagnosis_synonyms WHERE synonym = ?
+            LIMIT 1
+        """, (target_key, target_key)).fetchone()
+        if target is None:
+            raise ValueError(f"Unknown diagnosis {diagnosis!r}")
+        target = target[0]
+        old = conn.execute("SELECT diagnosis_code FROM diagnosis_synonyms WHERE synonym = ?", (key,)).fetchone()
+        conn.execute("INSERT OR REPLACE INTO diagnosis_synonyms (synonym, diagnosis_code) VALUES (?, ?)", (key, target))
+        old = old[0] if old and old[0] != target else None
+        dropped = old is not None and conn.execute("""
+            DELETE FROM diagnoses WHERE diagnosis_code = ?
+            AND NOT EXISTS (SELECT 1 FROM diagnosis_synonyms WHERE diagnosis_code = ?)
+        """, (old, old)).rowcount == 1
+        conn.commit()
+    finally:
+        conn.close()
+
+    if old is None:
+        return 0
+    recoded = 0
+    for patient_conn in db.patient_connections():
+        rows = patient_conn.execute("SELECT patient_id, diagnosis FROM patients WHERE diagnosis_code = ?", (old,)).fetchall()
+        # The old code may still stand for other spellings; only this one moves
+        ids = [(target, pid) for pid, text in rows if dropped or normalize_diagnosis(text) == key]
+        patient_conn.executemany("UPDATE patients SET diagnosis_code = ? WHERE patient_id = ?", ids)
+        patient_conn.commit()
+        patient_conn.close()
+        recoded += len(ids)
+    return recoded
+
+
+def backfill_diagnosis_codes(progress=None, batch_size=500):
+    """
+    Code patients whose diagnosis_code is still NULL (rows written before coding existed).
+    Commits every batch_size rows and calls progress(done, total) after each batch.
+    Returns the number of patients coded.
+    """
+    import db
+
+    conns = db.patient_connections()
+    count = 0
+    try:
+        pending = [
+            conn.execute("""
+                SELECT patient_id, diagnosis FROM patients
+                WHERE diagnosis_code IS NULL AND diagnosis IS NOT NULL AND diagnosis != ''
+            """).fetchall()
+            for conn in conns
+        ]
+        total = sum(len(rows) for rows in pending)
+        for conn, rows in zip(conns, pending):
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                codes = resolve_codes(diagnosis for _, diagnosis in batch)
+                conn.executemany(
+                    "UPDATE patients SET diagnosis_code = ? WHERE patient_id = ? AND diagnosis_code IS NULL",
+                    [(codes[diagnosis], pid) for pid, diagnosis in batch]
+                )
+                conn.commit()
+                count += len(batch)
+                if progress:
+                    progress(count, total)
+    finally:
+        for conn in conns:
+            conn.close()
+    return count
@@ -0,0 +1,290 @@
+# hms.py
+"""
+Command-line entry point for admin operations, for cron jobs and scripts that should
+not boot Streamlit:
+
+    python -m hms init                      # create tables and apply migrations
+    python -m hms migrate
+    python -m hms seed
+    python -m hms anonymize
+    python -m hms code-diagnoses
+    python -m hms retention 365
+    python -m hms export patients --output patients_backup.csv
+    python -m hms export logs --since "2026-10-01" --output -
+    python -m hms export logs --incremental
+    python -m hms export snapshot           # Parquet + Arrow files for analytics (needs pyarrow)
+    python -m hms stats --json
+    python -m hms perf perf.jsonl           # server time per rerun, from HMS_PERF_LOG
+
+Each subcommand imports only what it needs (init, migrate, code-diagnoses, retention,
+log exports and stats never load pandas or cryptography). Progress goes to stderr,
+results to stdout. Exit status is 0 on success, 1 when the operation fails and 2 for usage errors.
+"""
+import argparse
+import csv
+import json
+import statistics
+import sys
+
+import db
+import sqltrace
+
+CLI_ROLE = "cli"
+
+
+def _progress(label):
+    def report(done, total):
+        print(f"{label}: {done}/{total}", file=sys.stderr, flush=True)
+    return report
+
+
+def _audit(action, details):
+    """Record a CLI operation in the audit log like the app's own admin actions."""
+    conn = db.get_connection()
+    db.insert_log(conn.cursor(), None, CLI_ROLE, action, details, db.now_epoch())
+    conn.commit()
+    conn.close()
+
+
+# -------------------- Commands --------------------
+def cmd_init(args):
+    conn = db.get_connection()
+    db.create_schema(conn)
+    conn.close()
+    print(f"Database ready at {db.DB_PATH}")
+
+
+def cmd_migrate(args):
+    db.migrate_schema()
+    print(f"Schema of {db.DB_PATH} is up to date")
+
+
+def cmd_seed(args):
+    from seed_data import seed
+
+    users, patients = seed()
+    print(f"Added {users} user(s) and {patients} patient(s)")
+
+
+def cmd_anonymize(args):
+    from utils import anonymize_all_unanonymized
+
+    count = anonymize_all_unanonymized(progress=_progress("anonymized"), batch_size=args.batch_size)
+    _audit("AnonymizeAll", f"Anonymized {count} patients")
+    print(f"Anonymized {count} patient(s)")
+
+
+def cmd_code_diagnoses(args):
+    from diagnoses import backfill_diagnosis_codes
+
+    count = backfill_diagnosis_codes(progress=_progress("coded"), batch_size=args.batch_size)
+    _audit("BackfillDiagnosisCodes", f"Coded {count} patients")
+    print(f"Coded {count} patient diagnos{'is' if count == 1 else 'es'}")
+
+
+def cmd_retention(args):
+    if args.days < 0:
+        raise ValueError("days must be zero or positive")
+    deleted = db.apply_data_retention(args.days)
+    _audit("ApplyRetention", json.dumps({"deleted": deleted, "retention_days": args.days}))
+    print(f"Deleted {deleted} patient(s) older than {args.days} day(s)")
+
+
+def _export_logs_csv(args):
+    """Stream the audit log as CSV, newest first, without building a DataFrame."""
+    lo, hi = db.time_range(start=args.since, end=args.until)
+    where, params = db.range_clause("timestamp_epoch", lo, hi)
+    conn = db.get_read_connection()
+    out = sys.stdout if args.output == "-" else open(args.output, "w", newline="", encoding="utf-8")
+    rows = 0
+    try:
+        cursor = conn.execute(f"SELECT * FROM logs WHERE {where} ORDER BY timestamp_epoch DESC", params)
+        writer = csv.writer(out)
+        writer.writerow(column[0] for column in cursor.description)
+        while True:
+            batch = cursor.fetchmany(5000)
+            if not batch:
+                break
+            writer.writerows(batch)
+            rows += len(batch)
+    finally:
+        conn.close()
+        if out is not sys.stdout:
+            out.close()
+    return rows
+
+
+def cmd_export(args):
+    if args.what == "patients":
+        from utils import export_patients_csv
+
+        if args.output == "-" or args.since or args.until or args.incremental:
+            raise ValueError("export patients takes only --output FILE")
+        path = export_patients_csv(args.output or "patients_backup.csv")
+        _audit("ExportPatients", path)
+        print(f"Exported patients to {path}")
+    elif args.what == "snapshot":
+        from snapshot_export import export_snapshot
+
+        if args.output == "-" or args.since or args.until or args.incremental:
+            raise ValueError("export snapshot takes only --output DIR")
+        manifest = export_snapshot(args.output)
+        rows = {table: entry["rows"] for table, entry in manifest["tables"].items()}
+        _audit("ExportSnapshot", json.dumps({"path": manifest["path"], "rows": rows}))
+        for table, count in rows.items():
+            print(f"{table}: {count} row(s)")
+        print(f"Wrote snapshot {manifest['path']}")
+    elif args.incremental:
+        from log_export import export_logs_incremental
+
+        if args.output or args.since or args.until:
+            raise ValueError("--incremental writes to the log export directory and takes no other options")
+        files = export_logs_incremental()
+        rows = sum(f["rows"] for f in files)
+        _audit("ExportLogsIncremental", json.dumps({"files": [f["file"] for f in files], "rows": rows}))
+        for f in files:
+            print(f"{f['file']}: {f['rows']} row(s)")
+        print(f"Exported {rows} new log entr{'y' if rows == 1 else 'ies'} in {len(files)} file(s)")
+    else:
+        args.output = args.output or "logs_export.csv"
+        rows = _export_logs_csv(args)
+        if args.output != "-":
+            _audit("ExportLogs", args.output)
+            print(f"Exported {rows} log entr{'y' if rows == 1 else 'ies'} to {args.output}")
+
+
+def cmd_perf(args):
+    """Per-scope server time from an HMS_PERF_LOG file written by app.py."""
+    samples = {}
+    with open(args.file, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                samples.setdefault(entry["scope"], []).append(entry["ms"])
+    if not samples:
+        raise ValueError(f"{args.file} has no timings")
+    print(f"{'scope':<28}{'runs':>7}{'median ms':>11}{'p95 ms':>10}")
+    for scope, values in sorted(samples.items()):
+        values.sort()
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        print(f"{scope:<28}{len(values):>7}{statistics.median(values):>11.1f}{p95:>10.1f}")
+
+
+def collect_stats():
+    """Row counts, job queue and file sizes of the configured database."""
+    from storage import active_profile_name
+
+    conn = db.get_connection()
+    try:
+        count = lambda sql: conn.execute(sql).fetchone()[0]
+        stats = {
+            "database": db.DB_PATH,
+            "storage_profile": active_profile_name(db.DB_PATH),
+            "users": count("SELECT COUNT(*) FROM users"),
+            "log_entries": count("SELECT COUNT(*) FROM logs_compact"),
+            "jobs": dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()),
+        }
+        page_size = count("PRAGMA page_size")
+        stats["file_bytes"] = count("PRAGMA page_count") * page_size
+        stats["free_bytes"] = count("PRAGMA freelist_count") * page_size
+    finally:
+        conn.close()
+    stats["patients"] = sum(db.fan_out_patients(
+        lambda c: c.execute("SELECT COUNT(*) FROM patients").fetchone()[0], primary=True
+    ))
+    stats["unanonymized_patients"] = sum(db.fan_out_patients(
+        lambda c: c.execute("SELECT COUNT(*) FROM patients WHERE anonymized_name IS NULL OR anonymized_name = ''").fetchone()[0],
+        primary=True,
+    ))
+    router = db.get_shard_router()
+    stats["shards"] = len(router) if router is not None else 0
+    return stats
+
+
+def cmd_stats(args):
+    stats = collect_stats()
+    if args.json:
+        print(json.dumps(stats, indent=2))
+        return
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            value = ", ".join(f"{k} {v}" for k, v in value.items()) or "-"
+        print(f"{key:<24}{value}")
+
+
+# -------------------- Entry point --------------------
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m hms", description="Hospital management admin operations")
+    parser.add_argument("--db", help=f"database file or SQLite URI (default HMS_DATABASE or {db.DB_PATH})")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("init", help="create a new database with the current schema").set_defaults(func=cmd_init)
+    sub.add_parser("migrate", help="apply pending schema migrations").set_defaults(func=cmd_migrate)
+    sub.add_parser("seed", help="insert the example users and patients").set_defaults(func=cmd_seed)
+
+    anonymize = sub.add_parser("anonymize", help="encrypt and mask patients that are not anonymized yet")
+    anonymize.add_argument("--batch-size", type=int, default=500)
+    anonymize.set_defaults(func=cmd_anonymize)
+
+    code = sub.add_parser("code-diagnoses", help="fill diagnosis_code for patients written before coding")
+    code.add_argument("--batch-size", type=int, default=500)
+    code.set_defaults(func=cmd_code_diagnoses)
+
+    retention = sub.add_parser("retention", help="delete patients added more than DAYS days ago")
+    retention.add_argument("days", type=int)
+    retention.set_defaults(func=cmd_retention)
+
+    export = sub.add_parser("export", help="export patients or audit logs to CSV, or an analytics snapshot")
+    export.add_argument("what", choices=("patients", "logs", "snapshot"))
+    export.add_argument("--output", help='file to write ("-" for stdout, logs only; a directory for snapshot)')
+    export.add_argument("--since", help="logs only: first timestamp to include")
+    export.add_argument("--until", help="logs only: timestamp to stop before")
+    export.add_argument("--incremental", action="store_true",
+                        help="logs only: append entries not exported yet to the log export directory")
+    export.set_defaults(func=cmd_export)
+
+    perf = sub.add_parser("perf", help="summarize server time per rerun from an HMS_PERF_LOG file")
+    perf.add_argument("file")
+    perf.set_defaults(func=cmd_perf)
+
+    stats = sub.add_parser("stats", help="show row counts, job queue and database size")
+    stats.add_argument("--json", action="store_true")
+    stats.set_defaults(func=cmd_stats)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.db:
+        db.configure_database(args.db, db.DB_SNAPSHOT)
+    if args.command == "perf":
+        # Reads a log file only; no database needed
+        try:
+            args.func(args)
+        except (OSError, ValueError) as exc:
+            print(f"error: {exc}", file=sys.stderr)
+            return 1
+        return 0
+    if args.command != "init" and not db.database_exists():
+        print(f"error: {db.DB_PATH} does not exist; run `python -m hms init` first", file=sys.stderr)
+        return 1
+    try:
+        if args.command not in ("init", "migrate"):
+            db.ensure_schema()
+        args.func(args)
+        sqltrace.flush()
+    except KeyboardInterrupt:
+        print("interrupted", file=sys.stderr)
+        return 130
+    except BrokenPipeError:
+        # e.g. `export logs --output - | head`
+        sys.stderr.close()
+        return 1
+    except Exception as exc:
+        print(f"error: {exc}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,451 @@
+# jobs.py
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+from db import get_connection, now_epoch
+from storage import PROFILES
+
+JOB_STATUSES = ("queued", "running", "succeeded", "failed", "cancelled")
+JOB_COLUMNS = (
+    "job_id", "kind", "params", "status", "progress", "message", "result",
+    "submitted_by", "submitted_role", "schedule_id", "created_at", "started_at", "finished_at",
+    "cancel_requested",
+)
+
+# Runners refresh heartbeat_at on their running jobs every HEARTBEAT_INTERVAL seconds; a
+# running job whose heartbeat is older than HEARTBEAT_TIMEOUT lost its worker.
+HEARTBEAT_INTERVAL = float(os.environ.get("HMS_JOB_HEARTBEAT_INTERVAL", "10"))
+# One beat period is the interval plus a busy_timeout wait for each of the heartbeat and
+# the recovery sweep, so a job survives HEARTBEAT_MISSES - 1 beats lost to a busy database.
+# HMS_JOB_HEARTBEAT_TIMEOUT can only raise the timeout.
+HEARTBEAT_MISSES = 3
+_BUSY_SECONDS = max(profile.get("busy_timeout", 0) for profile in PROFILES.values()) / 1000
+HEARTBEAT_TIMEOUT = max(
+    float(os.environ.get("HMS_JOB_HEARTBEAT_TIMEOUT", "0")),
+    HEARTBEAT_MISSES * (HEARTBEAT_INTERVAL + 2 * _BUSY_SECONDS),
+)
+
+# kind -> (function, audit action). Functions are called as func(ctx, **params).
+JOB_KINDS = {}
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when an admin has asked for it to stop."""
+
+
+def job_kind(name, audit_action=None):
+    """Register a function as a job kind. audit_action, if given, is logged when the job succeeds."""
+    def register(func):
+        JOB_KINDS[name] = (func, audit_action)
+        return func
+    return register
+
+
+class JobContext:
+    """Handed to every job function for progress reporting and cancellation checks."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self._last_write = 0.0
+
+    def cancelled(self):
+        conn = get_connection()
+        row = conn.execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (self.job_id,)).fetchone()
+        conn.close()
+        return bool(row and row[0])
+
+    def progress(self, fraction, message=None):
+        """
+        Record progress (0..1). Writes are throttled to a few per second; raises
+        JobCancelled if cancellation was requested.
+        """
+        now = time.monotonic()
+        if now - self._last_write >= 0.5 or fraction >= 1:
+            self._last_write = now
+            conn = get_connection()
+            conn.execute(
+                "UPDATE jobs SET progress = ?, message = COALESCE(?, message) WHERE job_id = ?",
+                (min(max(fraction, 0.0), 1.0), message, self.job_id)
+            )
+            conn.commit()
+            conn.close()
+            if self.cancelled():
+                raise JobCancelled()
+
+
+# -------------------- Submission & status --------------------
+def _as_job(row):
+    job = dict(zip(JOB_COLUMNS, row))
+    job["params"] = json.loads(job["params"]) if job["params"] else {}
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+def submit_job(kind, params=None, user_id=None, role=None, schedule_id=None):
+    """Queue a job and return its id; a running JobRunner picks it up."""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job kind {kind!r}")
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO jobs (kind, params, submitted_by, submitted_role, schedule_id, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (kind, json.dumps(params or {}), user_id, role, schedule_id, now_epoch()))
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+
+def get_job(job_id):
+    conn = get_connection()
+    row = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    conn.close()
+    return _as_job(row) if row else None
+
+
+def list_jobs(limit=20, kinds=None):
+    """Most recent jobs first."""
+    sql = f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs"
+    params = []
+    if kinds:
+        sql += f" WHERE kind IN ({','.join('?' * len(kinds))})"
+        params.extend(kinds)
+    sql += " ORDER BY job_id DESC LIMIT ?"
+    params.append(limit)
+    conn = get_connection()
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    return [_as_job(row) for row in rows]
+
+
+def cancel_job(job_id):
+    """Cancel a queued job immediately, or ask a running one to stop at its next progress report."""
+    conn = get_connection()
+    conn.execute(
+        "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE job_id = ? AND status = 'queued'",
+        (now_epoch(), job_id)
+    )
+    conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND status = 'running'", (job_id,))
+    conn.commit()
+    conn.close()
+
+
+# -------------------- Recurring jobs --------------------
+def schedule_job(kind, params=None, every_seconds=86400, first_run=None, user_id=None, role=None):
+    """Run kind every every_seconds, first at epoch first_run (default: one interval from now)."""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job kind {kind!r}")
+    next_run = first_run if first_run is not None else now_epoch() + every_seconds
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO job_schedules (kind, params, every_seconds, next_run, submitted_by, submitted_role)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (kind, json.dumps(params or {}), every_seconds, next_run, user_id, role))
+    schedule_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return schedule_id
+
+
+def unschedule_job(schedule_id):
+    conn = get_connection()
+    conn.execute("DELETE FROM job_schedules WHERE schedule_id = ?", (schedule_id,))
+    conn.commit()
+    conn.close()
+
+
+def list_schedules(kind=None):
+    sql = "SELECT schedule_id, kind, params, every_seconds, next_run FROM job_schedules"
+    params = []
+    if kind:
+        sql += " WHERE kind = ?"
+        params.append(kind)
+    conn = get_connection()
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    return [
+        {"schedule_id": r[0], "kind": r[1], "params": json.loads(r[2] or "{}"), "every_seconds": r[3], "next_run": r[4]}
+        for r in rows
+    ]
+
+
+def _enqueue_due_schedules():
+    """Submit every schedule whose next_run has passed and move it forward atomically."""
+    now = now_epoch()
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    due = conn.execute(
+        "SELECT schedule_id, kind, params, every_seconds, next_run, submitted_by, submitted_role "
+        "FROM job_schedules WHERE next_run <= ?", (now,)
+    ).fetchall()
+    for schedule_id, kind, params, every, next_run, user_id, role in due:
+        if kind not in JOB_KINDS:
+            continue
+        # Skip missed runs instead of replaying them all after downtime
+        while next_run <= now:
+            next_run += every
+        conn.execute("UPDATE job_schedules SET next_run = ? WHERE schedule_id = ?", (next_run, schedule_id))
+        conn.execute("""
+            INSERT INTO jobs (kind, params, submitted_by, submitted_role, schedule_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (kind, params, user_id, role, schedule_id, now))
+    conn.commit()
+    conn.close()
+
+
+# -------------------- Worker pool --------------------
+class JobRunner:
+    """
+    Worker threads that claim queued jobs from the jobs table and run them. Claims
+    are atomic, so several processes (e.g. `python jobs.py` workers next to the app)
+    can share the same queue. Each claim records the runner's worker_id, and a
+    heartbeat thread keeps those jobs' heartbeat_at fresh while they run.
+    """
+
+    def __init__(self, workers=2, poll_interval=1.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _claim(self):
+        now = now_epoch()
+        conn = get_connection()
+        row = conn.execute("""
+            UPDATE jobs SET status = 'running', started_at = ?, worker_id = ?, heartbeat_at = ?
+            WHERE job_id = (SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY job_id LIMIT 1)
+              AND status = 'queued'
+            RETURNING job_id, kind, params, submitted_by, submitted_role
+        """, (now, self.worker_id, now)).fetchone()
+        conn.commit()
+        conn.close()
+        return row
+
+    def _heartbeat(self):
+        conn = get_connection()
+        conn.execute(
+            "UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND worker_id = ?",
+            (now_epoch(), self.worker_id)
+        )
+        conn.commit()
+        conn.close()
+
+    def _heartbeat_loop(self):
+        while not self._stop.is_set():
+            try:
+                self._heartbeat()
+                _recover_interrupted_jobs()
+            except sqlite3.OperationalError:
+                # Database busy; the next beat is well within the timeout
+                pass
+            self._stop.wait(HEARTBEAT_INTERVAL)
+
+    def _finish(self, job_id, status, result=None, message=None):
+        """
+        Record the outcome of a job this runner still holds. Returns False when the job
+        was meanwhile recovered as interrupted (e.g. after missed heartbeats), which stands.
+        """
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE jobs SET status = ?, result = ?, message = COALESCE(?, message), finished_at = ?,
+                            progress = CASE WHEN ? = 'succeeded' THEN 1 ELSE progress END
+            WHERE job_id = ? AND status = 'running' AND worker_id = ?
+        """, (status, json.dumps(result) if result is not None else None, message, now_epoch(), status, job_id,
+              self.worker_id))
+        finished = cursor.rowcount == 1
+        conn.commit()
+        conn.close()
+        return finished
+
+    def run_one(self):
+        """Claim and run a single queued job. Returns False when the queue was empty."""
+        claimed = self._claim()
+        if not claimed:
+            return False
+        job_id, kind, params, user_id, role = claimed
+        func, audit_action = JOB_KINDS.get(kind, (None, None))
+        if func is None:
+            self._finish(job_id, "failed", message=f"Unknown job kind {kind!r}")
+            return True
+        try:
+            result = func(JobContext(job_id), **json.loads(params or "{}"))
+        except JobCancelled:
+            self._finish(job_id, "cancelled", message="Cancelled by user")
+        except Exception as e:
+            self._finish(job_id, "failed", message=f"{e}\n{traceback.format_exc(limit=3)}")
+        else:
+            if self._finish(job_id, "succeeded", result=result) and audit_action:
+                from utils import log_action
+                log_action(user_id, role, audit_action, f"Job {job_id}: {json.dumps(result)}")
+        return True
+
+    def _loop(self, schedules):
+        while not self._stop.is_set():
+            try:
+                if schedules:
+                    _enqueue_due_schedules()
+                if self.run_one():
+                    continue
+            except sqlite3.OperationalError:
+                # Database busy; try again on the next tick
+                pass
+            self._stop.wait(self.poll_interval)
+
+    def start(self):
+        if self._threads:
+            return self
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, args=(i == 0,), name=f"hms-job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat_loop, name="hms-job-heartbeat", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+_runner = None
+
+
+def start_job_runner(workers=2):
+    """Start the in-process worker pool once; later calls return the same runner."""
+    global _runner
+    if _runner is None:
+        _runner = JobRunner(workers).start()
+    return _runner
+
+
+def _recover_interrupted_jobs(timeout=None):
+    """
+    Jobs whose runner stopped sending heartbeats (its process exited or hung) can never
+    finish; mark them failed. Jobs held by live runners in other processes are left alone.
+    """
+    timeout = HEARTBEAT_TIMEOUT if timeout is None else timeout
+    now = now_epoch()
+    conn = get_connection()
+    conn.execute(
+        "UPDATE jobs SET status = 'failed', message = 'Interrupted (worker exited)', finished_at = ? "
+        "WHERE status = 'running' AND COALESCE(heartbeat_at, started_at, 0) < ?", (now, now - timeout)
+    )
+    conn.commit()
+    conn.close()
+
+
+# -------------------- Built-in job kinds --------------------
+@job_kind("anonymize", audit_action="AnonymizeAll")
+def _anonymize_job(ctx):
+    from utils import anonymize_all_unanonymized
+    count = anonymize_all_unanonymized(progress=lambda done, total: ctx.progress(done / total, f"{done}/{total} records"))
+    return {"anonymized": count}
+
+
+@job_kind("diagnosis_codes", audit_action="BackfillDiagnosisCodes")
+def _diagnosis_codes_job(ctx):
+    from diagnoses import backfill_diagnosis_codes
+    count = backfill_diagnosis_codes(progress=lambda done, total: ctx.progress(done / total, f"{done}/{total} records"))
+    return {"coded": count}
+
+
+@job_kind("retention", audit_action="ApplyRetention")
+def _retention_job(ctx, retention_days):
+    from db import apply_data_retention
+    ctx.progress(0, f"Deleting records older than {retention_days} days")
+    deleted = apply_data_retention(retention_days)
+    return {"deleted": deleted, "retention_days": retention_days}
+
+
+@job_kind("export_patients", audit_action="ExportPatients")
+def _export_patients_job(ctx, filepath="patients_backup.csv"):
+    from utils import export_patients_csv
+    ctx.progress(0, "Exporting patients")
+    return {"file": export_patients_csv(filepath)}
+
+
+@job_kind("export_logs", audit_action="ExportLogs")
+def _export_logs_job(ctx, filepath="logs_export.csv"):
+    from utils import get_logs_df
+    ctx.progress(0, "Exporting logs")
+    get_logs_df().to_csv(filepath, index=False)
+    return {"file": filepath}
+
+
+@job_kind("export_logs_incremental", audit_action="ExportLogsIncremental")
+def _export_logs_incremental_job(ctx):
+    from log_export import export_logs_incremental
+    ctx.progress(0, "Exporting new log entries")
+    files = export_logs_incremental()
+    return {"files": [f["file"] for f in files], "rows": sum(f["rows"] for f in files)}
+
+
+@job_kind("export_snapshot", audit_action="ExportSnapshot")
+def _export_snapshot_job(ctx, formats=("parquet", "arrow")):
+    from snapshot_export import export_snapshot
+    ctx.progress(0, "Writing Parquet / Arrow snapshot")
+    manifest = export_snapshot(formats=tuple(formats))
+    return {"path": manifest["path"], "rows": {t: entry["rows"] for t, entry in manifest["tables"].items()}}
+
+
+@job_kind("cdc_compact", audit_action="CompactChanges")
+def _cdc_compact_job(ctx, max_age_days=None):
+    from cdc import CHANGE_MAX_AGE_SECONDS, compact_all
+    ctx.progress(0, "Compacting the change feed")
+    max_age = CHANGE_MAX_AGE_SECONDS if max_age_days is None else max_age_days * 86400
+    return {"deleted": compact_all(max_age)}
+
+
+@job_kind("maintenance", audit_action="DatabaseMaintenance")
+def _maintenance_job(ctx):
+    from cdc import compact_all
+    from storage import run_maintenance
+    # Compact first so the vacuum below reclaims the freed pages
+    ctx.progress(0, "Compacting the change feed")
+    changes_deleted = compact_all()
+    ctx.progress(0.1, "Optimizing and vacuuming")
+    reports = run_maintenance()
+    return {
+        "changes_deleted": changes_deleted,
+        "files": len(reports),
+        "reclaimed_bytes": sum(r["reclaimed_bytes"] for r in reports),
+        "reclaimed_pages": sum(r["reclaimed_pages"] for r in reports),
+        "file_bytes": sum(r["after"]["file_bytes"] for r in reports),
+    }
+
+
+@job_kind("backup", audit_action="Backup")
+def _backup_job(ctx):
+    from backup import create_backup
+    entry = create_backup(progress=lambda remaining, total: ctx.progress(1 - remaining / total if total else 1, "Copying pages"))
+    return {"file": entry["file"], "bytes": entry["bytes"], "integrity": entry["integrity"]}
+
+
+if __name__ == "__main__":
+    # Standalone worker process sharing the queue with the app
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run background job workers")
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+    runner = JobRunner(args.workers).start()
+    print(f"Job runner started with {args.workers} worker(s). Press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        runner.stop()
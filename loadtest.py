@@ -0,0 +1,386 @@
+# loadtest.py
+"""
+Concurrent multi-session load test for the utils.py helpers.
+
+Simulates receptionists, doctors and admins working at the same time against a
+throwaway copy of the database, spread over several threads and processes, and
+reports throughput, latency percentiles, lock retries and error rates per operation.
+
+    python loadtest.py run --mix receptionist=30,doctor=10,admin=1 --duration 30 --processes 4 --report before.json
+    python loadtest.py compare before.json after.json
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import db
+
+PASSWORD = "loadtest"
+DIAGNOSES = ("Flu", "Cold", "Asthma", "Diabetes", "Hypertension", "Migraine", "Fracture")
+
+# Operations each role performs, with relative weights
+ROLE_WORKLOADS = {
+    "receptionist": {"add_patient": 5, "edit_patient": 4, "login": 1},
+    "doctor": {"doctor_listing": 8, "view_patient": 2, "login": 1},
+    "admin": {"admin_dashboard": 4, "view_patient": 2, "login": 1},
+}
+DEFAULT_MIX = "receptionist=30,doctor=10,admin=1"
+
+
+# -------------------- Operations --------------------
+# Each operation takes the session dict and returns an outcome label ("ok", "conflict", ...).
+def _op_login(session):
+    from utils import check_user_password, log_action
+    conn = db.get_connection()
+    row = conn.execute("SELECT user_id, role FROM users WHERE username = ?", (session["username"],)).fetchone()
+    conn.close()
+    if not row or not check_user_password(row[0], PASSWORD):
+        raise RuntimeError(f"login failed for {session['username']}")
+    log_action(row[0], row[1], "Login", "User logged in")
+    return "ok"
+
+
+def _op_add_patient(session):
+    from utils import insert_patient, log_action
+    rng = session["rng"]
+    pid = insert_patient(
+        f"Patient {rng.randrange(10**6)}", f"555-{rng.randrange(10**7):07d}", rng.choice(DIAGNOSES), datetime.now()
+    )
+    log_action(session["user_id"], session["role"], "AddPatient", f"Added patient_id {pid}")
+    session["max_patient_id"] = max(session["max_patient_id"], pid)
+    return "ok"
+
+
+def _op_edit_patient(session):
+    from utils import get_patient_by_id, update_patient, log_action, UPDATE_OK
+    rng = session["rng"]
+    pid = rng.randint(1, session["max_patient_id"])
+    patient = get_patient_by_id(pid)
+    if patient is None:
+        return "not_found"
+    result = update_patient(pid, diagnosis=rng.choice(DIAGNOSES), expected_version=patient["row_version"])
+    if result["status"] == UPDATE_OK:
+        log_action(session["user_id"], session["role"], "UpdatePatient", f"Updated patient_id {pid}")
+    return result["status"]
+
+
+def _op_view_patient(session):
+    from utils import get_patient_by_id
+    patient = get_patient_by_id(session["rng"].randint(1, session["max_patient_id"]))
+    return "ok" if patient else "not_found"
+
+
+def _op_doctor_listing(session):
+    from utils import get_patients_for_doctor
+    get_patients_for_doctor()
+    return "ok"
+
+
+def _op_admin_dashboard(session):
+    from utils import get_logs_df, count_patients, count_patients_by_day, time_range
+    lo, hi = time_range(last_days=7)
+    get_logs_df(lo, hi)
+    count_patients()
+    count_patients_by_day(lo, hi)
+    return "ok"
+
+
+OPERATIONS = {
+    "login": _op_login,
+    "add_patient": _op_add_patient,
+    "edit_patient": _op_edit_patient,
+    "view_patient": _op_view_patient,
+    "doctor_listing": _op_doctor_listing,
+    "admin_dashboard": _op_admin_dashboard,
+}
+
+
+def _is_lock_error(error):
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+# -------------------- Throwaway database --------------------
+def prepare_database(workdir, source=None, patients=200, mix=None):
+    """
+    Create the test database in workdir: a backup of `source` if given, otherwise a new
+    schema seeded with `patients` patients. One user per simulated session is added.
+    Returns the database path.
+    """
+    from utils import encrypt_field, insert_patient
+
+    path = os.path.join(workdir, "loadtest.db")
+    conn = sqlite3.connect(path)
+    if source:
+        src = sqlite3.connect(source)
+        src.backup(conn)
+        src.close()
+    db.configure_database(path, shard_dir=workdir)
+    db.create_schema(conn)
+    for role, count in (mix or {}).items():
+        for i in range(count):
+            conn.execute(
+                "INSERT OR IGNORE INTO users (username, password, role) VALUES (?, ?, ?)",
+                (f"lt_{role}_{i}", encrypt_field(PASSWORD), role)
+            )
+    conn.commit()
+    conn.close()
+
+    rng = random.Random(0)
+    for i in range(patients):
+        insert_patient(f"Seed Patient {i}", f"555-{rng.randrange(10**7):07d}", rng.choice(DIAGNOSES), datetime.now())
+    return path
+
+
+# -------------------- Sessions --------------------
+def _run_session(session, deadline, think_time, max_retries, stats, lock):
+    rng = session["rng"]
+    ops, weights = zip(*ROLE_WORKLOADS[session["role"]].items())
+    while time.monotonic() < deadline:
+        name = rng.choices(ops, weights)[0]
+        retries = 0
+        start = time.perf_counter()
+        while True:
+            try:
+                outcome = OPERATIONS[name](session)
+                break
+            except Exception as e:
+                if _is_lock_error(e) and retries < max_retries:
+                    retries += 1
+                    time.sleep(rng.uniform(0, 0.05 * retries))
+                    continue
+                outcome = f"error: {type(e).__name__}: {e}"
+                break
+        elapsed = time.perf_counter() - start
+        with lock:
+            entry = stats.setdefault(name, {"latencies": [], "lock_retries": 0, "outcomes": {}})
+            entry["latencies"].append(elapsed)
+            entry["lock_retries"] += retries
+            key = outcome if not outcome.startswith("error") else "error"
+            entry["outcomes"][key] = entry["outcomes"].get(key, 0) + 1
+            if key == "error":
+                entry.setdefault("errors", []).append(outcome)
+        if think_time:
+            time.sleep(rng.expovariate(1 / think_time))
+
+
+def run_worker(db_path, sessions, duration, think_time, max_retries, seed):
+    """
+    Run the given sessions as threads in this process for `duration` seconds.
+    sessions is a list of (role, username); returns raw per-operation stats.
+    """
+    db.configure_database(db_path, shard_dir=os.path.dirname(db_path))
+    conn = db.get_connection()
+    users = dict(conn.execute("SELECT username, user_id FROM users").fetchall())
+    conn.close()
+    max_pid = max(1, _max_patient_id())
+
+    stats, lock = {}, threading.Lock()
+    deadline = time.monotonic() + duration
+    threads = []
+    for i, (role, username) in enumerate(sessions):
+        session = {
+            "role": role, "username": username, "user_id": users.get(username),
+            "rng": random.Random(seed * 100_003 + i), "max_patient_id": max_pid,
+        }
+        thread = threading.Thread(
+            target=_run_session, args=(session, deadline, think_time, max_retries, stats, lock), daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return stats
+
+
+def _max_patient_id():
+    highest = 0
+    for conn in db.patient_connections():
+        highest = max(highest, conn.execute("SELECT COALESCE(MAX(patient_id), 0) FROM patients").fetchone()[0])
+        conn.close()
+    return highest
+
+
+# -------------------- Reporting --------------------
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(stats, duration):
+    """Per-operation throughput, latency percentiles (ms), lock retries and error rate."""
+    operations = {}
+    for name, entry in sorted(stats.items()):
+        latencies = sorted(entry["latencies"])
+        count = len(latencies)
+        errors = entry["outcomes"].get("error", 0)
+        operations[name] = {
+            "count": count,
+            "throughput_per_s": round(count / duration, 2),
+            "p50_ms": round(_percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(_percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(_percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2),
+            "lock_retries": entry["lock_retries"],
+            "error_rate": round(errors / count, 4) if count else 0.0,
+            "outcomes": entry["outcomes"],
+            "sample_errors": sorted(set(entry.get("errors", [])))[:5],
+        }
+    total = sum(op["count"] for op in operations.values())
+    return {
+        "total_operations": total,
+        "throughput_per_s": round(total / duration, 2),
+        "lock_retries": sum(op["lock_retries"] for op in operations.values()),
+        "error_rate": round(sum(op["outcomes"].get("error", 0) for op in operations.values()) / total, 4) if total else 0.0,
+        "operations": operations,
+    }
+
+
+def _merge(all_stats):
+    merged = {}
+    for stats in all_stats:
+        for name, entry in stats.items():
+            target = merged.setdefault(name, {"latencies": [], "lock_retries": 0, "outcomes": {}, "errors": []})
+            target["latencies"].extend(entry["latencies"])
+            target["lock_retries"] += entry["lock_retries"]
+            target["errors"].extend(entry.get("errors", []))
+            for outcome, n in entry["outcomes"].items():
+                target["outcomes"][outcome] = target["outcomes"].get(outcome, 0) + n
+    return merged
+
+
+def print_report(report):
+    summary = report["summary"]
+    print(f"{report['config']['label'] or 'run'}: {summary['total_operations']} ops in "
+          f"{report['config']['duration']}s, {summary['throughput_per_s']} ops/s, "
+          f"{summary['lock_retries']} lock retries, error rate {summary['error_rate']:.2%}")
+    print(f"{'operation':<16}{'count':>8}{'ops/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'retries':>9}{'errors':>8}")
+    for name, op in summary["operations"].items():
+        print(f"{name:<16}{op['count']:>8}{op['throughput_per_s']:>9}{op['p50_ms']:>9}{op['p95_ms']:>9}"
+              f"{op['p99_ms']:>9}{op['lock_retries']:>9}{op['error_rate']:>8.2%}")
+        for error in op["sample_errors"]:
+            print(f"    {error}")
+
+
+def compare_reports(before, after):
+    """Print per-operation deltas between two saved reports."""
+    print(f"{'operation':<16}{'ops/s':>18}{'p95 ms':>20}{'p99 ms':>20}{'errors':>18}")
+    names = sorted(set(before["summary"]["operations"]) | set(after["summary"]["operations"]))
+    for name in names:
+        a = before["summary"]["operations"].get(name)
+        b = after["summary"]["operations"].get(name)
+        if not a or not b:
+            print(f"{name:<16} only in {'after' if b else 'before'}")
+            continue
+        print(f"{name:<16}"
+              f"{a['throughput_per_s']:>8} -> {b['throughput_per_s']:<7}"
+              f"{a['p95_ms']:>9} -> {b['p95_ms']:<8}"
+              f"{a['p99_ms']:>9} -> {b['p99_ms']:<8}"
+              f"{a['error_rate']:>7.2%} -> {b['error_rate']:<7.2%}")
+
+
+# -------------------- Runner --------------------
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        role, _, count = part.partition("=")
+        role = role.strip()
+        if role not in ROLE_WORKLOADS:
+            raise ValueError(f"Unknown role {role!r}; expected one of {', '.join(ROLE_WORKLOADS)}")
+        mix[role] = int(count or 1)
+    return mix
+
+
+def run_load_test(mix, duration=30.0, processes=1, think_time=0.05, max_retries=5, patients=200,
+                  source=None, seed=1, keep=False, label=None):
+    """Run a load test and return the report dict (config + summary)."""
+    workdir = tempfile.mkdtemp(prefix="hms-loadtest-")
+    original = db.DB_PATH, db.DB_SNAPSHOT, db.SHARD_DIR
+    try:
+        db_path = prepare_database(workdir, source, patients, mix)
+        sessions = [(role, f"lt_{role}_{i}") for role, count in mix.items() for i in range(count)]
+        random.Random(seed).shuffle(sessions)
+        groups = [sessions[i::processes] for i in range(processes)]
+
+        started = time.monotonic()
+        if processes == 1:
+            all_stats = [run_worker(db_path, groups[0], duration, think_time, max_retries, seed)]
+        else:
+            ctx = multiprocessing.get_context("spawn")
+            with ctx.Pool(processes) as pool:
+                all_stats = pool.starmap(
+                    run_worker,
+                    [(db_path, group, duration, think_time, max_retries, seed + i) for i, group in enumerate(groups)]
+                )
+        elapsed = time.monotonic() - started
+    finally:
+        db.configure_database(*original)
+        if keep:
+            print(f"Test database kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "config": {
+            "label": label, "mix": mix, "duration": duration, "processes": processes,
+            "think_time": think_time, "max_retries": max_retries, "patients": patients,
+            "source": source, "seed": seed, "shards": db.SHARD_COUNT,
+            "sqlite_version": sqlite3.sqlite_version, "python": platform.python_version(),
+            "started_at": datetime.now().strftime(db.TIMESTAMP_FORMAT),
+        },
+        "summary": summarize(_merge(all_stats), elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent multi-session load test")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="run a load test against a throwaway database")
+    run.add_argument("--mix", default=DEFAULT_MIX, help=f"sessions per role (default {DEFAULT_MIX})")
+    run.add_argument("--duration", type=float, default=30.0, help="seconds to run")
+    run.add_argument("--processes", type=int, default=1, help="worker processes; sessions are split between them")
+    run.add_argument("--think-time", type=float, default=0.05, help="mean pause between a session's operations (s)")
+    run.add_argument("--max-retries", type=int, default=5, help="retries of an operation that hit a locked database")
+    run.add_argument("--patients", type=int, default=200, help="patients to seed before the run")
+    run.add_argument("--source", help="copy this database instead of starting empty")
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--label", help="name stored in the report")
+    run.add_argument("--report", help="write the JSON report to this file")
+    run.add_argument("--keep", action="store_true", help="keep the throwaway database")
+
+    compare = sub.add_parser("compare", help="compare two saved reports")
+    compare.add_argument("before")
+    compare.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        with open(args.before) as a, open(args.after) as b:
+            compare_reports(json.load(a), json.load(b))
+        return
+
+    report = run_load_test(
+        parse_mix(args.mix), args.duration, args.processes, args.think_time, args.max_retries,
+        args.patients, args.source, args.seed, args.keep, args.label,
+    )
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# log_export.py
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+
+from db import get_connection
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+EXPORT_DIR = os.path.join(os.path.dirname(__file__), "log_exports")
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = ".export.lock"
+LOG_COLUMNS = ("log_id", "user_id", "role", "action", "timestamp", "details")
+
+
+def load_manifest(export_dir=EXPORT_DIR):
+    """The export manifest: {"files": [{"file", "first_log_id", "last_log_id", "rows", "bytes", "sha256", "created_at"}, ...]}."""
+    path = os.path.join(export_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"files": []}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest, export_dir):
+    path = os.path.join(export_dir, MANIFEST_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def last_exported_log_id(export_dir=EXPORT_DIR):
+    """Watermark: highest log_id already shipped (0 when nothing has been exported)."""
+    return max((entry["last_log_id"] for entry in load_manifest(export_dir)["files"]), default=0)
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on the file at path, waiting for any other holder (another
+    thread or process) to let go first. Not reentrant: do not nest on the same path.
+    """
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            f.seek(0)
+            while True:
+                try:
+                    # Retries for about 10 seconds before giving up; keep waiting
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class _PartWriter:
+    """One export file being written; renamed to its final log_id range on close."""
+
+    def __init__(self, export_dir, compress):
+        self.export_dir = export_dir
+        self.suffix = ".csv.gz" if compress else ".csv"
+        fd, self.tmp_path = tempfile.mkstemp(prefix=".part-", suffix=self.suffix, dir=export_dir)
+        os.close(fd)
+        raw = gzip.open(self.tmp_path, "wb") if compress else open(self.tmp_path, "wb")
+        self.stream = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+        self.writer = csv.writer(self.stream)
+        self.writer.writerow(LOG_COLUMNS)
+        self.first_log_id = None
+        self.last_log_id = None
+        self.rows = 0
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        if self.first_log_id is None:
+            self.first_log_id = rows[0][0]
+        self.last_log_id = rows[-1][0]
+        self.rows += len(rows)
+
+    def close(self):
+        self.stream.close()
+        name = f"logs_{self.first_log_id:010d}_{self.last_log_id:010d}{self.suffix}"
+        final_path = os.path.join(self.export_dir, name)
+        os.replace(self.tmp_path, final_path)
+        return {
+            "file": name,
+            "first_log_id": self.first_log_id,
+            "last_log_id": self.last_log_id,
+            "rows": self.rows,
+            "bytes": os.path.getsize(final_path),
+            "sha256": _sha256(final_path),
+            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+def export_logs_incremental(export_dir=EXPORT_DIR, compress=True, max_rows_per_file=100_000, batch_size=5_000):
+    """
+    Append audit rows newer than the last exported log_id to new export files.
+
+    Rows are streamed from a single read transaction in log_id order, written in
+    batches and rotated every max_rows_per_file rows. The manifest is updated after
+    each finished file, so an interrupted run resumes from the last complete file.
+    Runs against the same export_dir take turns, so no row is exported twice.
+    Returns the manifest entries written by this run (empty when there was nothing new).
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    with file_lock(os.path.join(export_dir, LOCK_NAME)):
+        return _export_new_logs(export_dir, compress, max_rows_per_file, batch_size)
+
+
+def _export_new_logs(export_dir, compress, max_rows_per_file, batch_size):
+    manifest = load_manifest(export_dir)
+    watermark = max((entry["last_log_id"] for entry in manifest["files"]), default=0)
+
+    conn = get_connection()
+    cursor = conn.execute(
+        f"SELECT {', '.join(LOG_COLUMNS)} FROM logs WHERE log_id > ? ORDER BY log_id", (watermark,)
+    )
+    written = []
+    part = None
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            while rows:
+                if part is None:
+                    part = _PartWriter(export_dir, compress)
+                room = max_rows_per_file - part.rows
+                part.write(rows[:room])
+                rows = rows[room:]
+                if part.rows >= max_rows_per_file:
+                    written.append(part.close())
+                    part = None
+                    manifest["files"].append(written[-1])
+                    _save_manifest(manifest, export_dir)
+        if part is not None:
+            written.append(part.close())
+            part = None
+            manifest["files"].append(written[-1])
+            _save_manifest(manifest, export_dir)
+    finally:
+        if part is not None:
+            part.stream.close()
+            os.remove(part.tmp_path)
+        conn.close()
+    return written
@@ -0,0 +1,88 @@
+# replica.py
+import os
+import sqlite3
+import threading
+import time
+
+import sqltrace
+
+
+class ReadReplica:
+    """
+    Snapshot copy of the main database for read-heavy pages.
+
+    A background thread copies the source database into `replica_path` with the
+    sqlite3 backup API every `interval` seconds. Readers open the snapshot
+    read-only, so dashboard queries never hold locks on the file receptionists
+    write to.
+    """
+
+    def __init__(self, source_path, replica_path, interval=30.0, mmap_size=256 * 1024 * 1024):
+        self.source_path = source_path
+        self.replica_path = replica_path
+        self.interval = interval
+        self.mmap_size = mmap_size
+        self.last_refresh = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """Copy the current source database into the snapshot file."""
+        with self._lock:
+            started = time.monotonic()
+            src = sqlite3.connect(self.source_path)
+            dst = sqlite3.connect(self.replica_path, timeout=30)
+            try:
+                src.backup(dst)
+                # The snapshot is never written, so it needs no WAL/-shm files next to it
+                dst.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                dst.close()
+                src.close()
+            self.last_refresh = started
+        return self.last_refresh
+
+    def staleness(self):
+        """Seconds since the start of the last completed refresh (inf if never refreshed)."""
+        if self.last_refresh is None:
+            return float("inf")
+        return time.monotonic() - self.last_refresh
+
+    def connect(self, max_staleness=None):
+        """
+        Open a read-only, memory-mapped connection to the snapshot.
+        If the snapshot is older than max_staleness seconds it is refreshed first.
+        """
+        if max_staleness is None:
+            max_staleness = self.interval * 2
+        if self.staleness() > max_staleness or not os.path.exists(self.replica_path):
+            self.refresh()
+        uri = "file:" + os.path.abspath(self.replica_path).replace("\\", "/") + "?mode=ro"
+        conn = sqltrace.connect(uri, uri=True, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        return conn
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except sqlite3.Error:
+                # Keep serving the previous snapshot; the next tick retries.
+                pass
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return self
+        self.refresh()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="hms-read-replica", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval)
+            self._thread = None
@@ -1,37 +1,43 @@
 import sqlite3
 from datetime import datetime
 
-conn = sqlite3.connect('database.db')
-cursor = conn.cursor()
+from db import get_connection
 
 # Users: Admin, Doctor, Receptionist
-users = [
+USERS = [
     ('admin', 'admin123', 'admin'),
     ('Dr. Bob', 'doc123', 'doctor'),
     ('Alice_recep', 'rec123', 'receptionist')
 ]
 
-for u in users:
-    try:
-        cursor.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", u)
-    except sqlite3.IntegrityError:
-        pass
-
-# Sample Patients
-patients = [
-    ('John Doe', '123-456-7890', 'Flu', None, None, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-    ('Jane Smith', '987-654-3210', 'Cold', None, None, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+# Sample Patients (encrypted and anonymized on insert)
+PATIENTS = [
+    ('John Doe', '123-456-7890', 'Flu'),
+    ('Jane Smith', '987-654-3210', 'Cold')
 ]
 
-for p in patients:
-    try:
-        cursor.execute('''
-            INSERT INTO patients (name, contact, diagnosis, anonymized_name, anonymized_contact, date_added)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', p)
-    except sqlite3.IntegrityError:
-        pass
-
-conn.commit()
-conn.close()
-print("Seed data inserted successfully!")
+
+def seed():
+    """Insert the example users (skipping existing usernames) and patients. Returns (users, patients) added."""
+    from utils import insert_patient
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    users_added = 0
+    for u in USERS:
+        try:
+            cursor.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", u)
+            users_added += 1
+        except sqlite3.IntegrityError:
+            pass
+    conn.commit()
+    conn.close()
+
+    for p in PATIENTS:
+        insert_patient(*p, datetime.now())
+    return users_added, len(PATIENTS)
+
+
+if __name__ == "__main__":
+    seed()
+    print("Seed data inserted successfully!")
@@ -0,0 +1,266 @@
+# sharding.py
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import sqltrace
+
+
+class ShardRouter:
+    """
+    Spreads patient rows over several SQLite files.
+
+    The primary database keeps a small directory table (patient_shards) that hands
+    out globally unique patient ids and records which shard holds each patient, so
+    lookups stay correct while rows are being rebalanced. Users and logs remain in
+    the primary database.
+
+    The layout, how many shards there are, lives in the primary too (shard_layout),
+    so every process routes the same way and sees a rebalance started by another one.
+    shard_paths(count) returns the files of a count-shard layout; a larger layout must
+    keep the smaller one's paths as its first entries, so a shard index names the same
+    file before, during and after a rebalance.
+
+    strategy="hash" places a patient by patient_id; strategy="facility" places it by
+    the facility name, using facility_map (name -> shard index) and a stable hash for
+    unmapped facilities.
+
+    configure, if given, is called on every new shard connection (e.g. to set pragmas).
+    """
+
+    def __init__(self, shard_paths, primary_connect, strategy="hash", facility_map=None, configure=None, shard_count=1):
+        if shard_count < 1:
+            raise ValueError("At least one shard is required")
+        if strategy not in ("hash", "facility"):
+            raise ValueError(f"Unknown sharding strategy {strategy!r}")
+        self._paths = shard_paths
+        self.primary_connect = primary_connect
+        self.strategy = strategy
+        self.facility_map = dict(facility_map or {})
+        self.configure = configure
+        self.shard_count = shard_count
+        # Set while a rebalance moves rows onto a layout of target_count shards
+        self.target_count = None
+        self.shard_paths = shard_paths(shard_count)
+
+    def __len__(self):
+        """Shard files currently in use (during a rebalance, the old and new layouts' together)."""
+        self.refresh()
+        return len(self.shard_paths)
+
+    def refresh(self, conn=None):
+        """Re-read the layout from the primary; returns (shard_count, target_count)."""
+        own = conn is None
+        conn = self.primary_connect() if own else conn
+        try:
+            row = conn.execute("SELECT shard_count, target_count FROM shard_layout WHERE layout_id = 1").fetchone()
+        finally:
+            if own:
+                conn.close()
+        if row is not None:
+            self.shard_count, self.target_count = row
+        self.shard_paths = self._paths(max(self.shard_count, self.target_count or 0))
+        return self.shard_count, self.target_count
+
+    # -------------------- Placement --------------------
+    def place(self, patient_id, facility=None, shard_count=None):
+        """Shard index a new patient belongs on (by the target layout while rebalancing)."""
+        shard_count = shard_count or self.target_count or self.shard_count
+        if self.strategy == "facility" and facility:
+            if facility in self.facility_map:
+                return self.facility_map[facility] % shard_count
+            return zlib.crc32(facility.encode()) % shard_count
+        return patient_id % shard_count
+
+    def allocate(self, facility=None):
+        """Reserve a new patient id and record its shard; returns (patient_id, shard_index)."""
+        conn = self.primary_connect()
+        # Layout read under the write lock: a rebalance cannot start between placing and recording
+        conn.execute("BEGIN IMMEDIATE")
+        self.refresh(conn)
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO patient_shards (shard) VALUES (NULL)")
+        patient_id = cursor.lastrowid
+        shard = self.place(patient_id, facility)
+        cursor.execute("UPDATE patient_shards SET shard = ? WHERE patient_id = ?", (shard, patient_id))
+        conn.commit()
+        conn.close()
+        return patient_id, shard
+
+    def locate(self, patient_id):
+        """Shard index holding patient_id according to the directory (None if unknown)."""
+        conn = self.primary_connect()
+        row = conn.execute("SELECT shard FROM patient_shards WHERE patient_id = ?", (patient_id,)).fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def forget(self, patient_ids):
+        conn = self.primary_connect()
+        conn.executemany("DELETE FROM patient_shards WHERE patient_id = ?", [(pid,) for pid in patient_ids])
+        conn.commit()
+        conn.close()
+
+    # -------------------- Connections --------------------
+    def connect(self, index):
+        if index >= len(self.shard_paths):
+            # Placed by a layout this process has not read yet
+            self.refresh()
+        conn = sqltrace.connect(self.shard_paths[index], timeout=30, check_same_thread=False)
+        if self.configure is not None:
+            self.configure(conn)
+        return conn
+
+    def connect_for(self, patient_id):
+        shard = self.locate(patient_id)
+        if shard is None:
+            shard = self.place(patient_id)
+        return self.connect(shard)
+
+    def fan_out(self, func):
+        """
+        Run func(conn) against every shard in parallel and return the results in shard
+        order. Each call gets its own connection, closed afterwards.
+        """
+        def run(index):
+            conn = self.connect(index)
+            try:
+                return func(conn)
+            finally:
+                conn.close()
+
+        count = len(self)
+        if count == 1:
+            return [run(0)]
+        with ThreadPoolExecutor(max_workers=count) as pool:
+            return list(pool.map(run, range(count)))
+
+    def execute_all(self, sql, params=()):
+        """Run a write statement on every shard; returns the total number of rows changed."""
+        def run(conn):
+            cursor = conn.execute(sql, params)
+            conn.commit()
+            return cursor.rowcount
+        return sum(self.fan_out(run))
+
+    # -------------------- Rebalancing --------------------
+    def rebalance(self, shard_count, create_schema, batch_size=500):
+        """
+        Move patients and their encounters so they match placement over shard_count
+        shards (e.g. after adding one). create_schema(conn) must create the patients and
+        encounters tables in a shard. Returns the number of patients moved.
+
+        The target layout is recorded first, so from then on every process places new
+        patients by it and reads the new shard files too. Each batch is copied into its
+        new shard, switched in the directory, then deleted from the old shard, each step
+        in its own transaction: a transaction over ATTACHed databases in WAL mode (the
+        default profile) commits file by file, not atomically, so a crash must leave a
+        duplicate rather than lose the batch. Writes to the old shard wait while one of
+        its batches moves. Until the rebalance ends, queries fanned out over every shard
+        may see a batch twice. After a crash, calling rebalance again with the same
+        shard_count finishes the job.
+        """
+        if shard_count < 1:
+            raise ValueError("At least one shard is required")
+        conn = self.primary_connect()
+        conn.execute("BEGIN IMMEDIATE")
+        _, target = self.refresh(conn)
+        if target is not None and target != shard_count:
+            conn.rollback()
+            conn.close()
+            raise RuntimeError(f"A rebalance to {target} shards is already in progress")
+        conn.execute("UPDATE shard_layout SET target_count = ? WHERE layout_id = 1", (shard_count,))
+        conn.commit()
+        conn.close()
+
+        for index in range(len(self)):
+            shard = self.connect(index)
+            create_schema(shard)
+            shard.close()
+
+        moved = 0
+        while True:
+            # Repeat until a pass finds nothing: patients allocated just before the target
+            # layout was recorded may reach their old shard after its pass
+            results = [self._rebalance_shard(index, shard_count, batch_size) for index in range(len(self.shard_paths))]
+            moved += sum(copied for copied, _ in results)
+            if not any(copied or removed for copied, removed in results):
+                break
+
+        conn = self.primary_connect()
+        conn.execute("UPDATE shard_layout SET shard_count = ?, target_count = NULL WHERE layout_id = 1", (shard_count,))
+        conn.commit()
+        conn.close()
+        self.refresh()
+        return moved
+
+    def _rebalance_shard(self, index, shard_count, batch_size):
+        """Move the patients on shard `index` that belong elsewhere; returns (copied, removed)."""
+        conn = self.connect(index)
+        rows = conn.execute("SELECT patient_id, facility FROM patients").fetchall()
+        conn.close()
+        moves = {}
+        for patient_id, facility in rows:
+            target = self.place(patient_id, facility, shard_count)
+            if target != index:
+                moves.setdefault(target, []).append(patient_id)
+        copied = removed = 0
+        for target, patient_ids in moves.items():
+            for start in range(0, len(patient_ids), batch_size):
+                batch_copied, batch_removed = self._move(index, target, patient_ids[start:start + batch_size])
+                copied += batch_copied
+                removed += batch_removed
+        return copied, removed
+
+    def _move(self, source, target, patient_ids):
+        """Copy patient_ids from shard source to target, switch the directory, delete the originals."""
+        src = self.connect(source)
+        directory = self.primary_connect()
+        try:
+            # Writers to the old shard wait, so the copy cannot miss a change
+            src.execute("BEGIN IMMEDIATE")
+            placeholders = ",".join("?" * len(patient_ids))
+            present = [pid for pid, in src.execute(
+                f"SELECT patient_id FROM patients WHERE patient_id IN ({placeholders})", patient_ids
+            ).fetchall()]
+            if not present:
+                src.rollback()
+                return 0, 0
+            placeholders = ",".join("?" * len(present))
+            # Already switched by an interrupted run: the new shard's copy is current
+            switched = {pid for pid, in directory.execute(
+                f"SELECT patient_id FROM patient_shards WHERE shard = ? AND patient_id IN ({placeholders})",
+                [target, *present]
+            ).fetchall()}
+            copy = [pid for pid in present if pid not in switched]
+            if copy:
+                self._copy(source, target, copy)
+                directory.executemany("UPDATE patient_shards SET shard = ? WHERE patient_id = ?", [(target, pid) for pid in copy])
+                directory.commit()
+            src.execute(f"DELETE FROM patients WHERE patient_id IN ({placeholders})", present)
+            src.commit()
+            return len(copy), len(present)
+        finally:
+            directory.close()
+            src.close()
+
+    def _copy(self, source, target, patient_ids):
+        """Copy patients and their encounters in one transaction on the target shard; safe to repeat."""
+        placeholders = ",".join("?" * len(patient_ids))
+        conn = self.connect(target)
+        try:
+            conn.execute("ATTACH DATABASE ? AS source", (self.shard_paths[source],))
+            columns = ", ".join(row[1] for row in conn.execute("PRAGMA source.table_info(patients)").fetchall())
+            # Encounters left by an interrupted copy would otherwise be duplicated
+            conn.execute(f"DELETE FROM main.encounters WHERE patient_id IN ({placeholders})", patient_ids)
+            conn.execute(
+                f"INSERT OR REPLACE INTO main.patients ({columns}) "
+                f"SELECT {columns} FROM source.patients WHERE patient_id IN ({placeholders})", patient_ids
+            )
+            conn.execute(
+                "INSERT INTO main.encounters (patient_id, ts, diagnosis, recorded_by) "
+                f"SELECT patient_id, ts, diagnosis, recorded_by FROM source.encounters WHERE patient_id IN ({placeholders})",
+                patient_ids
+            )
+            conn.commit()
+            conn.execute("DETACH DATABASE source")
+        finally:
+            conn.close()
@@ -0,0 +1,241 @@
+# shared_cache.py
+"""
+Optional cache shared by every app process on a host.
+
+Streamlit caches live inside one process, so each replica behind a load balancer
+recomputes the same frames and counts. With HMS_SHARED_CACHE set to a file path
+(e.g. /dev/shm/hms-cache.db) the read helpers decorated with @cached store their
+results in that SQLite file instead, where all workers find them:
+
+- DataFrames are stored as Arrow IPC streams (columnar, dtypes preserved) when pyarrow
+  is installed, otherwise pickled; other values are pickled.
+- Every entry is stamped with the data version of the tables it was computed from:
+  the AUTOINCREMENT counters of `changes` (bumped by the patients/users triggers, on
+  every shard) and `logs_compact`. Any write moves a counter, so the entry goes stale.
+- The version is read from the primary, but the helper may have read an older replica
+  snapshot. While a replica is enabled, entries are therefore dated by that snapshot
+  and served only until it would be REPLICA_MAX_STALENESS old, the same bound an
+  uncached replica read has.
+- Entries also expire after HMS_SHARED_CACHE_TTL seconds, and the least recently used
+  ones are evicted to stay under HMS_SHARED_CACHE_MB.
+
+Only the app writes the cache file; keep it somewhere other users cannot write, since
+pickled entries are loaded back as Python objects. Helpers returning decrypted patient
+fields are never cached.
+"""
+import functools
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+
+import db
+
+SHARED_CACHE_PATH = os.environ.get("HMS_SHARED_CACHE")
+SHARED_CACHE_MB = float(os.environ.get("HMS_SHARED_CACHE_MB", "256"))
+SHARED_CACHE_TTL = float(os.environ.get("HMS_SHARED_CACHE_TTL", "300"))
+
+# Tables a cached helper can depend on, and the AUTOINCREMENT counter that moves when they change
+VERSIONED_TABLES = ("patients", "users", "logs")
+
+# Hits refresh last_used at most this often, so reads rarely write
+_TOUCH_INTERVAL = 5.0
+
+_cache = None
+
+
+class SharedCache:
+    """Size-bounded key/value store in a SQLite file, safe to use from many processes."""
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self.ttl = ttl
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                format TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries(last_used)")
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=1.0)
+        # The cache can always be rebuilt, so never wait on fsync
+        conn.execute("PRAGMA synchronous = OFF")
+        return conn
+
+    def get(self, key, version, max_age=None):
+        """(True, value) for an entry with this version at most max_age (default ttl) seconds old, else (False, None)."""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT version, format, payload, created_at, last_used FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            if row is None or row[0] != version or now - row[3] > min(self.ttl, max_age or self.ttl):
+                return False, None
+            if now - row[4] > _TOUCH_INTERVAL:
+                conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+                conn.commit()
+            return True, _loads(row[1], row[2])
+        finally:
+            conn.close()
+
+    def put(self, key, version, value, created_at=None):
+        """
+        Store value and evict least recently used entries beyond max_bytes.
+        created_at backdates the entry to when its data was read (default now).
+        """
+        fmt, payload = _dumps(value)
+        if len(payload) > self.max_bytes // 4:
+            return False
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, version, format, payload, bytes, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, version, fmt, payload, len(payload), now if created_at is None else created_at, now),
+            )
+            conn.execute('''
+                DELETE FROM entries WHERE key IN (
+                    SELECT key FROM (SELECT key, SUM(bytes) OVER (ORDER BY last_used DESC, key) AS kept FROM entries)
+                    WHERE kept > ?
+                )
+            ''', (self.max_bytes,))
+            conn.commit()
+            return True
+        finally:
+            conn.close()
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("DELETE FROM entries")
+        conn.commit()
+        conn.close()
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            entries, used = conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries").fetchone()
+        finally:
+            conn.close()
+        return {"path": self.path, "entries": entries, "bytes": used, "max_bytes": self.max_bytes, "ttl": self.ttl}
+
+
+def get_shared_cache():
+    """The configured SharedCache, or None when HMS_SHARED_CACHE is not set."""
+    global _cache
+    if _cache is None and SHARED_CACHE_PATH:
+        _cache = SharedCache(SHARED_CACHE_PATH, SHARED_CACHE_MB * 1024 * 1024, SHARED_CACHE_TTL)
+    return _cache
+
+
+# -------------------- Serialization --------------------
+def _is_dataframe(value):
+    return type(value).__name__ == "DataFrame" and type(value).__module__.startswith("pandas")
+
+
+def _dumps(value):
+    if _is_dataframe(value):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            pa = None
+        if pa is not None:
+            table = pa.Table.from_pandas(value)
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            return "arrow", sink.getvalue().to_pybytes()
+    return "pickle", pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(fmt, payload):
+    if fmt == "arrow":
+        import pyarrow as pa
+        return pa.ipc.open_stream(payload).read_all().to_pandas()
+    return pickle.loads(payload)
+
+
+# -------------------- Versions --------------------
+def _sequences(conn, names):
+    placeholders = ",".join("?" * len(names))
+    rows = conn.execute(f"SELECT name, seq FROM sqlite_sequence WHERE name IN ({placeholders})", names).fetchall()
+    found = dict(rows)
+    return [found.get(name, 0) for name in names]
+
+
+def data_version(tables):
+    """
+    Stamp that changes whenever a patient or user row is inserted, updated or deleted,
+    or an audit entry is appended, in one of `tables`.
+    """
+    parts = []
+    if "patients" in tables:
+        parts += [seq for (seq,) in db.fan_out_patients(lambda conn: _sequences(conn, ["changes"]), primary=True)]
+    primary = [name for table, name in (("users", "changes"), ("logs", "logs_compact")) if table in tables]
+    if primary:
+        conn = db.get_connection()
+        try:
+            parts += _sequences(conn, primary)
+        finally:
+            conn.close()
+    return f"{db.DB_PATH}:" + ".".join(str(p) for p in parts)
+
+
+# -------------------- Decorator --------------------
+def cached(*tables, unless=None):
+    """
+    Cache a read helper's result in the shared cache, invalidated by writes to `tables`.
+    unless(*args, **kwargs) may return True to bypass the cache for a call. Without
+    HMS_SHARED_CACHE the helper runs unchanged. Cache errors never fail the read.
+    """
+    unknown = set(tables) - set(VERSIONED_TABLES)
+    if unknown:
+        raise ValueError(f"Cannot version tables {sorted(unknown)}; expected some of {', '.join(VERSIONED_TABLES)}")
+
+    def decorator(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = get_shared_cache()
+            if cache is None or (unless is not None and unless(*args, **kwargs)):
+                return func(*args, **kwargs)
+            key = hashlib.sha256(f"{name}|{db.DB_PATH}|{args!r}|{sorted(kwargs.items())!r}".encode()).hexdigest()
+            replica = db.read_replica()
+            max_age = created_at = None
+            if replica is not None:
+                # The helper may read a snapshot up to REPLICA_MAX_STALENESS old that predates
+                # `version`; date the entry by that snapshot so it is never served beyond the bound
+                max_age = db.REPLICA_MAX_STALENESS
+                created_at = time.time() - min(replica.staleness(), max_age)
+            try:
+                version = data_version(tables)
+                hit, value = cache.get(key, version, max_age)
+                if hit:
+                    return value
+            except Exception:
+                # A locked, corrupt or unreadable cache only costs the recomputation
+                return func(*args, **kwargs)
+            value = func(*args, **kwargs)
+            try:
+                cache.put(key, version, value, created_at)
+            except Exception:
+                pass
+            return value
+
+        return wrapper
+    return decorator
@@ -0,0 +1,253 @@
+# snapshot_export.py
+"""
+Columnar snapshots of anonymized patient and audit-log data for analytics.
+
+Each run writes one directory under SNAPSHOT_DIR:
+
+    snapshots/20261019-143000/
+        patients/date_added_month=2026-10/part-0.parquet   # Hive-style partitions
+        logs/timestamp_month=2026-10/part-0.parquet
+        patients.arrow, logs.arrow                          # Arrow IPC files, uncompressed
+        snapshot.json                                       # schemas, files, row counts, checksums
+
+Patients carry exactly the columns the doctor view shows (get_patients_for_doctor):
+no names or contacts beyond their anonymized form. Columns are typed (int64 ids,
+millisecond timestamps, the finest unit Parquet shares with Arrow, and
+dictionary-encoded categories) from an explicit schema, rows are streamed
+from SQLite in batches without pandas, and Parquet files use zstd compression with
+bounded row groups. The Arrow files can be memory-mapped for zero-copy reads:
+
+    pyarrow.ipc.open_file(pyarrow.memory_map("snapshots/.../patients.arrow")).read_all()
+
+    python snapshot_export.py [--formats parquet arrow] [--row-group-size 100000]
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import db
+from log_export import _sha256
+
+SNAPSHOT_DIR = os.environ.get("HMS_SNAPSHOT_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots")
+MANIFEST_NAME = "snapshot.json"
+FORMATS = ("parquet", "arrow")
+
+# The get_patients_for_doctor projection, typed
+PATIENT_SCHEMA = pa.schema([
+    ("patient_id", pa.int64()),
+    ("anonymized_name", pa.string()),
+    ("anonymized_contact", pa.string()),
+    ("diagnosis", pa.dictionary(pa.int32(), pa.string())),
+    ("date_added", pa.timestamp("ms")),
+])
+PATIENT_SQL = """
+    SELECT patient_id, anonymized_name, anonymized_contact, diagnosis, date_added_epoch
+    FROM patients ORDER BY date_added_epoch, patient_id
+"""
+
+LOG_SCHEMA = pa.schema([
+    ("log_id", pa.int64()),
+    ("user_id", pa.int64()),
+    ("role", pa.dictionary(pa.int32(), pa.string())),
+    ("action", pa.dictionary(pa.int32(), pa.string())),
+    ("timestamp", pa.timestamp("ms")),
+    ("details", pa.string()),
+])
+LOG_SQL = "SELECT log_id, user_id, role, action, timestamp_epoch, details FROM logs ORDER BY timestamp_epoch, log_id"
+
+
+def _month(epoch):
+    return "unknown" if epoch is None else time.strftime("%Y-%m", time.gmtime(epoch))
+
+
+def _batch(rows, schema, dictionaries):
+    """
+    RecordBatch from row tuples; the time column holds epoch seconds, as stored.
+    Category columns are encoded against dictionaries[name], which grows by appending,
+    so each batch's dictionary extends the previous one: the IPC file format accepts
+    such deltas but not a replaced dictionary.
+    """
+    columns = list(zip(*rows))
+    arrays = []
+    for values, field in zip(columns, schema):
+        if pa.types.is_dictionary(field.type):
+            strings = pa.array(values, pa.string())
+            known = dictionaries.get(field.name, pa.array([], pa.string()))
+            new = pc.unique(strings.filter(pc.invert(pc.is_in(strings, value_set=known)))).drop_null()
+            known = dictionaries[field.name] = pa.concat_arrays([known, new]) if len(new) else known
+            indices = pc.index_in(strings, value_set=known).cast(field.type.index_type)
+            arrays.append(pa.DictionaryArray.from_arrays(indices, known))
+        elif pa.types.is_timestamp(field.type):
+            arrays.append(pa.array(values, pa.timestamp("s")).cast(field.type))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class _DatasetWriter:
+    """Partitioned Parquet files plus one Arrow IPC file for a table."""
+
+    def __init__(self, root, name, schema, partition, formats, compression, row_group_size):
+        self.root, self.name, self.schema, self.partition = root, name, schema, partition
+        self.formats, self.compression, self.row_group_size = formats, compression, row_group_size
+        self.parquet = {}
+        self.arrow = None
+        self.rows = 0
+        self.dictionaries = {}
+        if "arrow" in formats:
+            self.arrow_path = os.path.join(root, f"{name}.arrow")
+            self.arrow = pa.ipc.new_file(self.arrow_path, schema,
+                                         options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def _parquet_writer(self, month):
+        if month not in self.parquet:
+            directory = os.path.join(self.root, self.name, f"{self.partition}={month}")
+            os.makedirs(directory, exist_ok=True)
+            self.parquet[month] = pq.ParquetWriter(
+                os.path.join(directory, "part-0.parquet"), self.schema,
+                compression=self.compression, write_statistics=True,
+            )
+        return self.parquet[month]
+
+    def write(self, rows, epoch_index):
+        if "parquet" in self.formats:
+            by_month = {}
+            for row in rows:
+                by_month.setdefault(_month(row[epoch_index]), []).append(row)
+            for month, month_rows in by_month.items():
+                self._parquet_writer(month).write_batch(_batch(month_rows, self.schema, self.dictionaries),
+                                                        row_group_size=self.row_group_size)
+        if self.arrow is not None:
+            self.arrow.write_batch(_batch(rows, self.schema, self.dictionaries))
+        self.rows += len(rows)
+
+    def close(self):
+        """Close every file and return their manifest entries."""
+        files = []
+        for writer in self.parquet.values():
+            writer.close()
+            files.append(writer.where)
+        if self.arrow is not None:
+            self.arrow.close()
+            files.append(self.arrow_path)
+        return {
+            "rows": self.rows,
+            "schema": self.schema.to_string(show_schema_metadata=False),
+            "partitioned_by": self.partition,
+            "files": [
+                {"file": os.path.relpath(path, self.root), "bytes": os.path.getsize(path), "sha256": _sha256(path)}
+                for path in sorted(files)
+            ],
+        }
+
+
+def _patient_sources():
+    """Read connections to every database holding patients."""
+    router = db.get_shard_router()
+    if router is None:
+        return [db.get_read_connection()]
+    return [router.connect(index) for index in range(len(router))]
+
+
+def _stream(conns, sql, writer, epoch_index, batch_size):
+    for conn in conns:
+        try:
+            # One read transaction per database: a consistent view while batches stream out
+            conn.execute("BEGIN")
+            cursor = conn.execute(sql)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                writer.write(rows, epoch_index)
+            conn.rollback()
+        finally:
+            conn.close()
+
+
+def export_snapshot(output_dir=None, formats=FORMATS, compression="zstd", row_group_size=100_000,
+                    batch_size=50_000, tables=("patients", "logs")):
+    """
+    Write a new snapshot directory and return its manifest. Files are written under a
+    temporary name and the directory is renamed into place when complete, so readers
+    never see a partial snapshot.
+    """
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"Unknown snapshot formats {sorted(unknown)}; expected {', '.join(FORMATS)}")
+    output_dir = output_dir or SNAPSHOT_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    created_at = db.now_epoch()
+    name = base = time.strftime("%Y%m%d-%H%M%S", time.gmtime(created_at))
+    suffix = 1
+    while os.path.exists(os.path.join(output_dir, name)):
+        suffix += 1
+        name = f"{base}-{suffix}"
+    final = os.path.join(output_dir, name)
+    root = os.path.join(output_dir, f".{name}.tmp")
+    os.makedirs(root)
+
+    manifest = {"snapshot": name, "created_at": created_at, "formats": list(formats),
+                "compression": compression, "row_group_size": row_group_size, "tables": {}}
+    started = time.perf_counter()
+    try:
+        if "patients" in tables:
+            writer = _DatasetWriter(root, "patients", PATIENT_SCHEMA, "date_added_month", formats, compression, row_group_size)
+            try:
+                _stream(_patient_sources(), PATIENT_SQL, writer, 4, batch_size)
+            finally:
+                manifest["tables"]["patients"] = writer.close()
+        if "logs" in tables:
+            writer = _DatasetWriter(root, "logs", LOG_SCHEMA, "timestamp_month", formats, compression, row_group_size)
+            try:
+                _stream([db.get_read_connection()], LOG_SQL, writer, 4, batch_size)
+            finally:
+                manifest["tables"]["logs"] = writer.close()
+        manifest["seconds"] = round(time.perf_counter() - started, 3)
+        with open(os.path.join(root, MANIFEST_NAME), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(root, final)
+    except BaseException:
+        shutil.rmtree(root, ignore_errors=True)
+        raise
+    manifest["path"] = final
+    return manifest
+
+
+def list_snapshots(output_dir=None):
+    """Manifests of the complete snapshots in output_dir, oldest first."""
+    output_dir = output_dir or SNAPSHOT_DIR
+    if not os.path.isdir(output_dir):
+        return []
+    manifests = []
+    for name in sorted(os.listdir(output_dir)):
+        path = os.path.join(output_dir, name, MANIFEST_NAME)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                manifests.append({**json.load(f), "path": os.path.dirname(path)})
+    return manifests
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export anonymized patients and logs as Parquet / Arrow")
+    parser.add_argument("--output-dir", default=SNAPSHOT_DIR)
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=list(FORMATS))
+    parser.add_argument("--compression", default="zstd", help="Parquet codec: zstd, snappy, gzip, none")
+    parser.add_argument("--row-group-size", type=int, default=100_000)
+    args = parser.parse_args()
+
+    manifest = export_snapshot(args.output_dir, args.formats, args.compression, args.row_group_size)
+    for table, entry in manifest["tables"].items():
+        size = sum(f["bytes"] for f in entry["files"])
+        print(f"{table}: {entry['rows']} rows, {len(entry['files'])} file(s), {size} bytes")
+    print(f"Snapshot {manifest['path']} written in {manifest['seconds']}s")
+
+
+if __name__ == "__main__":
+    main()
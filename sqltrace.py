@@ -0,0 +1,331 @@
+# sqltrace.py
+"""
+Sampled SQL tracing and the slow-query log.
+
+Connections opened through connect() (db.get_connection, the read replica, shards and
+the app's own connections) use a cursor that times a sample of statements,
+HMS_SQL_TRACE_SAMPLE of them (default 0.05; 1 traces everything, 0 installs nothing):
+
+- A traced statement's time covers execute() and every fetch until the cursor is
+  exhausted, re-executed or closed, so a SELECT's rows are counted as they are read.
+- Per-statement totals (count, total and max ms, rows) are kept in memory per process:
+  statement_stats().
+- Statements slower than HMS_SLOW_QUERY_MS (default 250) are written to the
+  `slow_queries` table with their EXPLAIN QUERY PLAN and the Python line that ran them,
+  each statement shape at most once per HMS_SLOW_QUERY_INTERVAL seconds (default 60).
+  The table lives in its own log database (HMS_SLOW_QUERY_LOG, default
+  `<database>-slowlog.db` next to the primary), written by a background thread. The
+  traced database never sees those commits, so a connection that still holds a read
+  snapshot can go on to write without hitting SQLITE_BUSY_SNAPSHOT.
+
+Statements are stored normalized, with literals replaced by `?`; parameters are never
+stored, so no patient data reaches the log.
+"""
+import hashlib
+import os
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+TRACE_SAMPLE = float(os.environ.get("HMS_SQL_TRACE_SAMPLE", "0.05"))
+SLOW_QUERY_MS = float(os.environ.get("HMS_SLOW_QUERY_MS", "250"))
+SLOW_QUERY_INTERVAL = float(os.environ.get("HMS_SLOW_QUERY_INTERVAL", "60"))
+# Rows kept in slow_queries; older ones are deleted as new ones arrive
+SLOW_QUERY_KEEP = int(os.environ.get("HMS_SLOW_QUERY_KEEP", "5000"))
+SLOW_QUERY_LOG = os.environ.get("HMS_SLOW_QUERY_LOG")
+
+SLOW_QUERIES_DDL = """
+CREATE TABLE IF NOT EXISTS slow_queries (
+    query_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    statement TEXT NOT NULL,
+    duration_ms REAL NOT NULL,
+    rows INTEGER,
+    database TEXT,
+    source TEXT,
+    plan TEXT
+)
+"""
+
+# Statement kinds EXPLAIN QUERY PLAN says something useful about
+_PLANNED = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+_MAX_STATEMENTS = 2000
+
+_stats = {}
+_last_logged = {}
+_lock = threading.Lock()
+_queue = queue.Queue(maxsize=1000)
+_writer = None
+
+
+# -------------------- Connections --------------------
+def connect(database, **kwargs):
+    """sqlite3.connect() with statement tracing when sampling is enabled; file: URIs are opened as URIs."""
+    if isinstance(database, str) and database.startswith("file:"):
+        kwargs.setdefault("uri", True)
+    if TRACE_SAMPLE > 0:
+        kwargs.setdefault("factory", TracedConnection)
+    return sqlite3.connect(database, **kwargs)
+
+
+class TracedConnection(sqlite3.Connection):
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.database = os.path.basename(str(database)).split("?")[0]
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TracedCursor)
+
+    # The C shortcuts open a plain cursor; route them through a traced one
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class TracedCursor(sqlite3.Cursor):
+    _trace = None
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        if random.random() >= TRACE_SAMPLE:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        self._trace = [sql, parameters, time.perf_counter() - started, 0]
+        if self.description is None:
+            self._finish(max(self.rowcount, 0))
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        if random.random() >= TRACE_SAMPLE:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        # The parameters were consumed, so no plan for this one
+        self._trace = [sql, None, time.perf_counter() - started, 0]
+        self._finish(max(self.rowcount, 0))
+        return self
+
+    def fetchone(self):
+        if self._trace is None:
+            return super().fetchone()
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._trace[2] += time.perf_counter() - started
+        if row is None:
+            self._finish()
+        else:
+            self._trace[3] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        if self._trace is None:
+            return super().fetchmany(size)
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._trace[2] += time.perf_counter() - started
+        self._trace[3] += len(rows)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        if self._trace is None:
+            return super().fetchall()
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._trace[2] += time.perf_counter() - started
+        self._trace[3] += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        if self._trace is None:
+            return super().__next__()
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._trace[2] += time.perf_counter() - started
+            self._finish()
+            raise
+        self._trace[2] += time.perf_counter() - started
+        self._trace[3] += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # Cursors dropped after a single fetchone() end their statement here
+        self._finish()
+
+    def _finish(self, rows=None):
+        trace, self._trace = self._trace, None
+        if trace is None:
+            return
+        sql, parameters, seconds, fetched = trace
+        try:
+            _record(self.connection, sql, parameters, seconds * 1000, fetched if rows is None else rows)
+        except Exception:
+            # Tracing must never fail the query it measured
+            pass
+
+
+# -------------------- Recording --------------------
+def normalize_statement(sql):
+    """Statement shape: string and number literals replaced by ?, whitespace collapsed."""
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def _caller():
+    """file:line function of the first frame outside this module."""
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+def _plan(conn, sql, parameters):
+    """EXPLAIN QUERY PLAN as an indented tree, on the connection that ran the statement."""
+    if parameters is None or not sql.lstrip().upper().startswith(_PLANNED):
+        return None
+    cursor = sqlite3.Cursor(conn)
+    try:
+        rows = cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    finally:
+        cursor.close()
+    depth = {0: -1}
+    lines = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node] + detail)
+    return "\n".join(lines) or None
+
+
+def _record(conn, sql, parameters, ms, rows):
+    statement = normalize_statement(sql)
+    fingerprint = hashlib.sha1(statement.encode()).hexdigest()[:16]
+    now = time.monotonic()
+    with _lock:
+        entry = _stats.get(fingerprint)
+        if entry is None and len(_stats) < _MAX_STATEMENTS:
+            entry = _stats[fingerprint] = {"statement": statement, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0}
+        if entry is not None:
+            entry["count"] += 1
+            entry["total_ms"] += ms
+            entry["max_ms"] = max(entry["max_ms"], ms)
+            entry["rows"] += rows
+        if ms < SLOW_QUERY_MS or now - _last_logged.get(fingerprint, -SLOW_QUERY_INTERVAL) < SLOW_QUERY_INTERVAL:
+            return
+        _last_logged[fingerprint] = now
+
+    import db
+
+    try:
+        plan = _plan(conn, sql, parameters)
+    except sqlite3.Error as exc:
+        plan = f"(no plan: {exc})"
+    row = (db.now_epoch(), fingerprint, statement[:4000], round(ms, 2), rows,
+           getattr(conn, "database", None), _caller(), plan)
+    try:
+        _queue.put_nowait((log_path(), row))
+    except queue.Full:
+        return
+    _start_writer()
+
+
+def _start_writer():
+    global _writer
+    with _lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_write_loop, name="hms-slow-queries", daemon=True)
+            _writer.start()
+
+
+def _write_loop():
+    # Kept open: cheaper per entry, and an in-memory log lives as long as its connection
+    conns = {}
+    while True:
+        path, row = _queue.get()
+        try:
+            if path not in conns:
+                conns[path] = open_log(path)
+            conn = conns[path]
+            conn.execute(
+                "INSERT INTO slow_queries (ts, fingerprint, statement, duration_ms, rows, database, source, plan) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row
+            )
+            conn.execute("DELETE FROM slow_queries WHERE query_id <= last_insert_rowid() - ?", (SLOW_QUERY_KEEP,))
+            conn.commit()
+        except sqlite3.Error:
+            # e.g. an unwritable log directory; the entry is dropped
+            pass
+        finally:
+            _queue.task_done()
+
+
+def flush():
+    """Wait until queued slow-query rows are written (for scripts and the CLI)."""
+    if _writer is not None and _writer.is_alive():
+        _queue.join()
+
+
+# -------------------- Log database --------------------
+def log_path(db_path=None):
+    """The slow-query log database for db_path (default: the configured primary)."""
+    import db
+
+    if SLOW_QUERY_LOG:
+        return SLOW_QUERY_LOG
+    path = db.DB_PATH if db_path is None else db_path
+    if db.is_memory_database(path):
+        base, _, query = path.partition("?")
+        return f"{base}-slowlog?{query}"
+    return os.path.splitext(db.database_file(path))[0] + "-slowlog.db"
+
+
+def open_log(path=None):
+    """Plain (untraced) connection to the slow-query log, creating its table if needed."""
+    path = path or log_path()
+    conn = sqlite3.connect(path, timeout=5, uri=path.startswith("file:"), check_same_thread=False)
+    conn.execute("PRAGMA journal_mode = WAL")
+    # Losing the last entries in a power cut is fine for a diagnostic log
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(SLOW_QUERIES_DDL)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_slow_queries_ts ON slow_queries(ts)")
+    conn.commit()
+    return conn
+
+
+# -------------------- Reading --------------------
+def statement_stats(limit=50):
+    """This process's sampled statements, by total time spent, as dicts."""
+    with _lock:
+        entries = [dict(entry, fingerprint=fp) for fp, entry in _stats.items()]
+    for entry in entries:
+        entry["avg_ms"] = round(entry["total_ms"] / entry["count"], 2)
+        entry["total_ms"] = round(entry["total_ms"], 2)
+        entry["max_ms"] = round(entry["max_ms"], 2)
+    entries.sort(key=lambda entry: entry["total_ms"], reverse=True)
+    return entries[:limit]
+
+
+def reset_statement_stats():
+    with _lock:
+        _stats.clear()
+        _last_logged.clear()
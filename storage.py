@@ -0,0 +1,213 @@
+# storage.py
+"""
+Named SQLite performance profiles and database maintenance.
+
+A profile is a set of pragmas applied to every connection db.get_connection() opens.
+The active profile comes from HMS_STORAGE_PROFILE or the "profile" key of the
+storage config file (HMS_STORAGE_CONFIG, default storage.json next to the database),
+which may also define extra profiles or override built-in ones:
+
+    {
+      "profile": "balanced",
+      "profiles": {"balanced": {"cache_size": -131072}},
+      "maintenance": {"vacuum_pages": 2000}
+    }
+"""
+import json
+import os
+
+# Pragmas a profile may set, in the order they are applied
+# (auto_vacuum must precede journal_mode to take effect on a new file).
+PROFILE_PRAGMAS = (
+    "auto_vacuum", "journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store",
+    "wal_autocheckpoint", "busy_timeout",
+)
+
+PROFILES = {
+    # Rollback journal and full fsync on every commit: SQLite's own defaults.
+    "compat": {},
+    # WAL keeps readers and the writer out of each other's way; FULL still syncs every commit.
+    "durable": {
+        "journal_mode": "WAL", "synchronous": "FULL", "cache_size": -32768,
+        "temp_store": "MEMORY", "auto_vacuum": "INCREMENTAL", "busy_timeout": 5000,
+    },
+    # NORMAL only syncs at checkpoints: a power cut may lose the last commits, never corrupt the file.
+    "balanced": {
+        "journal_mode": "WAL", "synchronous": "NORMAL", "cache_size": -65536, "mmap_size": 268435456,
+        "temp_store": "MEMORY", "auto_vacuum": "INCREMENTAL", "busy_timeout": 5000,
+    },
+    # durable, but only the WAL archiver (backup.py) checkpoints, so every frame can be archived.
+    "archive": {
+        "journal_mode": "WAL", "synchronous": "FULL", "cache_size": -32768,
+        "temp_store": "MEMORY", "auto_vacuum": "INCREMENTAL", "busy_timeout": 5000, "wal_autocheckpoint": 0,
+    },
+    # Large page cache and memory map for dashboard / analytics heavy deployments.
+    "read-heavy": {
+        "journal_mode": "WAL", "synchronous": "NORMAL", "cache_size": -262144, "mmap_size": 1073741824,
+        "temp_store": "MEMORY", "auto_vacuum": "INCREMENTAL", "busy_timeout": 5000,
+    },
+}
+DEFAULT_PROFILE = "durable"
+
+MAINTENANCE_DEFAULTS = {
+    "analyze": True,        # run ANALYZE when the database has no statistics yet
+    "vacuum_pages": None,   # free pages to release per run (None = all)
+    "checkpoint": True,     # truncate the WAL so the reclaimed space shows in the file size
+}
+
+_config_cache = {}
+
+
+def config_path(db_path):
+    import db
+
+    path = db.database_file(db_path)
+    # An in-memory database has no directory; look next to the code instead
+    directory = os.path.dirname(os.path.abspath(path if path is not None else __file__))
+    return os.environ.get("HMS_STORAGE_CONFIG") or os.path.join(directory, "storage.json")
+
+
+def load_config(db_path):
+    """Storage config for the database at db_path ({} when there is no config file)."""
+    path = config_path(db_path)
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    cached = _config_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    config = {}
+    if mtime is not None:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+    _config_cache[path] = (mtime, config)
+    return config
+
+
+def active_profile_name(db_path):
+    return os.environ.get("HMS_STORAGE_PROFILE") or load_config(db_path).get("profile") or DEFAULT_PROFILE
+
+
+def get_profile(db_path, name=None):
+    """Pragma settings of the named profile, or of the configured one."""
+    config = load_config(db_path)
+    name = name or active_profile_name(db_path)
+    custom = config.get("profiles", {})
+    if name not in PROFILES and name not in custom:
+        raise ValueError(f"Unknown storage profile {name!r}; expected one of {', '.join(sorted({*PROFILES, *custom}))}")
+    profile = {**PROFILES.get(name, {}), **custom.get(name, {})}
+    unknown = set(profile) - set(PROFILE_PRAGMAS)
+    if unknown:
+        raise ValueError(f"Storage profile {name!r} sets unsupported pragmas: {', '.join(sorted(unknown))}")
+    return profile
+
+
+def _pragma_value(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isalnum():
+        return value
+    raise ValueError(f"Invalid pragma value {value!r}")
+
+
+def apply_profile(conn, profile):
+    """
+    Apply a profile's pragmas to an open connection. auto_vacuum only takes effect
+    on a new database; run_maintenance converts existing files.
+    """
+    for pragma in PROFILE_PRAGMAS:
+        if pragma in profile:
+            conn.execute(f"PRAGMA {pragma} = {_pragma_value(profile[pragma])}")
+    return conn
+
+
+# -------------------- Maintenance --------------------
+def _file_size(path):
+    import db
+
+    path = db.database_file(path)
+    if path is None:
+        return 0
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def maintain(conn, path, profile=None, analyze=True, vacuum_pages=None, checkpoint=True):
+    """
+    Run PRAGMA optimize (ANALYZE first if the database has never been analyzed),
+    release free pages with incremental vacuum and checkpoint the WAL. A database not
+    yet in the profile's auto_vacuum mode is converted with a one-off full VACUUM.
+    Returns sizes before/after and what was reclaimed.
+    """
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    before = {
+        "file_bytes": _file_size(path),
+        "pages": conn.execute("PRAGMA page_count").fetchone()[0],
+        "free_pages": conn.execute("PRAGMA freelist_count").fetchone()[0],
+    }
+    actions = []
+
+    has_stats = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+    if analyze and not has_stats:
+        conn.execute("ANALYZE")
+        actions.append("analyze")
+    conn.execute("PRAGMA optimize")
+    actions.append("optimize")
+
+    # 0 = none, 1 = full, 2 = incremental
+    wanted = str((profile or {}).get("auto_vacuum", "")).upper()
+    current = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    if wanted == "INCREMENTAL" and current != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        actions.append("vacuum (enable incremental)")
+    elif current == 2 and before["free_pages"]:
+        # executescript steps the pragma to completion; execute() would free a single page
+        conn.commit()
+        conn.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages or 0)});")
+        actions.append("incremental_vacuum")
+    conn.commit()
+
+    # With WAL archiving (wal_autocheckpoint = 0) the archiver owns checkpoints
+    archiving = (profile or {}).get("wal_autocheckpoint") == 0
+    if checkpoint and not archiving and conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        actions.append("checkpoint")
+
+    after = {
+        "file_bytes": _file_size(path),
+        "pages": conn.execute("PRAGMA page_count").fetchone()[0],
+        "free_pages": conn.execute("PRAGMA freelist_count").fetchone()[0],
+    }
+    return {
+        "path": path,
+        "actions": actions,
+        "page_size": page_size,
+        "before": before,
+        "after": after,
+        "reclaimed_bytes": before["file_bytes"] - after["file_bytes"],
+        "reclaimed_pages": before["pages"] - after["pages"],
+    }
+
+
+def run_maintenance(**options):
+    """
+    Maintain the primary database and every patient shard with the configured
+    profile and maintenance options (keyword arguments override the config file).
+    Returns one report per database file.
+    """
+    import db
+
+    config = load_config(db.DB_PATH)
+    settings = {**MAINTENANCE_DEFAULTS, **config.get("maintenance", {}), **options}
+    profile = get_profile(db.DB_PATH)
+
+    targets = [(db.get_connection(), db.DB_PATH)]
+    router = db.get_shard_router()
+    if router is not None:
+        targets += [(router.connect(i), router.shard_paths[i]) for i in range(len(router))]
+
+    reports = []
+    for conn, path in targets:
+        try:
+            reports.append(maintain(conn, path, profile, **settings))
+        finally:
+            conn.close()
+    return reports
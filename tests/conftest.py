@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A new, unsharded database file in tmp_path; the previous location is restored afterwards."""
+    saved = db.DB_PATH, db.DB_SNAPSHOT, db.SHARD_DIR
+    monkeypatch.setattr(db, "SHARD_COUNT", 0)
+    path = db.configure_database(str(tmp_path / "hms.db"), shard_dir=str(tmp_path))
+    conn = db.get_connection()
+    db.create_schema(conn)
+    conn.close()
+    yield path
+    db.configure_database(*saved)
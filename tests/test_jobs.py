@@ -0,0 +1,35 @@
+import db
+import jobs
+
+
+def job_status(job_id):
+    conn = db.get_connection()
+    row = conn.execute("SELECT status, message FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def test_recovered_job_is_not_overwritten(database, monkeypatch):
+    def interrupted(ctx):
+        # Another runner's sweep gives up on this job while it is still running
+        jobs._recover_interrupted_jobs(timeout=-1)
+        return {"done": True}
+
+    monkeypatch.setitem(jobs.JOB_KINDS, "interrupted", (interrupted, None))
+    job_id = jobs.submit_job("interrupted")
+    assert jobs.JobRunner(workers=1).run_one()
+    assert job_status(job_id) == ("failed", "Interrupted (worker exited)")
+
+
+def test_finish_requires_the_claiming_runner(database, monkeypatch):
+    monkeypatch.setitem(jobs.JOB_KINDS, "noop", (lambda ctx: {}, None))
+    job_id = jobs.submit_job("noop")
+    runner = jobs.JobRunner(workers=1)
+    runner._claim()
+    assert not jobs.JobRunner(workers=1)._finish(job_id, "succeeded")
+    assert runner._finish(job_id, "succeeded")
+    assert job_status(job_id)[0] == "succeeded"
+
+
+def test_heartbeat_timeout_outlasts_busy_beats():
+    assert jobs.HEARTBEAT_TIMEOUT >= jobs.HEARTBEAT_MISSES * (jobs.HEARTBEAT_INTERVAL + 2 * jobs._BUSY_SECONDS)
@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+
+import db
+
+
+def add_patient(date_added, date_added_epoch=None):
+    patient_id, conn = db.allocate_patient()
+    conn.execute(
+        "INSERT INTO patients (patient_id, diagnosis, anonymized_name, anonymized_contact, date_added, date_added_epoch) "
+        "VALUES (?, 'Flu', 'ANON', 'XXX-XXX-0000', ?, ?)",
+        (patient_id, date_added, date_added_epoch)
+    )
+    conn.commit()
+    conn.close()
+    return patient_id
+
+
+def test_retention_dates_rows_without_epoch(database):
+    old = (datetime.now() - timedelta(days=400)).strftime("%Y-%m-%dT%H:%M:%S")
+    recent = (datetime.now() - timedelta(days=3)).strftime(db.TIMESTAMP_FORMAT)
+    old_id = add_patient(old)
+    recent_id = add_patient(recent)
+    undated_id = add_patient("not a date")
+    dated_id = add_patient(old, db.to_epoch(old))
+
+    assert db.apply_data_retention(365) == 2
+
+    conn = db.get_connection()
+    rows = dict(conn.execute("SELECT patient_id, date_added_epoch FROM patients").fetchall())
+    conn.close()
+    assert old_id not in rows and dated_id not in rows
+    assert rows[recent_id] == db.to_epoch(recent)
+    assert undated_id in rows and rows[undated_id] is None
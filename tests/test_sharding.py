@@ -0,0 +1,85 @@
+import pytest
+
+import db
+from sharding import ShardRouter
+
+
+@pytest.fixture
+def sharded(database, monkeypatch):
+    monkeypatch.setattr(db, "SHARD_COUNT", 2)
+    return db.get_shard_router()
+
+
+def add_patients(count):
+    """Allocate count patients with patient_id % 4 + 1 encounters each; returns their ids."""
+    patient_ids = []
+    for i in range(count):
+        patient_id, conn = db.allocate_patient()
+        conn.execute(
+            "INSERT INTO patients (patient_id, diagnosis, anonymized_name, anonymized_contact, date_added) "
+            "VALUES (?, 'Flu', ?, 'XXX-XXX-0000', '2026-01-01 00:00:00')", (patient_id, f"ANON_{i}")
+        )
+        conn.executemany(
+            "INSERT INTO encounters (patient_id, ts, diagnosis) VALUES (?, ?, 'Flu')",
+            [(patient_id, n) for n in range(patient_id % 4 + 1)]
+        )
+        conn.commit()
+        conn.close()
+        patient_ids.append(patient_id)
+    return patient_ids
+
+
+def assert_consistent(router, patient_ids, shard_count):
+    """Every patient sits once, on its placed shard, with all its encounters, and the directory agrees."""
+    assert len(router) == shard_count
+    conn = db.get_connection()
+    directory = dict(conn.execute("SELECT patient_id, shard FROM patient_shards WHERE shard IS NOT NULL").fetchall())
+    conn.close()
+    found = []
+    for index in range(shard_count):
+        conn = router.connect(index)
+        on_shard = [pid for pid, in conn.execute("SELECT patient_id FROM patients").fetchall()]
+        encounters = dict(conn.execute("SELECT patient_id, COUNT(*) FROM encounters GROUP BY patient_id").fetchall())
+        conn.close()
+        for patient_id in on_shard:
+            assert router.place(patient_id) == index
+            assert directory[patient_id] == index
+        assert encounters == {pid: pid % 4 + 1 for pid in on_shard}
+        found += on_shard
+    assert sorted(found) == sorted(patient_ids)
+
+
+def test_allocate_and_rebalance(sharded):
+    patient_ids = add_patients(20)
+    assert_consistent(sharded, patient_ids, 2)
+
+    moved = db.rebalance_shards(3)
+    assert moved == sum(1 for pid in patient_ids if pid % 2 != pid % 3)
+    assert_consistent(sharded, patient_ids, 3)
+
+    # Another process's router reads the layout from the primary and places by it
+    other = ShardRouter(db._open_shard_paths, db.get_connection, shard_count=2)
+    assert len(other) == 3
+    patient_id, shard = other.allocate()
+    assert shard == patient_id % 3
+
+
+def test_interrupted_rebalance_resumes(sharded, monkeypatch):
+    patient_ids = add_patients(20)
+    copy = ShardRouter._copy
+
+    def crash_after_copy(self, source, target, ids):
+        copy(self, source, target, ids)
+        raise OSError("simulated crash")
+
+    monkeypatch.setattr(ShardRouter, "_copy", crash_after_copy)
+    with pytest.raises(OSError):
+        db.rebalance_shards(3)
+    assert sharded.refresh() == (2, 3)
+    with pytest.raises(RuntimeError):
+        db.rebalance_shards(4)
+
+    monkeypatch.setattr(ShardRouter, "_copy", copy)
+    db.rebalance_shards(3)
+    assert sharded.refresh() == (3, None)
+    assert_consistent(sharded, patient_ids, 3)
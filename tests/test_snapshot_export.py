@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+import db
+import snapshot_export
+
+DIAGNOSES = ("Flu", "Cold", "Asthma", "Flu", "Migraine", None, "Cold")
+
+
+def add_patients(count, start_epoch):
+    for i in range(count):
+        patient_id, conn = db.allocate_patient()
+        epoch = start_epoch + i * 20 * 86400
+        conn.execute(
+            "INSERT INTO patients (patient_id, diagnosis, anonymized_name, anonymized_contact, date_added, date_added_epoch) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (patient_id, DIAGNOSES[i % len(DIAGNOSES)], f"ANON_{i}", "XXX-XXX-0000", db.format_epoch(epoch), epoch)
+        )
+        conn.commit()
+        conn.close()
+
+
+def add_logs(count, start_epoch):
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    for i in range(count):
+        db.insert_log(cursor, 1, ("admin", "doctor")[i % 2], ("Login", "ViewPatient", "Export")[i % 3], f"entry {i}",
+                      start_epoch + i * 3600)
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.parametrize("shards", [0, 2])
+def test_multi_batch_snapshot_reads_back(database, tmp_path, monkeypatch, shards):
+    monkeypatch.setattr(db, "SHARD_COUNT", shards)
+    start = db.to_epoch("2026-01-01 00:00:00")
+    add_patients(9, start)
+    add_logs(11, start)
+
+    # Batches of 2 rows: every table is written in several batches, each adding categories
+    manifest = snapshot_export.export_snapshot(str(tmp_path / "snapshots"), batch_size=2, row_group_size=3)
+    root = manifest["path"]
+    assert manifest["tables"]["patients"]["rows"] == 9
+    assert manifest["tables"]["logs"]["rows"] >= 11
+
+    for table, schema in (("patients", snapshot_export.PATIENT_SCHEMA), ("logs", snapshot_export.LOG_SCHEMA)):
+        with pa.memory_map(f"{root}/{table}.arrow") as source:
+            arrow = pa.ipc.open_file(source).read_all()
+        parquet = pq.read_table(f"{root}/{table}")
+        assert arrow.schema == schema
+        assert arrow.num_rows == parquet.num_rows == manifest["tables"][table]["rows"]
+        time_column = schema.field(4).name
+        assert parquet.schema.field(time_column).type == schema.field(time_column).type
+        key = schema.field(0).name
+        assert sorted(arrow.to_pylist(), key=lambda r: r[key]) == sorted(
+            (dict((name, row[name]) for name in schema.names) for row in parquet.to_pylist()), key=lambda r: r[key])
+
+    patients = pa.ipc.open_file(pa.memory_map(f"{root}/patients.arrow")).read_all()
+    assert sorted(patients.column("diagnosis").to_pylist(), key=str) == sorted(
+        (DIAGNOSES[i % len(DIAGNOSES)] for i in range(9)), key=str)
+    # Naive UTC datetimes, to the second
+    assert min(patients.column("date_added").to_pylist()) == datetime(1970, 1, 1) + timedelta(seconds=start)
@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import sqltrace
+
+
+def test_traced_read_then_write_transaction(tmp_path, monkeypatch):
+    """Logging a slow read must not invalidate the snapshot the transaction writes from."""
+    monkeypatch.setattr(sqltrace, "TRACE_SAMPLE", 1.0)
+    monkeypatch.setattr(sqltrace, "SLOW_QUERY_MS", 0.0)
+    monkeypatch.setattr(sqltrace, "SLOW_QUERY_INTERVAL", 0.0)
+    saved = db.DB_PATH, db.DB_SNAPSHOT
+    db.configure_database(str(tmp_path / "trace.db"))
+    try:
+        conn = db.get_connection()
+        db.create_schema(conn)
+        conn.execute("INSERT INTO users (username, password, role) VALUES ('a', 'x', 'admin')")
+        conn.commit()
+
+        for attempt in range(5):
+            conn.execute("BEGIN")
+            assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] >= 1
+            sqltrace.flush()
+            time.sleep(0.01)
+            conn.execute("INSERT INTO users (username, password, role) VALUES (?, 'x', 'doctor')", (f"u{attempt}",))
+            conn.commit()
+        conn.close()
+
+        sqltrace.flush()
+        log = sqltrace.open_log()
+        logged = log.execute("SELECT COUNT(*) FROM slow_queries WHERE statement LIKE 'SELECT COUNT(*) FROM users%'").fetchone()[0]
+        log.close()
+        assert logged >= 5
+        assert os.path.exists(tmp_path / "trace-slowlog.db")
+    finally:
+        db.configure_database(*saved)
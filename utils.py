@@ -2,9 +2,11 @@
 import sqlite3
 from datetime import datetime, timedelta
 import hashlib
+import json
 from cryptography.fernet import Fernet
 import pandas as pd
 import os
+from contextlib import contextmanager
 from cryptography.fernet import Fernet
 import os
 key = b'l6uwdkD_JVmYy-JOODtYb_lzwA7quvhbEEgKfJ8chhk='
@@ -32,10 +34,18 @@ def is_encrypted(value):
     except Exception:
         return False
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "database.db")
+from db import (
+    database_exists, get_connection, get_read_connection, enable_read_replica, ensure_schema,
+    to_epoch, format_epoch, now_epoch, time_range, range_clause,
+    get_shard_router, patient_connection, patient_connections, fan_out_patients, allocate_patient,
+    insert_log, apply_data_retention,
+)
+from shared_cache import cached
+from sqltrace import open_log
+from diagnoses import resolve_code
 
 def ensure_db_exists():
-    return os.path.exists(DB_PATH)
+    return database_exists()
 # -------------------- Password helpers --------------------
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
@@ -56,100 +66,198 @@ def verify_password(input_password: str, stored_password: str) -> bool:
     except Exception:
         return False
 
+def check_user_password(user_id, password):
+    """Verify a user's password whether it is stored Fernet-encrypted, hashed or as legacy plaintext."""
+    conn = get_connection()
+    row = conn.execute("SELECT password FROM users WHERE user_id=?", (user_id,)).fetchone()
+    conn.close()
+    return bool(row) and verify_password(password, decrypt_field(row[0]))
+
 # -------------------- Logging --------------------
+def _insert_log(cursor, user_id, role, action, details=""):
+    """Write an audit row on an open cursor so it commits with the caller's transaction."""
+    insert_log(cursor, user_id, role, action, details, now_epoch())
+
 def log_action(user_id, role, action, details=""):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO logs (user_id, role, action, timestamp, details)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, role, action, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), details))
+    _insert_log(cursor, user_id, role, action, details)
     conn.commit()
     conn.close()
 
-def get_logs_df():
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql("SELECT * FROM logs ORDER BY timestamp DESC", conn)
+@cached("logs")
+def get_logs_df(lo=None, hi=None):
+    """Audit log rows, newest first, optionally limited to the epoch range [lo, hi) (see time_range)."""
+    where, params = range_clause("timestamp_epoch", lo, hi)
+    conn = get_read_connection()
+    df = pd.read_sql(f"SELECT * FROM logs WHERE {where} ORDER BY timestamp_epoch DESC", conn, params=params)
     conn.close()
     return df
 
+@cached("logs")
+def count_logs(lo=None, hi=None):
+    """Number of audit entries in [lo, hi), counted on the compact table without loading rows."""
+    where, params = range_clause("ts", lo, hi)
+    conn = get_read_connection()
+    count = conn.execute(f"SELECT COUNT(*) FROM logs_compact WHERE {where}", params).fetchone()[0]
+    conn.close()
+    return count
+
+def get_slow_queries_df(lo=None, hi=None, limit=500):
+    """Slow-query log entries (see sqltrace.py), newest first, optionally limited to [lo, hi)."""
+    where, params = range_clause("ts", lo, hi)
+    conn = open_log()
+    df = pd.read_sql(f"SELECT * FROM slow_queries WHERE {where} ORDER BY query_id DESC LIMIT ?", conn, params=[*params, limit])
+    conn.close()
+    df["ts"] = df["ts"].map(format_epoch)
+    return df
+
 # -------------------- Anonymization & Encryption --------------------
-def anonymize_all_unanonymized():
+def _anonymized_values(pid, name, contact):
+    """
+    Return (anonymized_name, anonymized_contact, encrypted_name, encrypted_contact)
+    for one patient row, encrypting name/contact only if they are still plaintext.
+    """
+    name = name or ""
+    contact = contact or ""
+    plain_contact = decrypt_field(contact)
+    anon_name = f"ANON_{pid + 1000}"
+    anon_contact = f"XXX-XXX-{plain_contact[-4:]}" if plain_contact else "XXX-XXX-XXXX"
+    if name and not is_encrypted(name):
+        encrypted_name = fernet.encrypt(name.encode()).decode()
+    else:
+        encrypted_name = name
+
+    if contact and not is_encrypted(contact):
+        encrypted_contact = fernet.encrypt(contact.encode()).decode()
+    else:
+        encrypted_contact = contact
+    return anon_name, anon_contact, encrypted_name, encrypted_contact
+
+def anonymize_all_unanonymized(progress=None, batch_size=500):
     """
     Mask and encrypt only patients that haven't been anonymized (anonymized_name is NULL).
+    insert_patient protects new rows itself, so this only finds rows written before that.
     Stores encrypted original in name/contact and masked in anonymized_ fields.
+    Commits every batch_size rows and calls progress(done, total) after each batch;
+    an exception raised by progress (e.g. a job cancellation) stops the sweep there.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT patient_id, name, contact FROM patients WHERE anonymized_name IS NULL OR anonymized_name = ''")
-    patients = cursor.fetchall()
-
-    for p in patients:
-        pid, name, contact = p
-        name = name or ""
-        contact = contact or ""
-        anon_name = f"ANON_{pid + 1000}"
-        anon_contact = f"XXX-XXX-{contact[-4:]}" if contact else "XXX-XXX-XXXX"
-        if name and not is_encrypted(name):
-            encrypted_name = fernet.encrypt(name.encode()).decode()
-        else:
-            encrypted_name = name
+    conns = patient_connections()
+    count = 0
+    try:
+        pending = [
+            conn.execute("SELECT patient_id, name, contact FROM patients WHERE anonymized_name IS NULL OR anonymized_name = ''").fetchall()
+            for conn in conns
+        ]
+        total = sum(len(rows) for rows in pending)
+        for conn, patients in zip(conns, pending):
+            cursor = conn.cursor()
+            for start in range(0, len(patients), batch_size):
+                batch = patients[start:start + batch_size]
+                cursor.executemany('''
+                    UPDATE patients
+                    SET anonymized_name = ?, anonymized_contact = ?, name = ?, contact = ?
+                    WHERE patient_id = ?
+                ''', [(*_anonymized_values(pid, name, contact), pid) for pid, name, contact in batch])
+                conn.commit()
+                count += len(batch)
+                if progress:
+                    progress(count, total)
+    finally:
+        for conn in conns:
+            conn.close()
+    return count
 
-        if contact and not is_encrypted(contact):
-            encrypted_contact = fernet.encrypt(contact.encode()).decode()
-        else:
-            encrypted_contact = contact
 
-        cursor.execute('''
-            UPDATE patients
-            SET anonymized_name = ?, anonymized_contact = ?, name = ?, contact = ?
-            WHERE patient_id = ?
-        ''', (anon_name, anon_contact, encrypted_name, encrypted_contact, pid))
-    conn.commit()
-    conn.close()
-    return len(patients)  
+# -------------------- Patient CRUD --------------------
+def _read_patients_sql(sql, params=(), order_by=None, max_staleness=None):
+    """pd.read_sql over every patient database (shards are queried in parallel), merged in order."""
+    frames = fan_out_patients(lambda conn: pd.read_sql(sql, conn, params=list(params)), max_staleness)
+    df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+    if order_by and len(frames) > 1:
+        df = df.sort_values(order_by, ignore_index=True)
+    return df
 
+@contextmanager
+def _patient_transaction():
+    """
+    Yield (connections to every patient database, cursor for the audit row). Unsharded,
+    the audit row shares the patients transaction; everything commits together on success.
+    """
+    conns = patient_connections()
+    log_conn = conns[0] if get_shard_router() is None else get_connection()
+    all_conns = conns if log_conn is conns[0] else conns + [log_conn]
+    try:
+        yield conns, log_conn.cursor()
+        for conn in all_conns:
+            conn.commit()
+    except Exception:
+        for conn in all_conns:
+            conn.rollback()
+        raise
+    finally:
+        for conn in all_conns:
+            conn.close()
 
-# -------------------- Patient CRUD --------------------
 def get_all_patients_raw(): 
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql("SELECT * FROM patients ORDER BY patient_id", conn)
-    conn.close()
+    df = _read_patients_sql("SELECT * FROM patients ORDER BY patient_id", order_by="patient_id")
     if not df.empty:
         df['name_decrypted'] = df['name'].apply(lambda x: decrypt_field(x))
         df['contact_decrypted'] = df['contact'].apply(lambda x: decrypt_field(x) if x else "")
     return df
 
+@cached("patients")
 def get_patients_for_doctor(): 
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql("SELECT patient_id, anonymized_name, anonymized_contact, diagnosis, date_added FROM patients ORDER BY patient_id", conn)
-    conn.close()
-    return df
-def add_patient_admin(name, contact, diagnosis):
-    return insert_patient(name, contact, diagnosis, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    return _read_patients_sql(
+        "SELECT patient_id, anonymized_name, anonymized_contact, diagnosis, date_added FROM patients ORDER BY patient_id",
+        order_by="patient_id"
+    )
+def add_patient_admin(name, contact, diagnosis, recorded_by=None):
+    return insert_patient(name, contact, diagnosis, datetime.now(), recorded_by=recorded_by)
 
 
 def delete_patient_admin(patient_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = patient_connection(patient_id)
     cursor = conn.cursor()
     cursor.execute("DELETE FROM patients WHERE patient_id = ?", (patient_id,))
     conn.commit()
     conn.close()
     return True
-def insert_patient(name, contact, diagnosis, date_added):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        INSERT INTO patients (name, contact, diagnosis, date_added)
-        VALUES (?, ?, ?, ?)
-    """, (name, contact, diagnosis, date_added))
-    conn.commit()
-    conn.close()
+def insert_patient(name, contact, diagnosis, date_added, facility=None, recorded_by=None):
+    """
+    date_added may be a datetime, date or timestamp string; it is stored in the canonical formats.
+    Name and contact are encrypted and the anonymized columns filled in the same INSERT, so
+    plaintext PII never reaches the database. A diagnosis also opens the patient's encounter
+    history (recorded_by is the user id). Returns the new patient_id. With sharding
+    enabled the row goes to the patient's shard.
+    """
+    epoch = to_epoch(date_added)
+    if epoch is None:
+        epoch = now_epoch()
+    # Coded before allocate_patient opens the write transaction on the primary
+    diagnosis_code = resolve_code(diagnosis)
+    pid, conn = allocate_patient(facility)
+    anon_name, anon_contact, encrypted_name, encrypted_contact = _anonymized_values(pid, name, contact)
+    try:
+        conn.execute("""
+            INSERT INTO patients (patient_id, name, contact, diagnosis, diagnosis_code, anonymized_name,
+                                  anonymized_contact, date_added, date_added_epoch, facility)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (pid, encrypted_name, encrypted_contact, diagnosis, diagnosis_code, anon_name, anon_contact,
+              format_epoch(epoch), epoch, facility))
+        if diagnosis:
+            conn.execute(
+                "INSERT INTO encounters (patient_id, ts, diagnosis, recorded_by) VALUES (?, ?, ?, ?)",
+                (pid, epoch, diagnosis, recorded_by)
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    return pid
 
 
 def get_patient_by_id(patient_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = patient_connection(patient_id)
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM patients WHERE patient_id=?", (patient_id,))
     row = cursor.fetchone()
@@ -174,63 +282,313 @@ def get_patient_by_id(patient_id):
 
     return patient
 
-def update_patient_admin(patient_id, name=None, contact=None, diagnosis=None):
-    conn = sqlite3.connect(DB_PATH)
+# Outcomes reported by update_patient
+UPDATE_OK = "updated"
+UPDATE_CONFLICT = "conflict"
+UPDATE_NOT_FOUND = "not_found"
+
+def update_patient(patient_id, name=None, contact=None, diagnosis=None, expected_version=None, recorded_by=None):
+    """
+    Apply a partial update in a single UPDATE; fields left as None keep their value.
+    If expected_version is given the row is only changed while it still has that
+    row_version, so two editors cannot silently overwrite each other.
+    A changed diagnosis is appended to the patient's encounters (see get_encounters).
+    Returns {"status": UPDATE_OK | UPDATE_CONFLICT | UPDATE_NOT_FOUND, "row_version": int or None}.
+    """
+    diagnosis_code = resolve_code(diagnosis) if diagnosis is not None else None
+    conn = patient_connection(patient_id)
     cursor = conn.cursor()
 
-    cursor.execute("SELECT name, contact, diagnosis FROM patients WHERE patient_id=?", (patient_id,))
-    row = cursor.fetchone()
-    if not row:
+    # A new contact also gets a new masked value; anonymized_name is derived from the id
+    masked_contact = _anonymized_values(patient_id, None, contact)[1] if contact else None
+    sql = """
+        UPDATE patients
+        SET name = COALESCE(?, name),
+            contact = COALESCE(?, contact),
+            anonymized_contact = COALESCE(?, anonymized_contact),
+            diagnosis = COALESCE(?, diagnosis),
+            diagnosis_code = CASE WHEN ? IS NULL THEN diagnosis_code ELSE ? END,
+            row_version = row_version + 1
+        WHERE patient_id = ?
+    """
+    params = [encrypt_field(name), encrypt_field(contact), masked_contact, diagnosis,
+              diagnosis, diagnosis_code, patient_id]
+    version_sql, version_params = "", []
+    if expected_version is not None:
+        version_sql, version_params = " AND row_version = ?", [expected_version]
+    if diagnosis is not None:
+        # Compares with the diagnosis being replaced, so it must run before the UPDATE
+        cursor.execute(
+            "INSERT INTO encounters (patient_id, ts, diagnosis, recorded_by) "
+            "SELECT patient_id, ?, ?, ? FROM patients WHERE patient_id = ? AND diagnosis IS NOT ?" + version_sql,
+            [now_epoch(), diagnosis, recorded_by, patient_id, diagnosis] + version_params
+        )
+    cursor.execute(sql + version_sql, params + version_params)
+
+    if cursor.rowcount == 1:
+        result = {"status": UPDATE_OK, "row_version": None}
+        if expected_version is not None:
+            result["row_version"] = expected_version + 1
+    else:
+        conn.rollback()
+        # Only the failure path pays for a second query, to tell the two cases apart.
+        cursor.execute("SELECT row_version FROM patients WHERE patient_id = ?", (patient_id,))
+        row = cursor.fetchone()
+        if row:
+            result = {"status": UPDATE_CONFLICT, "row_version": row[0]}
+        else:
+            result = {"status": UPDATE_NOT_FOUND, "row_version": None}
+
+    conn.commit()
+    conn.close()
+    return result
+
+def update_patient_admin(patient_id, name=None, contact=None, diagnosis=None, recorded_by=None):
+    return update_patient(patient_id, name=name, contact=contact, diagnosis=diagnosis, recorded_by=recorded_by)["status"] == UPDATE_OK
+
+# -------------------- Encounter history --------------------
+def get_encounters(patient_id, limit=None, lo=None, hi=None):
+    """
+    A patient's encounters, newest first: the latest `limit` and/or those in the epoch
+    range [lo, hi) (see time_range). Served from idx_encounters_patient_ts alone, so the
+    cost grows with the rows returned, not with the size of the table.
+    DataFrame(encounter_id, recorded_at, diagnosis, recorded_by) with recorded_by as a username.
+    """
+    where, params = range_clause("ts", lo, hi)
+    sql = f"""
+        SELECT encounter_id, ts, diagnosis, recorded_by FROM encounters
+        WHERE patient_id = ? AND {where}
+        ORDER BY ts DESC, encounter_id DESC
+    """
+    params = [patient_id] + params
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    conn = patient_connection(patient_id)
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+
+    user_ids = sorted({row[3] for row in rows if row[3] is not None})
+    usernames = {}
+    if user_ids:
+        conn = get_read_connection()
+        usernames = dict(conn.execute(
+            "SELECT user_id, username FROM users WHERE user_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(user_ids),)
+        ).fetchall())
         conn.close()
-        return False
+    df = pd.DataFrame(
+        [(eid, ts, diagnosis, usernames.get(uid, uid)) for eid, ts, diagnosis, uid in rows],
+        columns=["encounter_id", "recorded_at", "diagnosis", "recorded_by"],
+    )
+    df["recorded_at"] = pd.to_datetime(df["recorded_at"], unit="s")
+    return df
 
-    existing_name, existing_contact, existing_diag = row
+# -------------------- Column-projected queries --------------------
+PATIENT_COLUMNS = (
+    "patient_id", "name", "contact", "diagnosis",
+    "anonymized_name", "anonymized_contact", "date_added", "row_version",
+)
+# Derived columns and the stored (encrypted) column each one is decrypted from
+DECRYPTED_COLUMNS = {"name_decrypted": "name", "contact_decrypted": "contact"}
+
+def _type_patient_frame(df):
+    """Give patient columns compact, analysis-ready dtypes in place."""
+    for col in ("patient_id", "row_version"):
+        if col in df:
+            df[col] = df[col].astype("Int64")
+    if "date_added" in df:
+        # Selected from date_added_epoch, so no string parsing is needed
+        df["date_added"] = pd.to_datetime(df["date_added"], unit="s")
+    if "diagnosis" in df:
+        df["diagnosis"] = df["diagnosis"].astype("category")
+    return df
 
-    encrypted_name = encrypt_field(name) if name and not is_encrypted(name) else existing_name
+def _bypass_shared_cache(columns=None, where=None, params=(), order_by=None, arrow=False, max_staleness=None, **kwargs):
+    """
+    Decrypted fields never leave the process, and max_staleness=0 needs current rows, which
+    the shared cache may not hold; get_read_connection(0) then reads the primary.
+    """
+    return max_staleness == 0 or any(c in DECRYPTED_COLUMNS for c in columns or ())
 
-    encrypted_contact = encrypt_field(contact) if contact and not is_encrypted(contact) else existing_contact
+@cached("patients", unless=_bypass_shared_cache)
+def query_patients(columns=None, where=None, params=(), order_by="patient_id", arrow=False, max_staleness=None,
+                   lo=None, hi=None):
+    """
+    Read only the requested patient columns as a typed DataFrame.
 
-    diag_val = diagnosis if diagnosis else existing_diag
+    columns may include name_decrypted / contact_decrypted; the ciphertext behind them
+    is read and decrypted only then, and dropped unless it was requested too.
+    where/params add an internal SQL filter and lo/hi an indexed date_added range
+    (see time_range). arrow=True returns pyarrow-backed dtypes.
+    """
+    columns = list(columns or PATIENT_COLUMNS)
+    unknown = [c for c in columns if c not in PATIENT_COLUMNS and c not in DECRYPTED_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown patient columns: {unknown}")
+    if order_by and order_by not in PATIENT_COLUMNS:
+        raise ValueError(f"Cannot order by {order_by!r}")
+
+    select = [c for c in columns if c in PATIENT_COLUMNS]
+    for col in columns:
+        source = DECRYPTED_COLUMNS.get(col)
+        if source and source not in select:
+            select.append(source)
+
+    select_sql = ["date_added_epoch AS date_added" if c == "date_added" else c for c in select]
+    range_sql, range_params = range_clause("date_added_epoch", lo, hi)
+    sql = f"SELECT {', '.join(select_sql)} FROM patients WHERE {range_sql}"
+    if where:
+        sql += f" AND ({where})"
+    if order_by:
+        sql += f" ORDER BY {'date_added_epoch' if order_by == 'date_added' else order_by}"
+
+    df = _read_patients_sql(sql, range_params + list(params), order_by=order_by, max_staleness=max_staleness)
+
+    for col in columns:
+        source = DECRYPTED_COLUMNS.get(col)
+        if source:
+            df[col] = df[source].map(decrypt_field)
+    df = _type_patient_frame(df[columns])
+    if arrow:
+        df = df.convert_dtypes(dtype_backend="pyarrow")
+    return df
 
-    cursor.execute("""
-        UPDATE patients
-        SET name=?, contact=?, diagnosis=?
-        WHERE patient_id=?
-    """, (encrypted_name, encrypted_contact, diag_val, patient_id))
+@cached("patients")
+def count_patients(lo=None, hi=None):
+    where, params = range_clause("date_added_epoch", lo, hi)
+    return sum(fan_out_patients(
+        lambda conn: conn.execute(f"SELECT COUNT(*) FROM patients WHERE {where}", params).fetchone()[0]
+    ))
+
+@cached("patients")
+def count_patients_by_day(lo=None, hi=None):
+    """Patients added per local day in [lo, hi), grouped in SQL over the date_added_epoch index."""
+    where, params = range_clause("date_added_epoch", lo, hi)
+    df = _read_patients_sql(f"""
+        SELECT date_added_epoch / 86400 * 86400 AS date_added, COUNT(*) AS patients
+        FROM patients
+        WHERE date_added_epoch IS NOT NULL AND {where}
+        GROUP BY date_added_epoch / 86400
+        ORDER BY 1
+    """, params)
+    if get_shard_router() is not None:
+        df = df.groupby("date_added", as_index=False)["patients"].sum()
+    df["date_added"] = pd.to_datetime(df["date_added"], unit="s").dt.date
+    return df
 
-    conn.commit()
-    conn.close()
-    return True
+# -------------------- Bulk patient operations --------------------
+def _summarize_ids(patient_ids, limit=20):
+    """Compact, bounded description of an id set for audit logs, e.g. '1-5, 9, 12-14'."""
+    ids = sorted(set(patient_ids))
+    ranges = []
+    for pid in ids:
+        if ranges and pid == ranges[-1][1] + 1:
+            ranges[-1][1] = pid
+        else:
+            ranges.append([pid, pid])
+    parts = [str(a) if a == b else f"{a}-{b}" for a, b in ranges]
+    if len(parts) > limit:
+        parts = parts[:limit] + [f"... (+{len(parts) - limit} more ranges)"]
+    return ", ".join(parts)
+
+def select_patient_ids(patient_ids=None, id_range=None, date_from=None, date_to=None, diagnosis=None):
+    """
+    Resolve a bulk selection into existing patient ids. Every given criterion must match:
+    an explicit id list, an inclusive (first, last) id range, a date_added window and/or
+    a diagnosis (case- and whitespace-insensitive).
+    """
+    clauses, params = [], []
+    if patient_ids is not None:
+        clauses.append("patient_id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps([int(pid) for pid in patient_ids]))
+    if id_range is not None:
+        clauses.append("patient_id BETWEEN ? AND ?")
+        params.extend([int(id_range[0]), int(id_range[1])])
+    if date_from is not None or date_to is not None:
+        clause, range_params = range_clause("date_added_epoch", *time_range(start=date_from, end=date_to))
+        clauses.append(clause)
+        params.extend(range_params)
+    if diagnosis:
+        clauses.append("LOWER(TRIM(diagnosis)) = LOWER(TRIM(?))")
+        params.append(diagnosis)
+
+    sql = "SELECT patient_id FROM patients"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    results = fan_out_patients(lambda conn: [row[0] for row in conn.execute(sql, params).fetchall()], primary=True)
+    return sorted(pid for ids in results for pid in ids)
+
+def bulk_delete_patients(patient_ids, user_id=None, role=None):
+    """Delete many patients in one transaction with one summarized audit entry. Returns rows deleted."""
+    ids = [(int(pid),) for pid in patient_ids]
+    deleted = 0
+    with _patient_transaction() as (conns, log_cursor):
+        for conn in conns:
+            cursor = conn.cursor()
+            cursor.executemany("DELETE FROM patients WHERE patient_id = ?", ids)
+            deleted += cursor.rowcount
+        _insert_log(log_cursor, user_id, role, "BulkDeletePatients",
+                    f"Deleted {deleted} patients: {_summarize_ids(pid for (pid,) in ids)}")
+    return deleted
+
+def bulk_update_diagnosis(patient_ids, diagnosis, user_id=None, role=None):
+    """
+    Set the same diagnosis on many patients in one transaction, appending an encounter
+    for each patient whose diagnosis changes. Returns rows updated.
+    """
+    ids = [int(pid) for pid in patient_ids]
+    updated = 0
+    now = now_epoch()
+    diagnosis_code = resolve_code(diagnosis)
+    with _patient_transaction() as (conns, log_cursor):
+        for conn in conns:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "INSERT INTO encounters (patient_id, ts, diagnosis, recorded_by) "
+                "SELECT patient_id, ?, ?, ? FROM patients WHERE patient_id = ? AND diagnosis IS NOT ?",
+                [(now, diagnosis, user_id, pid, diagnosis) for pid in ids]
+            )
+            cursor.executemany(
+                "UPDATE patients SET diagnosis = ?, diagnosis_code = ?, row_version = row_version + 1 WHERE patient_id = ?",
+                [(diagnosis, diagnosis_code, pid) for pid in ids]
+            )
+            updated += cursor.rowcount
+        _insert_log(log_cursor, user_id, role, "BulkUpdateDiagnosis",
+                    f"Set diagnosis '{diagnosis}' on {updated} patients: {_summarize_ids(ids)}")
+    return updated
+
+def bulk_reanonymize_patients(patient_ids, user_id=None, role=None):
+    """Recompute masked fields (and encrypt any plaintext) for many patients in one transaction."""
+    ids_json = json.dumps([int(pid) for pid in patient_ids])
+    done = []
+    with _patient_transaction() as (conns, log_cursor):
+        for conn in conns:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT patient_id, name, contact FROM patients WHERE patient_id IN (SELECT value FROM json_each(?))",
+                (ids_json,)
+            )
+            rows = cursor.fetchall()
+            cursor.executemany('''
+                UPDATE patients
+                SET anonymized_name = ?, anonymized_contact = ?, name = ?, contact = ?, row_version = row_version + 1
+                WHERE patient_id = ?
+            ''', [(*_anonymized_values(pid, name, contact), pid) for pid, name, contact in rows])
+            done.extend(r[0] for r in rows)
+        _insert_log(log_cursor, user_id, role, "BulkReanonymize",
+                    f"Re-anonymized {len(done)} patients: {_summarize_ids(done)}")
+    return len(done)
 
 # -------------------- CSV export --------------------
 def export_patients_csv(filepath="patients_backup.csv"):
-    df = get_all_patients_raw()
-    if not df.empty:
-        export_df = df[['patient_id', 'name_decrypted', 'contact_decrypted', 'diagnosis', 'anonymized_name', 'anonymized_contact', 'date_added']]
-        export_df = export_df.rename(columns={'name_decrypted':'name', 'contact_decrypted':'contact'})
-        export_df.to_csv(filepath, index=False)
-    else:
-        export_df = pd.DataFrame(columns=['patient_id','name','contact','diagnosis','anonymized_name','anonymized_contact','date_added'])
-        export_df.to_csv(filepath, index=False)
+    columns = ['patient_id', 'name_decrypted', 'contact_decrypted', 'diagnosis', 'anonymized_name', 'anonymized_contact', 'date_added']
+    export_df = query_patients(columns, max_staleness=0)
+    export_df = export_df.rename(columns={'name_decrypted':'name', 'contact_decrypted':'contact'})
+    export_df.to_csv(filepath, index=False)
     return filepath
 
 
-# -------------------- Data retention --------------------
-def apply_data_retention(retention_days):
-    """
-    Delete patient records older than retention_days (based on date_added).
-    Returns number of deleted records.
-    """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cutoff = (datetime.now() - timedelta(days=retention_days)).strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute("SELECT COUNT(*) FROM patients WHERE date_added < ?", (cutoff,))
-    count = cursor.fetchone()[0]
-    cursor.execute("DELETE FROM patients WHERE date_added < ?", (cutoff,))
-    conn.commit()
-    conn.close()
-    return count
-
 # -------------------- Helper --------------------
 def ensure_db_exists():
-    return os.path.exists(DB_PATH)
+    return database_exists()